@@ -3,6 +3,9 @@ The onsset package contains the following modules:
 
  - onsset.py : main functions of the model
  - runner.py : runner is used to calibrate inputs and specify scenario runs
+ - config.py : parses the specs file once into a validated configuration
+ - cache.py : memoises the stages of scenario runs
+ - storage.py : reads and writes settlement data in columns and in chunks
 """
 
 from pkg_resources import get_distribution, DistributionNotFound
@@ -13,3 +16,5 @@ except DistributionNotFound:
     pass
 
 from .onsset import *
+from .cache import StageCache
+from .storage import ColumnStore, ResultDataset, SettlementWriter, open_csv, settlement_format
@@ -0,0 +1,158 @@
+"""Memoises the stages of scenario runs
+
+Scenarios of a sweep often share the parameters of their first stages, e.g. all scenarios with the same population
+growth have the same population projection. A ``StageCache`` keeps the settlements after each stage under a hash of
+everything they depend on, so that the scenarios after the first restore them instead of running the stage again.
+"""
+
+import copy
+import glob
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+try:
+    from onsset.onsset import Technology
+except ImportError:
+    from onsset import Technology
+
+
+def code_version(folder=os.path.dirname(os.path.abspath(__file__))):
+    """Returns a hash of the source of all modules of the onsset package, or of the modules in folder"""
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(folder, '*.py'))):
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as module:
+            digest.update(hashlib.sha256(module.read()).digest())
+    return digest.hexdigest()
+
+
+class StageCache:
+    """Memoises the settlement data after a stage of a scenario, so that scenarios sharing the parameters of a stage
+    and of every stage before it can skip it
+
+    Entries hold a copy of ``SettlementProcessor.df`` and the return value of the stage. They are kept in memory up to
+    ``max_bytes`` and evicted least recently used first. If a folder is given, entries are also pickled there, which
+    lets worker processes and later runs share them. Pickling the cache itself, as when it is sent to a worker
+    process, leaves the entries in memory behind. The keys include the version of the code, so entries in the folder
+    are not restored after a module of the package changes.
+    """
+
+    def __init__(self, max_bytes=2 * 1024 ** 3, folder=None):
+        self.max_bytes = max_bytes
+        self.folder = folder
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.code = code_version()
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(entries=OrderedDict(), sizes={}, nbytes=0)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @staticmethod
+    def fingerprint(*parts):
+        """Returns a stable hash of numbers, strings and containers of them"""
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    @staticmethod
+    def data_hash(df):
+        """Returns a hash of the values and index of a DataFrame"""
+        return hashlib.sha1(pd.util.hash_pandas_object(df, index=True).values.tobytes()).hexdigest()
+
+    @staticmethod
+    def nbytes_of(value):
+        """Estimates the memory held by a stage result"""
+        if isinstance(value, pd.DataFrame):
+            return int(value.memory_usage(index=True, deep=True).sum())
+        if isinstance(value, pd.Series):
+            return int(value.memory_usage(index=True, deep=True))
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        if isinstance(value, (tuple, list)):
+            return sum(StageCache.nbytes_of(item) for item in value)
+        return 0
+
+    @staticmethod
+    def technology_fingerprint(*technologies):
+        """Returns a hash of the parameters of the given technologies and of those shared by all technologies"""
+        shared = sorted((name, value) for name, value in vars(Technology).items()
+                        if isinstance(value, (int, float, str)) and not name.startswith('_'))
+        return StageCache.fingerprint(shared, [sorted(vars(technology).items()) for technology in technologies])
+
+    def get(self, key):
+        """Returns a copy of the entry stored under key, or None"""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return copy.deepcopy(self.entries[key])
+        if self.folder is not None:
+            try:
+                with open(os.path.join(self.folder, key + '.pkl'), 'rb') as entry_file:
+                    entry = pickle.load(entry_file)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                return None
+            self._remember(key, entry)
+            return copy.deepcopy(entry)
+        return None
+
+    def put(self, key, entry):
+        """Stores a copy of entry under key"""
+        entry = copy.deepcopy(entry)
+        if self.folder is not None:
+            path = os.path.join(self.folder, key + '.pkl')
+            with open(path + '.tmp{}'.format(os.getpid()), 'wb') as entry_file:
+                pickle.dump(entry, entry_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp{}'.format(os.getpid()), path)
+        self._remember(key, entry)
+
+    def _remember(self, key, entry):
+        size = self.nbytes_of(entry)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.sizes[key]
+        self.entries[key] = entry
+        self.sizes[key] = size
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            evicted, _ = self.entries.popitem(last=False)
+            self.nbytes -= self.sizes.pop(evicted)
+
+    def run(self, onsseter, stage, parameters, *args, **kwargs):
+        """Runs a stage of a scenario, or restores the settlements and the result it produced before
+
+        Arguments
+        ---------
+        onsseter : SettlementProcessor
+        stage : callable
+            A method of onsseter
+        parameters : dict
+            Everything the settlements depend on after the stage: the input data, the year and the scenario
+            parameters of this stage and of all stages before it
+
+        Returns
+        -------
+        The return value of the stage
+        """
+        key = self.fingerprint(self.code, stage.__name__, sorted(parameters.items()))
+        entry = self.get(key)
+        if entry is not None:
+            self.hits += 1
+            onsseter.df, result = entry
+            return result
+        self.misses += 1
+        result = stage(*args, **kwargs)
+        self.put(key, (onsseter.df, result))
+        return result
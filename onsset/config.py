@@ -0,0 +1,328 @@
+"""Compiles the specs file into a validated configuration
+
+The SpecsData, SpecsDataCalib, ScenarioInfo and ScenarioParameters sheets are parsed once into a ``Config``, which the
+calibration and the scenarios take their parameters from instead of reading the workbook again. A config can be saved
+as and loaded from JSON or TOML, so that later runs do not need Excel at all, and the rows of the ScenarioInfo sheet
+are expanded up front into a ``ScenarioConfig`` each, with the ScenarioParameters values that they select.
+"""
+
+import json
+import math
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+try:
+    from onsset.specs import (SPE_COUNTRY, SPE_ELEC, SPE_ELEC_RURAL, SPE_ELEC_URBAN, SPE_END_YEAR,
+                              SPE_GRID_CAPACITY_INVESTMENT, SPE_GRID_LOSSES, SPE_MAX_GRID_EXTENSION_DIST,
+                              SPE_NUM_PEOPLE_PER_HH_RURAL, SPE_NUM_PEOPLE_PER_HH_URBAN, SPE_POP, SPE_POP_FUTURE,
+                              SPE_START_YEAR, SPE_URBAN, SPE_URBAN_FUTURE)
+except ImportError:
+    from specs import (SPE_COUNTRY, SPE_ELEC, SPE_ELEC_RURAL, SPE_ELEC_URBAN, SPE_END_YEAR,
+                       SPE_GRID_CAPACITY_INVESTMENT, SPE_GRID_LOSSES, SPE_MAX_GRID_EXTENSION_DIST,
+                       SPE_NUM_PEOPLE_PER_HH_RURAL, SPE_NUM_PEOPLE_PER_HH_URBAN, SPE_POP, SPE_POP_FUTURE,
+                       SPE_START_YEAR, SPE_URBAN, SPE_URBAN_FUTURE)
+
+# The sheets of the specs file, by their key in the serialised config
+SHEETS = {'specs': 'SpecsData', 'calibrated_specs': 'SpecsDataCalib', 'scenario_info': 'ScenarioInfo',
+          'scenario_parameters': 'ScenarioParameters'}
+
+# The types of the specs that the calibration and the scenarios read. Integers are accepted as floats, and floats
+# without a fraction as integers.
+SPECS_TYPES = {SPE_COUNTRY: str, 'CountryCode': str, SPE_START_YEAR: int, SPE_END_YEAR: int, SPE_POP: float,
+               SPE_URBAN: float, SPE_POP_FUTURE: float, SPE_URBAN_FUTURE: float, SPE_NUM_PEOPLE_PER_HH_RURAL: float,
+               SPE_NUM_PEOPLE_PER_HH_URBAN: float, SPE_GRID_CAPACITY_INVESTMENT: float, SPE_GRID_LOSSES: float,
+               SPE_MAX_GRID_EXTENSION_DIST: float, 'NewGridGenerationCapacityAnnualLimitMW': float, SPE_ELEC: float,
+               SPE_ELEC_URBAN: float, SPE_ELEC_RURAL: float}
+
+# The ScenarioParameters columns that each ScenarioInfo column selects a row of
+SCENARIO_PARAMETERS = {'Population_Growth': ['PopEndYear'],
+                       'Target_electricity_consumption_level': ['RuralTargetTier', 'UrbanTargetTier'],
+                       'Electrification_target_5_years': ['5YearTarget', 'GridConnectionsLimitThousands'],
+                       'Grid_electricity_generation_cost': ['GridGenerationCost'],
+                       'PV_cost_adjust': ['PV_Cost_adjust'],
+                       'Diesel_price': ['DieselPrice'],
+                       'Productive_uses_demand': ['ProductiveDemand'],
+                       'Prioritization_algorithm': ['PrioritizationAlgorithm', 'AutoIntensificationKM']}
+
+# The optional ScenarioParameters columns of the row that Prioritization_algorithm selects, with their allowed values.
+# A missing column or value stands for the first.
+OPTIONAL_PARAMETERS = {'GridExtensionAlgorithm': ('rounds', 'priority'),
+                       'HydroAllocation': ('dataframe', 'advantage')}
+
+
+def is_missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def matches_type(value, expected):
+    """Whether a value parsed from the specs can be used as the expected type"""
+    if expected is str:
+        return isinstance(value, str)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or is_missing(value):
+        return False
+    return expected is float or float(value).is_integer()
+
+
+def records(df):
+    """Returns the rows of a sheet as dicts of Python scalars, with missing values as NaN"""
+    rows = []
+    for row in df.to_dict('records'):
+        rows.append({str(column): float('nan') if is_missing(value) or value is pd.NaT else
+                     value.item() if isinstance(value, np.generic) else value
+                     for column, value in row.items()})
+    return rows
+
+
+def optional_parameter(row, column):
+    """Returns the value of an optional ScenarioParameters column, or its default if the column or value is missing"""
+    value = row.get(column)
+    return OPTIONAL_PARAMETERS[column][0] if is_missing(value) else value
+
+
+class ScenarioConfig:
+    """A row of the ScenarioInfo sheet with the ScenarioParameters values that it selects
+
+    Attributes
+    ----------
+    info : dict
+        The ScenarioInfo row, i.e. the scenario number and the ScenarioParameters row of each parameter
+    """
+
+    def __init__(self, info, parameters):
+        """
+        Arguments
+        ---------
+        info : dict
+            A row of the ScenarioInfo sheet
+        parameters : list of dict
+            The rows of the ScenarioParameters sheet
+        """
+        self.info = info
+        self.number = info['Scenario']
+
+        def parameter(index_column, column):
+            return parameters[int(info[index_column])][column]
+
+        self.end_year_pop = parameter('Population_Growth', 'PopEndYear')
+        self.rural_tier = parameter('Target_electricity_consumption_level', 'RuralTargetTier')
+        self.urban_tier = parameter('Target_electricity_consumption_level', 'UrbanTargetTier')
+        self.five_year_target = parameter('Electrification_target_5_years', '5YearTarget')
+        self.annual_new_grid_connections_limit = \
+            parameter('Electrification_target_5_years', 'GridConnectionsLimitThousands') * 1000
+        self.grid_price = parameter('Grid_electricity_generation_cost', 'GridGenerationCost')
+        self.pv_capital_cost_adjust = parameter('PV_cost_adjust', 'PV_Cost_adjust')
+        self.diesel_price = parameter('Diesel_price', 'DieselPrice')
+        self.productive_demand = parameter('Productive_uses_demand', 'ProductiveDemand')
+        self.prioritization = parameter('Prioritization_algorithm', 'PrioritizationAlgorithm')
+        self.auto_intensification = parameter('Prioritization_algorithm', 'AutoIntensificationKM')
+        # The grid extension algorithm is 'rounds' unless the GridExtensionAlgorithm column is set, and hydro-power
+        # sites are allocated in the order of the settlements unless the HydroAllocation column is set
+        self.algorithm = optional_parameter(parameters[int(info['Prioritization_algorithm'])],
+                                            'GridExtensionAlgorithm')
+        self.hydro_allocation = optional_parameter(parameters[int(info['Prioritization_algorithm'])],
+                                                   'HydroAllocation')
+
+
+class Config:
+    """The specs and scenarios of a country, parsed once from the specs file
+
+    Attributes
+    ----------
+    specs : dict
+        The SpecsData sheet, by column. Missing values are NaN, as in pandas.
+    calibrated_specs : dict or None
+        The SpecsDataCalib sheet, once the calibration has added it
+    scenario_info : list of dict
+        The rows of the ScenarioInfo sheet
+    scenario_parameters : list of dict
+        The rows of the ScenarioParameters sheet
+    scenarios : list of ScenarioConfig
+        The rows of the ScenarioInfo sheet, in order, with their parameters
+    source : str or None
+        The file the config was loaded from
+    """
+
+    _loaded = {}
+
+    def __init__(self, specs, calibrated_specs=None, scenario_info=(), scenario_parameters=(), source=None):
+        self.specs = dict(specs)
+        self.calibrated_specs = None if calibrated_specs is None else dict(calibrated_specs)
+        self.scenario_info = [dict(row) for row in scenario_info]
+        self.scenario_parameters = [dict(row) for row in scenario_parameters]
+        self.source = source
+        self.validate()
+        self.scenarios = [ScenarioConfig(row, self.scenario_parameters) for row in self.scenario_info]
+
+    def validate(self):
+        """Checks the specs that the model reads and that every scenario selects existing, complete parameters
+
+        Raises
+        ------
+        ValueError
+            Listing every problem found
+        """
+        errors = []
+        for key, specs in (('specs', self.specs), ('calibrated_specs', self.calibrated_specs)):
+            if specs is None:
+                continue
+            for column, expected in SPECS_TYPES.items():
+                if column not in specs or is_missing(specs[column]):
+                    errors.append('{} has no {}'.format(SHEETS[key], column))
+                elif not matches_type(specs[column], expected):
+                    errors.append('{} {} is {!r}, expected {}'.format(SHEETS[key], column, specs[column],
+                                                                      expected.__name__))
+
+        for number, info in enumerate(self.scenario_info):
+            if not matches_type(info.get('Scenario'), int):
+                errors.append('ScenarioInfo row {} Scenario is {!r}, expected an integer'
+                              .format(number, info.get('Scenario')))
+            for index_column, columns in SCENARIO_PARAMETERS.items():
+                index = info.get(index_column)
+                if not matches_type(index, int) or not 0 <= index < len(self.scenario_parameters):
+                    errors.append('ScenarioInfo row {} {} is {!r}, expected a row of ScenarioParameters'
+                                  .format(number, index_column, index))
+                    continue
+                for column in columns:
+                    value = self.scenario_parameters[int(index)].get(column)
+                    if not matches_type(value, float):
+                        errors.append('ScenarioParameters row {} {} is {!r}, expected a number'
+                                      .format(int(index), column, value))
+                if index_column == 'Prioritization_algorithm':
+                    for column, allowed in OPTIONAL_PARAMETERS.items():
+                        value = self.scenario_parameters[int(index)].get(column)
+                        if not is_missing(value) and value not in allowed:
+                            errors.append('ScenarioParameters row {} {} is {!r}, expected one of {}'
+                                          .format(int(index), column, value, ', '.join(allowed)))
+        if errors:
+            raise ValueError('Invalid specs{}:\n'.format(' in ' + self.source if self.source else '') +
+                             '\n'.join(errors))
+
+    @classmethod
+    def load(cls, path):
+        """Returns the config of a specs workbook, or of a config saved as .json or .toml
+
+        The config of each file is kept for as long as the file is unchanged, so that loading it again is free.
+        A ``Config`` is returned as it is.
+
+        Arguments
+        ---------
+        path : str or Config
+        """
+        if not isinstance(path, (str, os.PathLike)):
+            return path
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        if key not in cls._loaded:
+            extension = os.path.splitext(path)[1].lower()
+            if extension == '.json':
+                with open(path) as config_file:
+                    config = cls.from_dict(json.load(config_file), source=path)
+            elif extension == '.toml':
+                config = cls.from_dict(read_toml(path), source=path)
+            else:
+                config = cls.from_excel(path)
+            cls._loaded = {loaded: value for loaded, value in cls._loaded.items() if loaded[0] != key[0]}
+            cls._loaded[key] = config
+        return cls._loaded[key]
+
+    @classmethod
+    def from_excel(cls, path):
+        """Parses the sheets of a specs workbook, opening it once"""
+        with pd.ExcelFile(path) as book:
+            sheets = {key: records(book.parse(sheet)) for key, sheet in SHEETS.items() if sheet in book.sheet_names}
+        if 'specs' not in sheets:
+            raise ValueError('{} has no {} sheet'.format(path, SHEETS['specs']))
+        return cls(sheets['specs'][0], sheets['calibrated_specs'][0] if 'calibrated_specs' in sheets else None,
+                   sheets.get('scenario_info', ()), sheets.get('scenario_parameters', ()), source=path)
+
+    @classmethod
+    def from_dict(cls, config, source=None):
+        """Builds a config from the dict that ``to_dict`` returns"""
+        return cls(config['specs'], config.get('calibrated_specs'), config.get('scenario_info', ()),
+                   config.get('scenario_parameters', ()), source=source)
+
+    def to_dict(self):
+        """Returns copies of the sheets of the config by their key in ``SHEETS``, leaving out a missing
+        SpecsDataCalib"""
+        config = {'specs': dict(self.specs)}
+        if self.calibrated_specs is not None:
+            config['calibrated_specs'] = dict(self.calibrated_specs)
+        config['scenario_info'] = [dict(row) for row in self.scenario_info]
+        config['scenario_parameters'] = [dict(row) for row in self.scenario_parameters]
+        return config
+
+    def with_calibrated_specs(self, calibrated_specs):
+        """Returns a copy of the config with the SpecsDataCalib sheet set
+
+        Arguments
+        ---------
+        calibrated_specs : dict or pandas.DataFrame
+            A DataFrame is taken from its first row
+        """
+        if isinstance(calibrated_specs, pd.DataFrame):
+            calibrated_specs = records(calibrated_specs.iloc[:1])[0]
+        return Config(self.specs, calibrated_specs, self.scenario_info, self.scenario_parameters, self.source)
+
+    def specs_frame(self, calibrated=False):
+        """Returns the SpecsData, or with calibrated the SpecsDataCalib, sheet as a one row DataFrame"""
+        return pd.DataFrame([self.calibrated_specs if calibrated else self.specs])
+
+    def save(self, path):
+        """Writes the config as JSON or TOML, or as a workbook of just its sheets, by the extension of path"""
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.json':
+            with open(path, 'w') as config_file:
+                json.dump(self.to_dict(), config_file, indent=1)
+        elif extension == '.toml':
+            write_toml(self.to_dict(), path)
+        else:
+            with pd.ExcelWriter(path) as writer:
+                for key, rows in self.to_dict().items():
+                    pd.DataFrame(rows if isinstance(rows, list) else [rows]).to_excel(writer, sheet_name=SHEETS[key],
+                                                                                      index=False)
+
+
+def toml_key(key):
+    return key if re.fullmatch('[A-Za-z0-9_-]+', key) else json.dumps(key)
+
+
+def toml_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'nan'
+        if math.isinf(value):
+            return 'inf' if value > 0 else '-inf'
+        return repr(value)
+    if is_missing(value):
+        return 'nan'
+    return json.dumps(str(value))
+
+
+def write_toml(config, path):
+    """Writes the dict that ``Config.to_dict`` returns as TOML, with the sheets of one row as tables and the others as
+    arrays of tables"""
+    lines = []
+    for key, rows in config.items():
+        for row in rows if isinstance(rows, list) else [rows]:
+            lines.append(('[[{}]]' if isinstance(rows, list) else '[{}]').format(key))
+            lines += ['{} = {}'.format(toml_key(column), toml_value(value)) for column, value in row.items()]
+            lines.append('')
+    with open(path, 'w', encoding='utf-8') as config_file:
+        config_file.write('\n'.join(lines))
+
+
+def read_toml(path):
+    """Reads a TOML file with ``tomllib``, or ``tomli`` before Python 3.11"""
+    try:
+        import tomllib
+    except ImportError:
+        import tomli as tomllib
+    with open(path, 'rb') as config_file:
+        return tomllib.load(config_file)
@@ -4,9 +4,10 @@ This file runs either the calibration or scenario modules in the runner file,
 and asks the user to browse to the necessary input files
 """
 
+import os
 import tkinter as tk
 from tkinter import filedialog, messagebox
-import pandas as pd
+from config import Config
 from runner import calibration, scenario
 
 root = tk.Tk()
@@ -18,7 +19,8 @@ choice = int(input('Enter 1 to prepare/calibrate the GIS input file, 2 to run sc
 messagebox.showinfo('OnSSET', 'Open the specs file')
 specs_path = filedialog.askopenfilename()
 
-specs = pd.read_excel(specs_path, index_col=0)
+# The specs file is parsed once here and the config handed on, instead of every step reading the workbook again
+config = Config.load(specs_path)
 
 if choice == 1:
     messagebox.showinfo('OnSSET', 'Open the file containing separated countries')
@@ -32,7 +34,9 @@ if choice == 1:
     specs_path_calib = filedialog.asksaveasfilename()
     specs_path_calib = specs_path_calib + '.xlsx'
 
-    calibration(specs_path, csv_path, specs_path_calib, calibrated_csv_path)
+    # Re-running the calibration on unchanged inputs copies the previous outputs from the cache
+    cache_folder = os.path.join(os.path.dirname(calibrated_csv_path), 'calibration_cache')
+    calibration(config, csv_path, specs_path_calib, calibrated_csv_path, cache_folder=cache_folder)
 
 elif choice == 2:
     messagebox.showinfo('OnSSET', 'Open the csv file with calibrated GIS data')
@@ -42,4 +46,4 @@ elif choice == 2:
     messagebox.showinfo('OnSSET', 'Browse to SUMMARIES folder and name the scenario to save outputs')
     summary_folder = filedialog.askdirectory()
 
-    scenario(specs_path, calibrated_csv_path, results_folder, summary_folder)
+    scenario(config, calibrated_csv_path, results_folder, summary_folder)
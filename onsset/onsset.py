@@ -1,11 +1,22 @@
+import csv
+import heapq
+import itertools
+import json
 import logging
+import os
 from math import exp, log, pi
 from typing import Dict
+import scipy.sparse
 import scipy.spatial
 
 import numpy as np
 import pandas as pd
 
+try:
+    from onsset.storage import ColumnStore, open_csv, settlement_format
+except ImportError:
+    from storage import ColumnStore, open_csv, settlement_format
+
 logging.basicConfig(format='%(asctime)s\t\t%(message)s', level=logging.ERROR)
 logger = logging.getLogger(__name__)
 
@@ -43,6 +54,7 @@ SET_NUM_PEOPLE_PER_HH = 'NumPeoplePerHH'
 SET_ELEC_CURRENT = 'ElecStart'  # If the site is currently electrified (0 or 1)
 SET_NEW_CONNECTIONS = 'NewConnections'  # Number of new people with electricity connections
 SET_MIN_GRID_DIST = 'MinGridDist'
+SET_BREAK_EVEN_GRID_DIST = 'BreakEvenGridDist'  # Longest penalised grid connection that beats off-grid (km)
 SET_LCOE_GRID = 'Grid'  # All LCOE's in USD/kWh
 SET_LCOE_SA_PV = 'SA_PV'
 SET_LCOE_SA_DIESEL = 'SA_Diesel'
@@ -91,6 +103,63 @@ SET_MG_DIESEL_FUEL = 'MGDieselFuelCost'
 LHV_DIESEL = 9.9445485  # (kWh/l) lower heating value
 HOURS_PER_YEAR = 8760
 
+# Compact column types of the settlements. Codes are kept as small integers and names as categoricals. Measurements
+# stay float64, since those that are classified or compared against thresholds would change class at the bin edges
+# in float32. Columns that are not listed are left as they are.
+SETTLEMENT_DTYPES = {SET_COUNTRY: 'category',
+                     SET_X_DEG: 'float64', SET_Y_DEG: 'float64', SET_POP: 'float64', SET_GRID_CELL_AREA: 'float64',
+                     SET_ELEC_POP: 'float64', SET_WINDVEL: 'float64', SET_GHI: 'float64',
+                     SET_TRAVEL_HOURS: 'float64', SET_ELEVATION: 'float64', SET_SLOPE: 'float64',
+                     SET_NIGHT_LIGHTS: 'float64', SET_LAND_COVER: 'int8', SET_SUBSTATION_DIST: 'float64',
+                     SET_DIST_TO_TRANS: 'float64', SET_HV_DIST_CURRENT: 'float64', SET_HV_DIST_PLANNED: 'float64',
+                     SET_MV_DIST_CURRENT: 'float64', SET_MV_DIST_PLANNED: 'float64', SET_ROAD_DIST: 'float64',
+                     SET_HYDRO_DIST: 'float64', SET_HYDRO: 'float64', SET_HYDRO_FID: 'int32', SET_URBAN: 'int8',
+                     SET_CAPITA_DEMAND: 'float64', SET_HEALTH_DEMAND: 'float64', SET_EDU_DEMAND: 'float64',
+                     SET_AGRI_DEMAND: 'float64', SET_COMMERCIAL_DEMAND: 'float64', SET_ELEC_ORDER: 'int32',
+                     SET_RESIDENTIAL_TIER + 'Custom': 'float64', SET_RESIDENTIAL_TIER + '1': 'float64',
+                     SET_RESIDENTIAL_TIER + '2': 'float64', SET_RESIDENTIAL_TIER + '3': 'float64',
+                     SET_RESIDENTIAL_TIER + '4': 'float64', SET_RESIDENTIAL_TIER + '5': 'float64',
+                     # Added by the calibration and the scenarios
+                     SET_GRID_PENALTY: 'float64', SET_WINDCF: 'float64', SET_POP_CALIB: 'float64',
+                     SET_ELEC_POP_CALIB: 'float64', SET_ELEC_CURRENT: 'int8', SET_CALIB_GRID_DIST: 'float64',
+                     SET_TIER: 'int8'}
+
+# Compact types of the columns that are added once per year, by the name without the year
+SETTLEMENT_YEAR_DTYPES = {SET_ELEC_FINAL_CODE: 'int8', SET_LIMIT: 'int8', SET_MIN_OFFGRID_CODE: 'int8',
+                          SET_MIN_OVERALL_CODE: 'int8', SET_ELEC_ORDER: 'int32', SET_MIN_OFFGRID: 'category',
+                          SET_MIN_OVERALL: 'category'}
+
+# Yearly columns that the next year reads as well, by the name without the year. All other yearly columns are only
+# read in their own year (see SettlementProcessor.retire_year_columns).
+SETTLEMENT_YEAR_CARRIED = (SET_POP, SET_ELEC_FINAL_CODE, SET_LIMIT, SET_ELEC_ORDER)
+
+# Types of the settlement columns in the results files. Measurements, distances, costs per kWh and demands are written
+# as float32; population, energy and investment totals keep float64, since float32 would round them off. Integer and
+# categorical columns keep their SETTLEMENT_DTYPES types.
+RESULT_DTYPES = {SET_X_DEG: 'float32', SET_Y_DEG: 'float32', SET_POP: 'float64', SET_GRID_CELL_AREA: 'float32',
+                 SET_ELEC_POP: 'float64', SET_WINDVEL: 'float32', SET_GHI: 'float32', SET_TRAVEL_HOURS: 'float32',
+                 SET_ELEVATION: 'float32', SET_SLOPE: 'float32', SET_NIGHT_LIGHTS: 'float32',
+                 SET_SUBSTATION_DIST: 'float32', SET_DIST_TO_TRANS: 'float32', SET_HV_DIST_CURRENT: 'float32',
+                 SET_HV_DIST_PLANNED: 'float32', SET_MV_DIST_CURRENT: 'float32', SET_MV_DIST_PLANNED: 'float32',
+                 SET_ROAD_DIST: 'float32', SET_HYDRO_DIST: 'float32', SET_HYDRO: 'float32',
+                 SET_CAPITA_DEMAND: 'float32', SET_HEALTH_DEMAND: 'float32', SET_EDU_DEMAND: 'float32',
+                 SET_AGRI_DEMAND: 'float32', SET_COMMERCIAL_DEMAND: 'float32',
+                 SET_RESIDENTIAL_TIER + 'Custom': 'float32', SET_RESIDENTIAL_TIER + '1': 'float32',
+                 SET_RESIDENTIAL_TIER + '2': 'float32', SET_RESIDENTIAL_TIER + '3': 'float32',
+                 SET_RESIDENTIAL_TIER + '4': 'float32', SET_RESIDENTIAL_TIER + '5': 'float32',
+                 SET_GRID_PENALTY: 'float32', SET_WINDCF: 'float32', SET_POP_CALIB: 'float64',
+                 SET_ELEC_POP_CALIB: 'float64', SET_CALIB_GRID_DIST: 'float32', SET_MV_CONNECT_DIST: 'float32',
+                 SET_MIN_TD_DIST: 'float32', SET_NUM_PEOPLE_PER_HH: 'float32', SET_TOTAL_ENERGY_PER_CELL: 'float64'}
+
+# Types of the yearly columns in the results files, by the name without the year
+RESULT_YEAR_DTYPES = {SET_POP: 'float64', SET_NEW_CONNECTIONS: 'float64', SET_ENERGY_PER_CELL: 'float64',
+                      SET_INVESTMENT_COST: 'float64', SET_SA_DIESEL_FUEL: 'float32', SET_MG_DIESEL_FUEL: 'float32',
+                      SET_LCOE_GRID: 'float32', SET_LCOE_SA_PV: 'float32', SET_LCOE_SA_DIESEL: 'float32',
+                      SET_LCOE_MG_WIND: 'float32', SET_LCOE_MG_DIESEL: 'float32', SET_LCOE_MG_PV: 'float32',
+                      SET_LCOE_MG_HYDRO: 'float32', SET_MIN_OFFGRID_LCOE: 'float32', SET_MIN_OVERALL_LCOE: 'float32',
+                      SET_BREAK_EVEN_GRID_DIST: 'float32', SET_MIN_GRID_DIST: 'float32', SET_NEW_CAPACITY: 'float32',
+                      SET_INVEST_PER_CAPITA: 'float32'}
+
 
 class Technology:
     """
@@ -212,7 +281,8 @@ class Technology:
 
         Returns
         -------
-        lcoe or discounted investment cost
+        tuple of numpy.ndarray
+            The LCOE, discounted investment cost and installed capacity of each settlement
         """
 
         if type(people) == int or type(people) == float or type(people) == np.float64:
@@ -229,8 +299,6 @@ class Technology:
         else:
             energy_per_cell = np.maximum(energy_per_cell, 0.000000000001)
 
-        grid_penalty_ratio = np.maximum(1, grid_penalty_ratio)
-
         generation_per_year, peak_load, td_investment_cost = self.td_network_cost(people,
                                                                                   new_connections,
                                                                                   prev_code,
@@ -243,32 +311,33 @@ class Technology:
                                                                                   productive_nodes,
                                                                                   elec_loop,
                                                                                   penalty)
-        generation_per_year = pd.Series(generation_per_year)
-        peak_load = pd.Series(peak_load)
-        td_investment_cost = pd.Series(td_investment_cost)
 
-        td_investment_cost = td_investment_cost * grid_penalty_ratio
-        td_om_cost = td_investment_cost * self.om_of_td_lines * penalty
-        installed_capacity = peak_load / capacity_factor
+        return self.discounted_lcoe(generation_per_year, peak_load, td_investment_cost, people, num_people_per_hh,
+                                    start_year, end_year, capacity_factor, grid_penalty_ratio, fuel_cost, penalty)
 
-        cap_cost = td_investment_cost * 0
-        cost_dict_list = self.capital_cost.keys()
-        cost_dict_list = sorted(cost_dict_list)
-        for key in cost_dict_list:
-            if self.standalone:
-                cap_cost.loc[((installed_capacity / (people / num_people_per_hh)) < key) & (cap_cost == 0)] = \
-                    self.capital_cost[key]
-            else:
-                cap_cost.loc[(installed_capacity < key) & (cap_cost == 0)] = self.capital_cost[key]
+    def discount_factors(self, start_year, end_year):
+        """Calculates the scalar discount sums used to turn annual values into present values
 
-        capital_investment = installed_capacity * cap_cost * penalty
-        total_om_cost = td_om_cost + (cap_cost * penalty * self.om_costs * installed_capacity)
-        total_investment_cost = td_investment_cost + capital_investment
+        The yearly cash flows of the LCOE calculation are all proportional to a small number of per-settlement
+        quantities (generation, investment, O&M, fuel), so the discounting over the project life can be
+        collapsed into one factor per cash flow type.
 
-        if self.grid_price > 0:
-            fuel_cost = self.grid_price
+        Arguments
+        ---------
+        start_year : int
+            Year from which the settlement is supplied by the technology
+        end_year : int
+            Last year of the analysis
 
-        # Perform the time-value LCOE calculation
+        Returns
+        -------
+        annuity_factor : float
+            Sum of the discount factors over the operating years, applied to generation, O&M and fuel
+        investment_factor : float
+            Discount factor of the initial investment plus that of the reinvestment year, if any
+        salvage_factor : float
+            Discounted share of the investment that is recovered as salvage value at the end of the project
+        """
         project_life = end_year - self.base_year + 1
         reinvest_year = 0
         step = start_year - self.base_year
@@ -276,58 +345,151 @@ class Technology:
         if self.tech_life + step < project_life:
             reinvest_year = self.tech_life + step
 
-        year = np.arange(project_life)
-        el_gen = np.outer(np.asarray(generation_per_year), np.ones(project_life))
-        for s in range(step):
-            el_gen[:, s] = 0
-        discount_factor = (1 + self.discount_rate) ** year
-        investments = np.zeros(project_life)
-        investments[step] = 1
-        # Calculate the year of re-investment if tech_life is smaller than project life
-        if reinvest_year:
-            investments[reinvest_year] = 1
-        investments = np.outer(total_investment_cost, investments)
+        discount_factor = (1 + self.discount_rate) ** np.arange(project_life)
 
-        grid_capacity_investments = np.zeros(project_life)
-        grid_capacity_investments[step] = 1
-        # Calculate the year of re-investment if tech_life is smaller than project life
+        annuity_factor = np.sum(1 / discount_factor[step:])
+
+        investment_factor = 1 / discount_factor[step]
         if reinvest_year:
-            grid_capacity_investments[reinvest_year] = 1
-        grid_capacity_investments = np.outer(peak_load * self.grid_capacity_investment, grid_capacity_investments)
+            investment_factor += 1 / discount_factor[reinvest_year]
 
         # Calculate salvage value if tech_life is bigger than project life
-        salvage = np.zeros(project_life)
         if reinvest_year > 0:
             used_life = (project_life - step) - self.tech_life
         else:
             used_life = project_life - step - 1
-        salvage[-1] = 1
-        salvage = np.outer(total_investment_cost * (1 - used_life / self.tech_life), salvage)
-
-        operation_and_maintenance = np.ones(project_life)
-        for s in range(step):
-            operation_and_maintenance[s] = 0
-        operation_and_maintenance = np.outer(total_om_cost, operation_and_maintenance)
-        fuel = np.outer(np.asarray(generation_per_year), np.zeros(project_life))
-        for p in range(project_life):
-            fuel[:, p] = el_gen[:, p] * fuel_cost
-
-        discounted_investments = investments / discount_factor
-        dicounted_grid_capacity_investments = grid_capacity_investments / discount_factor
-        investment_cost = np.sum(discounted_investments, axis=1) + np.sum(dicounted_grid_capacity_investments, axis=1)
-        discounted_costs = (investments + operation_and_maintenance + fuel - salvage) / discount_factor
-        discounted_generation = el_gen / discount_factor
-        lcoe = np.sum(discounted_costs, axis=1) / np.sum(discounted_generation, axis=1)
-        #lcoe = pd.DataFrame(lcoe[:, np.newaxis])
-        #investment_cost = pd.DataFrame(investment_cost[:, np.newaxis])
-        #installed_capacity = pd.DataFrame(installed_capacity[:, np.newaxis])
-
-        lcoe = pd.DataFrame(lcoe)
-        investment_cost = pd.DataFrame(investment_cost)
-        installed_capacity = pd.DataFrame(installed_capacity)
+        salvage_factor = (1 - used_life / self.tech_life) / discount_factor[-1]
+
+        return annuity_factor, investment_factor, salvage_factor
+
+    def discounted_lcoe(self, generation_per_year, peak_load, td_investment_cost, people, num_people_per_hh,
+                        start_year, end_year, capacity_factor=0.9, grid_penalty_ratio=1, fuel_cost=0, penalty=1):
+        """Calculates the LCOE, discounted investment and installed capacity from the network components
+
+        The time-value calculation uses the scalar factors of ``discount_factors``, so memory use is linear
+        in the number of settlements regardless of the length of the project life.
+
+        Arguments
+        ---------
+        generation_per_year : numpy.ndarray
+            Annual electricity generation (kWh)
+        peak_load : numpy.ndarray
+            Peak load (kW)
+        td_investment_cost : numpy.ndarray
+            Investment cost of the transmission and distribution network (USD)
+        people : float or pandas.Series
+        num_people_per_hh : float or pandas.Series
+        start_year : int
+        end_year : int
+        capacity_factor : float or pandas.Series
+        grid_penalty_ratio : float or pandas.Series
+        fuel_cost : float or pandas.Series
+        penalty : float or pandas.Series
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            The LCOE, discounted investment cost and installed capacity of each settlement
+        """
+        generation_per_year = np.atleast_1d(np.asarray(generation_per_year, dtype=float))
+        peak_load = np.atleast_1d(np.asarray(peak_load, dtype=float))
+        td_investment_cost = np.atleast_1d(np.asarray(td_investment_cost, dtype=float))
+
+        installed_capacity, capital_investment, capital_om_cost = self.capacity_costs(peak_load, people,
+                                                                                      num_people_per_hh,
+                                                                                      capacity_factor, penalty)
+
+        if self.grid_price > 0:
+            fuel_cost = self.grid_price
+
+        lcoe, investment_cost = self.lcoe_from_costs(generation_per_year, peak_load, td_investment_cost,
+                                                     capital_investment, capital_om_cost,
+                                                     self.discount_factors(start_year, end_year),
+                                                     grid_penalty_ratio, fuel_cost, penalty)
 
         return lcoe, investment_cost, installed_capacity
 
+    def capacity_costs(self, peak_load, people, num_people_per_hh, capacity_factor=0.9, penalty=1):
+        """Sizes the generation capacity and calculates its investment and annual O&M cost
+
+        Arguments
+        ---------
+        peak_load : numpy.ndarray
+            Peak load (kW)
+        people : float or pandas.Series
+        num_people_per_hh : float or pandas.Series
+        capacity_factor : float or pandas.Series
+        penalty : float or pandas.Series
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            The installed capacity, capital investment and annual O&M cost of the generation capacity
+        """
+        people = np.asarray(people, dtype=float)
+        num_people_per_hh = np.asarray(num_people_per_hh, dtype=float)
+        capacity_factor = np.asarray(capacity_factor, dtype=float)
+        penalty = np.asarray(penalty, dtype=float)
+
+        installed_capacity = peak_load / capacity_factor
+
+        if self.standalone:
+            capacity_per_household = installed_capacity / (people / num_people_per_hh)
+        else:
+            capacity_per_household = installed_capacity
+
+        cap_cost = np.zeros(len(peak_load))
+        for key in sorted(self.capital_cost.keys()):
+            cap_cost = np.where((capacity_per_household < key) & (cap_cost == 0), self.capital_cost[key], cap_cost)
+
+        capital_investment = installed_capacity * cap_cost * penalty
+        capital_om_cost = cap_cost * penalty * self.om_costs * installed_capacity
+
+        return installed_capacity, capital_investment, capital_om_cost
+
+    def lcoe_from_costs(self, generation_per_year, peak_load, td_investment_cost, capital_investment,
+                        capital_om_cost, discount_factors, grid_penalty_ratio=1, fuel_cost=0, penalty=1):
+        """Calculates the LCOE and discounted investment from the annual costs of each settlement
+
+        Arguments
+        ---------
+        generation_per_year : numpy.ndarray
+        peak_load : numpy.ndarray
+        td_investment_cost : numpy.ndarray
+            Investment cost of the transmission and distribution network, before the grid penalty (USD)
+        capital_investment : numpy.ndarray
+            Investment cost of the generation capacity (USD)
+        capital_om_cost : numpy.ndarray
+            Annual O&M cost of the generation capacity (USD)
+        discount_factors : tuple
+            As returned by ``discount_factors``
+        grid_penalty_ratio : float or pandas.Series
+        fuel_cost : float or pandas.Series
+        penalty : float or pandas.Series
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            The LCOE and discounted investment cost of each settlement
+        """
+        grid_penalty_ratio = np.maximum(1, np.asarray(grid_penalty_ratio, dtype=float))
+        fuel_cost = np.asarray(fuel_cost, dtype=float)
+        penalty = np.asarray(penalty, dtype=float)
+        annuity_factor, investment_factor, salvage_factor = discount_factors
+
+        td_investment_cost = td_investment_cost * grid_penalty_ratio
+        td_om_cost = td_investment_cost * self.om_of_td_lines * penalty
+        total_om_cost = td_om_cost + capital_om_cost
+        total_investment_cost = td_investment_cost + capital_investment
+
+        investment_cost = (total_investment_cost + peak_load * self.grid_capacity_investment) * investment_factor
+        discounted_costs = total_investment_cost * (investment_factor - salvage_factor) + \
+            (total_om_cost + generation_per_year * fuel_cost) * annuity_factor
+        discounted_generation = generation_per_year * annuity_factor
+        lcoe = discounted_costs / discounted_generation
+
+        return lcoe, investment_cost
+
     def transmission_network(self, peak_load, additional_mv_line_length=0, additional_transformer=0,
                              mv_distribution=False):
         """This method calculates the required components for connecting the settlement
@@ -498,6 +660,51 @@ class Technology:
             Cost penalty factor for T&D network, e.g. https://www.mdpi.com/2071-1050/12/3/777
         """
 
+        components = self.td_network_components(people, new_connections, prev_code, total_energy_per_cell,
+                                                energy_per_cell, num_people_per_hh, grid_cell_area, productive_nodes)
+
+        td_investment_cost = self.td_investment_cost(components, additional_mv_line_length, additional_transformer,
+                                                     elec_loop, penalty)
+
+        return components['generation_per_year'], components['peak_load'], td_investment_cost
+
+    def td_network_components(self, people, new_connections, prev_code, total_energy_per_cell, energy_per_cell,
+                              num_people_per_hh, grid_cell_area, productive_nodes=0):
+        """Calculates the parts of the transmission and distribution network that do not depend on the
+        connection distance
+
+        Parameters
+        ----------
+        people : float
+            Number of people in settlement
+        new_connections : float
+            Number of new people in settlement to connect
+        prev_code : int
+            Code representation of previous supply technology in settlement
+        total_energy_per_cell : float
+            Total annual energy demand in cell, including already met demand
+        energy_per_cell : float
+            Annual energy demand in cell, excluding already met demand
+        num_people_per_hh : float
+            Number of people per household in settlement
+        grid_cell_area : float
+            Area of settlement (km2)
+        productive_nodes : int
+            Additional connections (schools, health facilities, shops)
+
+        Returns
+        -------
+        dict
+            The distribution network cost, generation and peak loads, used by ``td_investment_cost``
+        """
+        people = np.asarray(people)
+        new_connections = np.asarray(new_connections)
+        prev_code = np.asarray(prev_code)
+        total_energy_per_cell = np.asarray(total_energy_per_cell)
+        energy_per_cell = np.asarray(energy_per_cell)
+        num_people_per_hh = np.asarray(num_people_per_hh)
+        grid_cell_area = np.asarray(grid_cell_area)
+
         # Start by calculating the distribution network required to meet all of the demand
         cluster_mv_lines_length_total, cluster_lv_lines_length_total, no_of_service_transf_total, \
         generation_per_year_total, peak_load_total, total_nodes_total = \
@@ -521,19 +728,70 @@ class Technology:
         peak_load_additional = np.maximum(peak_load_total - peak_load_existing, 0)
         total_nodes_additional = np.maximum(total_nodes_total - total_nodes_existing, 0)
 
-        # Examine if there are any MV lines in the distribution network, used to determine transformer type
-        mv_distribution = np.where(mv_lines_distribution_length_additional > 0, True, False)
+        # If no distribution network is present, perform the calculations only once
+        mv_lines_distribution_length_new, total_lv_lines_length_new, num_transformers_new, generation_per_year_new, \
+        peak_load_new, total_nodes_new = self.distribution_network(people, energy_per_cell, num_people_per_hh,
+                                                                   grid_cell_area, productive_nodes)
+
+        # Settlements that are partly supplied already only need the additional network, the rest a new one
+        densification = (people != new_connections) & ((prev_code < 2) | (prev_code > 3))
+        grid_densification = (people != new_connections) & (prev_code < 2)
 
-        # Then calculate the transmission network (HV or MV lines plus transformers) using the same methodology
+        mv_lines_distribution_length = np.where(densification,
+                                                mv_lines_distribution_length_additional,
+                                                mv_lines_distribution_length_new)
+        total_lv_lines_length = np.where(densification, total_lv_lines_length_additional, total_lv_lines_length_new)
+        num_transformers = np.where(densification, num_transformers_additional, num_transformers_new)
+        total_nodes = np.where(densification, total_nodes_additional, total_nodes_new)
+        generation_per_year = np.where(densification, generation_per_year_additional, generation_per_year_new)
+        peak_load = np.where(densification, peak_load_additional, peak_load_new)
+
+        distribution_cost = (total_lv_lines_length * self.lv_line_cost +
+                             mv_lines_distribution_length * self.mv_line_cost +
+                             num_transformers * self.service_transf_cost +
+                             total_nodes * self.connection_cost_per_hh)
+
+        # The MV lines in the distribution network are used to determine the transformer type
+        return {'peak_load_total': peak_load_total,
+                'peak_load_existing': peak_load_existing,
+                'peak_load_new': peak_load_new,
+                'mv_distribution': mv_lines_distribution_length_additional > 0,
+                'mv_distribution_new': mv_lines_distribution_length_new > 0,
+                'densification': densification,
+                'grid_densification': grid_densification,
+                'distribution_cost': distribution_cost,
+                'generation_per_year': generation_per_year,
+                'peak_load': peak_load}
+
+    def td_investment_cost(self, components, additional_mv_line_length=0, additional_transformer=0, elec_loop=0,
+                           penalty=1):
+        """Calculates the investment in the transmission and distribution network for a connection distance
+
+        Parameters
+        ----------
+        components : dict
+            As returned by ``td_network_components``
+        additional_mv_line_length : float
+            Distance to connect the settlement
+        additional_transformer : int
+            If a transformer is needed on other end to connect to HV line
+        elec_loop : int
+            Round of extension in grid extension algorithm
+        penalty : float
+            Cost penalty factor for T&D network, e.g. https://www.mdpi.com/2071-1050/12/3/777
+        """
+        mv_distribution = components['mv_distribution']
+
+        # Calculate the transmission network (HV or MV lines plus transformers) using the same methodology
         hv_lines_total_length_total, mv_lines_connection_length_total, no_of_hv_mv_substation_total, \
         no_of_mv_mv_substation_total, no_of_hv_lv_substation_total, no_of_mv_lv_substation_total = \
-            self.transmission_network(peak_load_total, additional_mv_line_length, additional_transformer,
-                                      mv_distribution=mv_distribution)
+            self.transmission_network(components['peak_load_total'], additional_mv_line_length,
+                                      additional_transformer, mv_distribution=mv_distribution)
 
         hv_lines_total_length_existing, mv_lines_connection_length_existing, no_of_hv_mv_substation_existing, \
         no_of_mv_mv_substation_existing, no_of_hv_lv_substation_existing, no_of_mv_lv_substation_existing = \
-            self.transmission_network(peak_load_existing, additional_mv_line_length, additional_transformer,
-                                      mv_distribution=mv_distribution)
+            self.transmission_network(components['peak_load_existing'], additional_mv_line_length,
+                                      additional_transformer, mv_distribution=mv_distribution)
 
         hv_lines_total_length_additional = np.maximum(hv_lines_total_length_total - hv_lines_total_length_existing, 0)
         mv_lines_connection_length_additional = \
@@ -547,103 +805,735 @@ class Technology:
         no_of_mv_lv_substation_additional = \
             np.maximum(no_of_mv_lv_substation_total - no_of_mv_lv_substation_existing, 0)
 
-        # If no distribution network is present, perform the calculations only once
-        mv_lines_distribution_length_new, total_lv_lines_length_new, num_transformers_new, generation_per_year_new, \
-        peak_load_new, total_nodes_new = self.distribution_network(people, energy_per_cell, num_people_per_hh,
-                                                                   grid_cell_area, productive_nodes)
-
-        mv_distribution = np.where(mv_lines_distribution_length_new > 0, True, False)
-
         hv_lines_total_length_new, mv_lines_connection_length_new, no_of_hv_mv_substation_new, \
         no_of_mv_mv_substation_new, no_of_hv_lv_substation_new, no_of_mv_lv_substation_new = \
-            self.transmission_network(peak_load_new, additional_mv_line_length, additional_transformer,
-                                      mv_distribution=mv_distribution)
+            self.transmission_network(components['peak_load_new'], additional_mv_line_length, additional_transformer,
+                                      mv_distribution=components['mv_distribution_new'])
 
-        mv_lines_distribution_length = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                                mv_lines_distribution_length_additional,
-                                                mv_lines_distribution_length_new)
+        densification = components['densification']
+        grid_densification = components['grid_densification']
 
-        hv_lines_total_length = np.where((people != new_connections) & (prev_code < 2),
+        hv_lines_total_length = np.where(grid_densification,
                                          hv_lines_total_length_additional,
                                          hv_lines_total_length_new)
 
-        mv_lines_connection_length = np.where((people != new_connections) & (prev_code < 2),
+        mv_lines_connection_length = np.where(grid_densification,
                                               mv_lines_connection_length_additional,
                                               mv_lines_connection_length_new)
 
-        total_lv_lines_length = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                         total_lv_lines_length_additional,
-                                         total_lv_lines_length_new)
+        no_of_hv_lv_substation = np.where(densification,
+                                          no_of_hv_lv_substation_additional,
+                                          no_of_hv_lv_substation_new)
+
+        no_of_hv_mv_substation = np.where(densification,
+                                          no_of_hv_mv_substation_additional,
+                                          no_of_hv_mv_substation_new)
+
+        no_of_mv_mv_substation = np.where(densification,
+                                          no_of_mv_mv_substation_additional,
+                                          no_of_mv_mv_substation_new)
+
+        no_of_mv_lv_substation = np.where(densification,
+                                          no_of_mv_lv_substation_additional,
+                                          no_of_mv_lv_substation_new)
+
+        td_investment_cost = (hv_lines_total_length * self.hv_line_cost * (
+                1 + self.existing_grid_cost_ratio * elec_loop) +
+                              mv_lines_connection_length * self.mv_line_cost * (
+                                      1 + self.existing_grid_cost_ratio * elec_loop) +
+                              components['distribution_cost'] +
+                              no_of_hv_lv_substation * self.hv_lv_sub_station_cost +
+                              no_of_hv_mv_substation * self.hv_mv_sub_station_cost +
+                              no_of_mv_mv_substation * self.mv_mv_sub_station_cost +
+                              no_of_mv_lv_substation * self.mv_lv_sub_station_cost) * penalty
 
-        num_transformers = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                    num_transformers_additional,
-                                    num_transformers_new)
+        return td_investment_cost
 
-        total_nodes = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                               total_nodes_additional,
-                               total_nodes_new)
 
-        no_of_hv_lv_substation = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                          no_of_hv_lv_substation_additional,
-                                          no_of_hv_lv_substation_new)
+class GridLcoeEvaluator:
+    """
+    Evaluates the grid LCOE of all settlements in a time step for changing connection distances.
+
+    Only the length of the new MV/HV connection, the extension round and the need for an additional transformer
+    change between the rounds of the grid extension algorithm. The distribution network, peak loads, generation,
+    connection nodes and generation capacity cost are therefore calculated once, when the evaluator is created,
+    and ``evaluate`` only adds the transmission network for each new set of distances.
+    """
+
+    def __init__(self, technology, energy_per_cell, people, num_people_per_hh, start_year, end_year,
+                 new_connections, total_energy_per_cell, prev_code, grid_cell_area, capacity_factor=0.9,
+                 grid_penalty_ratio=1, fuel_cost=0, productive_nodes=0, penalty=1):
+        """The arguments are the same as those of ``Technology.get_lcoe``, excluding the connection distance,
+        extension round and additional transformer
+        """
+        people = np.maximum(np.asarray(people, dtype=float), 0.00001)
+        energy_per_cell = np.maximum(np.asarray(energy_per_cell, dtype=float), 0.000000000001)
+
+        self.technology = technology
+        self.penalty = penalty
+        self.grid_penalty_ratio = grid_penalty_ratio
+        self.components = technology.td_network_components(people, new_connections, prev_code,
+                                                           total_energy_per_cell, energy_per_cell,
+                                                           num_people_per_hh, grid_cell_area, productive_nodes)
+        self.generation_per_year = np.atleast_1d(self.components['generation_per_year'])
+        self.peak_load = np.atleast_1d(self.components['peak_load'])
+        self.installed_capacity, self.capital_investment, self.capital_om_cost = \
+            technology.capacity_costs(self.peak_load, people, num_people_per_hh, capacity_factor, penalty)
+        self.fuel_cost = technology.grid_price if technology.grid_price > 0 else fuel_cost
+        self.discount_factors = technology.discount_factors(start_year, end_year)
+
+    def evaluate(self, additional_mv_line_length=0.0, elec_loop=0, additional_transformer=0, index=None):
+        """Calculates the LCOE for the given connection distances
+
+        Arguments
+        ---------
+        additional_mv_line_length : float or numpy.ndarray
+            Distance to connect the settlement
+        elec_loop : int or numpy.ndarray
+            Round of extension in grid extension algorithm
+        additional_transformer : int
+            If a transformer is needed on other end to connect to HV line
+        index : numpy.ndarray, optional
+            Positions of the settlements to evaluate. If given, the distances and extension rounds refer to these
+            settlements only, and so do the results.
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            The LCOE, discounted investment cost and installed capacity of each settlement
+        """
+        components = self.components
+        generation_per_year = self.generation_per_year
+        peak_load = self.peak_load
+        capital_investment = self.capital_investment
+        capital_om_cost = self.capital_om_cost
+        installed_capacity = self.installed_capacity
+        grid_penalty_ratio = self._take(self.grid_penalty_ratio, index)
+        fuel_cost = self._take(self.fuel_cost, index)
+        penalty = self._take(self.penalty, index)
+
+        if index is not None:
+            components = {key: self._take(value, index) for key, value in components.items()}
+            generation_per_year = generation_per_year[index]
+            peak_load = peak_load[index]
+            capital_investment = capital_investment[index]
+            capital_om_cost = capital_om_cost[index]
+            installed_capacity = installed_capacity[index]
+
+        td_investment_cost = self.technology.td_investment_cost(components, additional_mv_line_length,
+                                                                additional_transformer, elec_loop, penalty)
+        lcoe, investment_cost = self.technology.lcoe_from_costs(generation_per_year, peak_load, td_investment_cost,
+                                                                capital_investment, capital_om_cost,
+                                                                self.discount_factors, grid_penalty_ratio, fuel_cost,
+                                                                penalty)
+        return lcoe, investment_cost, installed_capacity
+
+    def break_even_distance(self, max_lcoe, index=None, mv_to_hv_distance=50):
+        """Calculates the longest connection distance at which the grid LCOE is below max_lcoe
+
+        The transmission network cost is linear in the connection distance on either side of the switch from MV to
+        HV lines, so the LCOE of a connection in the first extension round is linear on both sides as well and the
+        break-even distance follows from evaluating it at two distances on each side. Later extension rounds and
+        additional transformers only make the grid more costly, so no settlement further away than its break-even
+        distance can be connected.
+
+        Arguments
+        ---------
+        max_lcoe : float or numpy.ndarray
+            LCOE the grid has to beat, e.g. that of the least-cost off-grid technology
+        index : numpy.ndarray, optional
+            Positions of the settlements to evaluate. If given, max_lcoe refers to these settlements only.
+        mv_to_hv_distance : float
+            Connection distance from which HV lines are used (km), as in ``Technology.transmission_network``
+
+        Returns
+        -------
+        numpy.ndarray
+            The break-even distance (km). Zero where the grid is not less costly than max_lcoe at any distance
+        """
+        max_lcoe = np.asarray(max_lcoe, dtype=float)
+        break_even = np.zeros(np.shape(self.evaluate(0, index=index)[0]))
+
+        for start, end in [(0, mv_to_hv_distance), (mv_to_hv_distance, np.inf)]:
+            # Any two distances within the segment define the LCOE line, excluding zero where no line is built
+            near = max(start, 1)
+            far = near + 1
+            lcoe_near = self.evaluate(near, index=index)[0]
+            lcoe_far = self.evaluate(far, index=index)[0]
+            slope = (lcoe_far - lcoe_near) / (far - near)
+            at_start = lcoe_near - slope * (near - start)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                root = np.where(slope > 0, start + (max_lcoe - at_start) / slope,
+                                np.where(at_start < max_lcoe, np.inf, -np.inf))
+            root = np.minimum(root, end)
+            break_even = np.where(root > start, np.maximum(break_even, root), break_even)
+
+        return break_even
+
+    @staticmethod
+    def _take(value, index):
+        """Selects the settlements in index, if value is given per settlement"""
+        value = np.asarray(value)
+        if index is None or value.ndim == 0:
+            return value
+        return value[index]
+
+
+class ExtensionNodeIndex:
+    """
+    Spatial index over the coordinates of all settlements, used to find the closest node the grid is extended from.
+
+    The tree is built once per time step. Between the rounds of the grid extension algorithm only the set of
+    active nodes changes, and the nearest active node of each settlement is found among its nearest neighbours
+    in the tree. Settlements without an active node among their ``max_neighbours`` nearest neighbours are matched
+    using a tree over the active nodes only.
+    """
+
+    def __init__(self, x, y, neighbours=8, max_neighbours=256):
+        """
+        Arguments
+        ---------
+        x : numpy.ndarray
+            Longitude of the settlements
+        y : numpy.ndarray
+            Latitude of the settlements
+        neighbours : int
+            Number of nearest neighbours queried first
+        max_neighbours : int
+            Largest number of nearest neighbours queried, before falling back to a tree over the active nodes
+        """
+        self.coordinates = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+        self.tree = scipy.spatial.cKDTree(self.coordinates)
+        self.neighbours = neighbours
+        self.max_neighbours = max_neighbours
+        self.active = np.zeros(len(self.coordinates), dtype=bool)
+        self.active_nodes = np.array([], dtype=int)
+
+    def activate(self, nodes):
+        """Sets the nodes the grid is extended from, replacing the previously active nodes"""
+        self.active[self.active_nodes] = False
+        self.active_nodes = np.asarray(nodes, dtype=int)
+        self.active[self.active_nodes] = True
+
+    def nearest(self, positions):
+        """Finds the closest active node of each settlement in positions
+
+        Arguments
+        ---------
+        positions : numpy.ndarray
+            Positions of the settlements
+
+        Returns
+        -------
+        numpy.ndarray
+            Position of the closest active node of each settlement
+        """
+        positions = np.asarray(positions, dtype=int)
+        points = self.coordinates[positions]
+        nearest = np.zeros(len(positions), dtype=int)
+        unresolved = np.arange(len(positions))
+        n = len(self.coordinates)
+        k = min(self.neighbours, n)
+
+        while len(unresolved) > 0 and k <= min(self.max_neighbours, n):
+            _, neighbours = self.tree.query(points[unresolved], k=k, workers=-1)
+            neighbours = neighbours.reshape(len(unresolved), -1)
+            found = self.active[neighbours]
+            hit = found.any(axis=1)
+            nearest[unresolved[hit]] = neighbours[hit, found[hit].argmax(axis=1)]
+            unresolved = unresolved[~hit]
+            if k == n:
+                break
+            k = min(k * 4, n)
+
+        if len(unresolved) > 0:
+            active_tree = scipy.spatial.cKDTree(self.coordinates[self.active_nodes])
+            _, closest = active_tree.query(points[unresolved], workers=-1)
+            nearest[unresolved] = self.active_nodes[closest]
+
+        return nearest
+
+    def neighbour_graph(self, k=8):
+        """Finds the k nearest neighbours of all settlements
+
+        Arguments
+        ---------
+        k : int
+            Number of nearest neighbours of each settlement
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            The neighbours of settlement i are indices[indptr[i]:indptr[i + 1]]. The graph is symmetric, so a
+            settlement is also a neighbour of the settlements that are among its own k nearest neighbours
+        """
+        n = len(self.coordinates)
+        _, neighbours = self.tree.query(self.coordinates, k=min(k + 1, n), workers=-1)
+        neighbours = neighbours.reshape(n, -1)
+        rows = np.repeat(np.arange(n), neighbours.shape[1])
+        cols = neighbours.ravel()
+        keep = rows != cols
+        graph = scipy.sparse.csr_matrix((np.ones(keep.sum()), (rows[keep], cols[keep])), shape=(n, n))
+        graph = (graph + graph.T).tocsr()
+        graph.sort_indices()
+        return graph.indptr, graph.indices
+
+
+class SettlementGraph:
+    """
+    Sparse k-nearest-neighbour graph of the settlements, used by the grid extension algorithms.
+
+    The coordinates and grid penalties of the settlements do not change after calibration, so the graph is built
+    once per calibrated file and stored next to it as ``.npy`` files in CSR form: the neighbours of settlement i are
+    ``indices[indptr[i]:indptr[i + 1]]``, with the haversine length of each edge in ``distance`` and the length
+    multiplied by the grid penalty of the neighbour in ``distance_adjusted``.
+    """
+
+    arrays = ('indptr', 'indices', 'distance', 'distance_adjusted')
+
+    def __init__(self, indptr, indices, distance, distance_adjusted, neighbours=8):
+        self.indptr = indptr
+        self.indices = indices
+        self.distance = distance
+        self.distance_adjusted = distance_adjusted
+        self.neighbours = neighbours
+
+    @classmethod
+    def build(cls, x, y, grid_penalty_ratio, neighbours=8):
+        """Builds the graph of the k nearest neighbours of each settlement
+
+        Arguments
+        ---------
+        x : numpy.ndarray
+            Longitude of the settlements
+        y : numpy.ndarray
+            Latitude of the settlements
+        grid_penalty_ratio : numpy.ndarray
+        neighbours : int
+            Number of nearest neighbours of each settlement. The graph is made symmetric, so settlements can have
+            more neighbours than this
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        indptr, indices = ExtensionNodeIndex(x, y).neighbour_graph(neighbours)
+        sources = np.repeat(np.arange(len(x)), np.diff(indptr))
+        distance = SettlementProcessor.haversine_vector(x[sources], y[sources], x[indices], y[indices])
+        distance_adjusted = np.nan_to_num(distance * np.asarray(grid_penalty_ratio, dtype=float)[indices])
+        return cls(indptr, indices, distance, distance_adjusted, neighbours)
+
+    @staticmethod
+    def folder(csv_path):
+        """The folder where the graph of the settlements in csv_path is stored"""
+        return os.path.splitext(csv_path)[0] + '_graph'
+
+    def save(self, folder, source=None):
+        """Saves the graph in folder, recording the size and modification time of the source file if given"""
+        os.makedirs(folder, exist_ok=True)
+        for name in self.arrays:
+            np.save(os.path.join(folder, name + '.npy'), getattr(self, name))
+        metadata = {'neighbours': self.neighbours, 'settlements': len(self.indptr) - 1}
+        if source is not None:
+            metadata['source_size'] = os.path.getsize(source)
+            metadata['source_mtime'] = os.path.getmtime(source)
+        with open(os.path.join(folder, 'metadata.json'), 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        """Loads a saved graph, memory-mapping the arrays unless mmap_mode is None"""
+        with open(os.path.join(folder, 'metadata.json')) as metadata_file:
+            metadata = json.load(metadata_file)
+        arrays = [np.load(os.path.join(folder, name + '.npy'), mmap_mode=mmap_mode) for name in cls.arrays]
+        return cls(*arrays, neighbours=metadata['neighbours'])
+
+    @classmethod
+    def cached(cls, csv_path, df, neighbours=8, mmap_mode='r'):
+        """Loads the graph stored next to csv_path, or builds and stores it if it is missing or out of date
+
+        Arguments
+        ---------
+        csv_path : str
+            Path of the calibrated settlements file the graph belongs to
+        df : pandas.DataFrame
+            The settlements in csv_path
+        neighbours : int
+        mmap_mode : str, optional
+        """
+        folder = cls.folder(csv_path)
+        try:
+            with open(os.path.join(folder, 'metadata.json')) as metadata_file:
+                metadata = json.load(metadata_file)
+            up_to_date = (metadata['neighbours'] == neighbours and metadata['settlements'] == len(df) and
+                          metadata.get('source_size') == os.path.getsize(csv_path) and
+                          metadata.get('source_mtime') == os.path.getmtime(csv_path))
+        except (OSError, ValueError, KeyError):
+            up_to_date = False
+
+        if up_to_date:
+            logging.info('Loading settlement graph from {}'.format(folder))
+            return cls.load(folder, mmap_mode)
+
+        logging.info('Building settlement graph in {}'.format(folder))
+        graph = cls.build(df[SET_X_DEG], df[SET_Y_DEG], df[SET_GRID_PENALTY], neighbours)
+        graph.save(folder, csv_path)
+        return graph
+
+    def edges(self, sources):
+        """Lists the edges from the given settlements
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            The source, neighbour, distance and adjusted distance of each edge
+        """
+        sources = np.asarray(sources, dtype=int)
+        starts = self.indptr[sources]
+        counts = self.indptr[sources + 1] - starts
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        edges = np.repeat(starts, counts) + offsets
+        return np.repeat(sources, counts), self.indices[edges], self.distance[edges], self.distance_adjusted[edges]
+
+
+class SettlementState:
+    """The settlement columns of a year that the grid extension and the electrification limits work on, as NumPy
+    arrays
+
+    The arrays follow the row order of ``SettlementProcessor.df`` by position, so the stages index them with integer
+    positions and write their results back to the data frame as whole columns, without index alignment. Columns that
+    the stages of the year have not added yet, such as the minimum overall code before ``results_columns``, are None.
+
+    The data frame is still where the settlements are kept between stages: pre_electrification, elec_extension and
+    apply_limitations each take a new state from it, since the stages before them add their inputs to the data frame.
+    """
+
+    __slots__ = ('x', 'y', 'grid_penalty_ratio', 'mv_dist_planned', 'hv_dist_planned', 'num_people_per_hh', 'pop',
+                 'new_connections', 'energy_per_cell', 'prev_code', 'min_offgrid_lcoe', 'min_overall_code',
+                 'investment_cost')
+
+    def __init__(self, df, year, time_step=None):
+        """
+        Arguments
+        ---------
+        df : pandas.DataFrame
+        year : int
+        time_step : int, optional
+            Without it, the code of the previous year is not available
+        """
+        def column(name):
+            if name not in df:
+                return None
+            return np.ascontiguousarray(df[name].to_numpy())
+
+        self.x = column(SET_X_DEG)
+        self.y = column(SET_Y_DEG)
+        self.grid_penalty_ratio = column(SET_GRID_PENALTY)
+        self.mv_dist_planned = column(SET_MV_DIST_PLANNED)
+        self.hv_dist_planned = column(SET_HV_DIST_PLANNED)
+        self.num_people_per_hh = column(SET_NUM_PEOPLE_PER_HH)
+        self.pop = column(SET_POP + "{}".format(year))
+        self.new_connections = column(SET_NEW_CONNECTIONS + "{}".format(year))
+        self.energy_per_cell = column(SET_ENERGY_PER_CELL + "{}".format(year))
+        self.prev_code = None if time_step is None else column(SET_ELEC_FINAL_CODE + "{}".format(year - time_step))
+        self.min_offgrid_lcoe = column(SET_MIN_OFFGRID_LCOE + "{}".format(year))
+        self.min_overall_code = column(SET_MIN_OVERALL_CODE + "{}".format(year))
+        self.investment_cost = column(SET_INVESTMENT_COST + "{}".format(year))
+
+    def peak_load(self, grid_calc, positions=slice(None)):
+        """Peak load on the grid of the settlements at positions, by default all of them (kW)"""
+        consumption = self.energy_per_cell[positions]  # kWh/year
+        average_load = consumption / (1 - grid_calc.distribution_losses) / HOURS_PER_YEAR  # kW
+        return average_load / grid_calc.base_to_peak_load_ratio
+
+    def new_grid_connections(self, positions=slice(None)):
+        """New households of the settlements at positions, by default all of them"""
+        return self.new_connections[positions] / self.num_people_per_hh[positions]
+
+
+class SettlementProcessor:
+    """
+    Processes the DataFrame and adds all the columns to determine the cheapest option and the final costs and summaries
+    """
+
+    def __init__(self, path, columns=None):
+        """
+        Arguments
+        ---------
+        path : str or pandas.DataFrame
+            A settlement file (see ``read_settlements``), or settlements that are already in memory, e.g. a chunk
+            from ``read_chunks``
+        columns : list, optional
+            The columns to read from the file
+        """
+        # Row-local stages, such as the off-grid LCOEs, work through this many settlements at a time if it is set
+        self.chunk_rows = None
+        # Yearly columns moved out of df by retire_year_columns, by year, and the order all columns were added in
+        self.year_columns = {}
+        self.column_order = []
+        if isinstance(path, pd.DataFrame):
+            self.df = path
+        else:
+            try:
+                self.df = self.read_settlements(path, columns)
+            except FileNotFoundError:
+                print("Please make sure that the country name you provided and the .csv file, both have the same name")
+                raise
+
+            if SET_GHI not in self.df.columns and (columns is None or SET_GHI in columns):
+                print('Column "GHI" not found, check column names in calibrated csv-file')
+                raise KeyError(SET_GHI)
+
+        self.enforce_schema()
+
+    @staticmethod
+    def schema_dtype(column):
+        """Returns the compact type of a settlement column, or None if the schema does not cover it
+
+        Arguments
+        ---------
+        column : str
+            Column name, for yearly columns including the year, e.g. FinalElecCode2030
+        """
+        if column in SETTLEMENT_DTYPES:
+            return SETTLEMENT_DTYPES[column]
+        stem = column.rstrip('0123456789')
+        if stem != column:
+            return SETTLEMENT_YEAR_DTYPES.get(stem)
+        return None
+
+    @staticmethod
+    def result_dtypes(df):
+        """Returns the types that the float columns of a results frame are written with
+
+        The types come from ``RESULT_DTYPES`` and, for yearly columns, ``RESULT_YEAR_DTYPES``, so that a column has
+        the same type in every scenario and year. Float columns that neither covers are written as they are.
+
+        Arguments
+        ---------
+        df : pandas.DataFrame
+
+        Returns
+        -------
+        dict
+            The float columns whose type differs from the declared one, with the declared type
+        """
+        dtypes = {}
+        for column, dtype in df.dtypes.items():
+            if dtype.kind != 'f':
+                continue
+            target = RESULT_DTYPES.get(column)
+            if target is None:
+                stem = column.rstrip('0123456789')
+                if stem != column:
+                    target = RESULT_YEAR_DTYPES.get(stem)
+            if target is not None and dtype != target:
+                dtypes[column] = target
+        return dtypes
+
+    def enforce_schema(self):
+        """Casts the settlement columns of df that the schema covers to their compact types, see ``cast_to_schema``"""
+        self.cast_to_schema(self.df)
+
+    @staticmethod
+    def cast_to_schema(df):
+        """Casts the settlement columns that the schema covers to their compact types, in place
+
+        Integer codes that still hold missing values, or values outside the range of the compact type, are left as
+        they are. Columns are cast one at a time so that the frame is never copied as a whole.
+
+        Arguments
+        ---------
+        df : pandas.DataFrame
+
+        Returns
+        -------
+        pandas.DataFrame
+            df
+        """
+        for column, dtype in df.dtypes.items():
+            target = SettlementProcessor.schema_dtype(column)
+            if target is None or dtype == target:
+                continue
+            values = df[column]
+            if target == 'category':
+                if dtype == object:
+                    df[column] = values.astype('category')
+                continue
+            target = np.dtype(target)
+            if values.dtype.kind not in 'biuf':
+                continue
+            if target.kind == 'i':
+                info = np.iinfo(target)
+                if values.isnull().any() or values.min() < info.min or values.max() > info.max:
+                    continue
+            df[column] = values.astype(target)
+        return df
+
+    @staticmethod
+    def sniff_separator(path, delimiters=',;\t'):
+        """Guesses the separator of a csv-file from its header line, defaulting to a comma
+
+        Arguments
+        ---------
+        path : str
+        delimiters : str
+            The candidate separators
+        """
+        with open_csv(path) as f:
+            header = f.readline()
+        try:
+            return csv.Sniffer().sniff(header, delimiters=delimiters).delimiter
+        except csv.Error:
+            return ','
+
+    @staticmethod
+    def read_settlements(path, columns=None):
+        """Reads a settlement file into a DataFrame
+
+        Parquet and Feather (Arrow IPC) files are recognised from the extension and need ``pyarrow``; anything
+        else is read as a csv-file with a sniffed separator, in one pass. Columns listed in ``SETTLEMENT_DTYPES`` are
+        parsed with the types given there, except that integer codes are parsed as floats, since they may have
+        gaps. ``cast_to_schema`` then casts the codes without gaps to their compact types.
+
+        Arguments
+        ---------
+        path : str
+        columns : list, optional
+            The columns to read. Names that are not in the file are ignored. By default all columns are read.
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        file_format = settlement_format(path)
+        if file_format == 'csv':
+            sep = SettlementProcessor.sniff_separator(path)
+            usecols = None if columns is None else set(columns).__contains__
+            dtype = {column: 'float64' if target != 'category' and np.dtype(target).kind == 'i' else target
+                     for column, target in SETTLEMENT_DTYPES.items()}
+            df = pd.read_csv(path, sep=sep, usecols=usecols, dtype=dtype)
+            return SettlementProcessor.cast_to_schema(df)
+
+        if file_format == 'columns':
+            return SettlementProcessor.load_columns(path, columns)
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        if columns is not None:
+            if file_format == 'parquet':
+                import pyarrow.parquet
+                available = pyarrow.parquet.ParquetFile(path).schema_arrow.names
+            else:
+                import pyarrow.ipc
+                available = pyarrow.ipc.open_file(path).schema.names
+            columns = [column for column in available if column in set(columns)]
+        if file_format == 'parquet':
+            return pd.read_parquet(path, columns=columns)
+        return pd.read_feather(path, columns=columns)
+
+    @staticmethod
+    def write_settlements(df, path):
+        """Writes a settlement DataFrame in the format given by the extension of ``path``
+
+        Arguments
+        ---------
+        df : pandas.DataFrame
+        path : str
+        """
+        file_format = settlement_format(path)
+        if file_format == 'parquet':
+            df.to_parquet(path, index=False)
+        elif file_format == 'feather':
+            df.reset_index(drop=True).to_feather(path)
+        else:
+            df.to_csv(path, index=False)
 
-        no_of_hv_mv_substation = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                          no_of_hv_mv_substation_additional,
-                                          no_of_hv_mv_substation_new)
+    @staticmethod
+    def read_chunks(path, chunk_rows, columns=None):
+        """Reads a settlement file as DataFrames of up to chunk_rows rows each, in file order
 
-        no_of_mv_mv_substation = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                          no_of_mv_mv_substation_additional,
-                                          no_of_mv_mv_substation_new)
+        Unlike ``read_settlements``, the column types of csv-files are inferred chunk by chunk; wrapping each chunk
+        in a ``SettlementProcessor`` casts them to the schema.
 
-        no_of_mv_lv_substation = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                          no_of_mv_lv_substation_additional,
-                                          no_of_mv_lv_substation_new)
+        Arguments
+        ---------
+        path : str
+        chunk_rows : int
+        columns : list, optional
+        """
+        file_format = settlement_format(path)
+        if file_format == 'csv':
+            sep = SettlementProcessor.sniff_separator(path)
+            usecols = None if columns is None else set(columns).__contains__
+            with pd.read_csv(path, sep=sep, usecols=usecols, chunksize=chunk_rows) as reader:
+                yield from reader
+        elif file_format == 'columns':
+            for start in range(0, ColumnStore.metadata(path)['rows'], chunk_rows):
+                yield ColumnStore.read(path, columns, rows=slice(start, start + chunk_rows))
+        elif file_format == 'parquet':
+            import pyarrow.parquet
+            parquet_file = pyarrow.parquet.ParquetFile(path)
+            if columns is not None:
+                columns = [column for column in parquet_file.schema_arrow.names if column in set(columns)]
+            for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=columns):
+                yield batch.to_pandas()
+        else:
+            import pyarrow.ipc
+            reader = pyarrow.ipc.open_file(path)
+            if columns is not None:
+                columns = [column for column in reader.schema.names if column in set(columns)]
+            for number in range(reader.num_record_batches):
+                batch = reader.get_batch(number)
+                if columns is not None:
+                    batch = batch.select(columns)
+                for start in range(0, batch.num_rows, chunk_rows):
+                    yield batch.slice(start, chunk_rows).to_pandas()
 
-        generation_per_year = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                                       generation_per_year_additional,
-                                       generation_per_year_new)
+    @staticmethod
+    def rows_per_chunk(path, memory_budget, copies=4):
+        """Returns how many settlements of a file to process at a time to stay within a memory budget
 
-        peak_load = np.where((people != new_connections) & ((prev_code < 2) | (prev_code > 3)),
-                             peak_load_additional,
-                             peak_load_new)
+        The size of a settlement is measured on the first rows of the file.
 
-        td_investment_cost = (hv_lines_total_length * self.hv_line_cost * (
-                1 + self.existing_grid_cost_ratio * elec_loop) +
-                              mv_lines_connection_length * self.mv_line_cost * (
-                                      1 + self.existing_grid_cost_ratio * elec_loop) +
-                              total_lv_lines_length * self.lv_line_cost +
-                              mv_lines_distribution_length * self.mv_line_cost +
-                              num_transformers * self.service_transf_cost +
-                              total_nodes * self.connection_cost_per_hh +
-                              no_of_hv_lv_substation * self.hv_lv_sub_station_cost +
-                              no_of_hv_mv_substation * self.hv_mv_sub_station_cost +
-                              no_of_mv_mv_substation * self.mv_mv_sub_station_cost +
-                              no_of_mv_lv_substation * self.mv_lv_sub_station_cost) * penalty
+        Arguments
+        ---------
+        path : str
+        memory_budget : int
+            Bytes that a chunk may take up, including the columns the stages add and their temporaries
+        copies : int, optional
+            How many times the memory of the chunk as read from the file this allows for
+        """
+        sample = next(SettlementProcessor.read_chunks(path, 1000), None)
+        if sample is None or sample.empty:
+            return 1
+        row_bytes = sample.memory_usage(index=False, deep=True).sum() / len(sample)
+        return max(1, int(memory_budget // (row_bytes * copies)))
 
-        return generation_per_year, peak_load, td_investment_cost
+    @staticmethod
+    def save_columns(df, folder):
+        """Stores the settlements as a ``ColumnStore``, so that several processes can load them without parsing
 
+        Arguments
+        ---------
+        df : pandas.DataFrame
+        folder : str
+        """
+        with ColumnStore(folder) as store:
+            store.append(df)
 
-class SettlementProcessor:
-    """
-    Processes the DataFrame and adds all the columns to determine the cheapest option and the final costs and summaries
-    """
+    @staticmethod
+    def load_columns(folder, columns=None, mmap_mode='r'):
+        """Reads settlements stored by ``save_columns``
 
-    def __init__(self, path):
-        try:
-            self.df = pd.read_csv(path)
-        except FileNotFoundError:
-            print("Please make sure that the country name you provided and the .csv file, both have the same name")
-            raise
+        The column files are read through memory maps instead of being parsed or unpickled. Each call returns a
+        frame with its own writable copy of the columns, so processes loading the same folder only share the parsing
+        work and the file pages in the operating system's cache, not the settlement data in their memory.
 
-        try:
-            self.df[SET_GHI]
-        except KeyError:
-            self.df = pd.read_csv(path, sep=';')
-            try:
-                self.df[SET_GHI]
-            except ValueError:
-                print('Column "GHI" not found, check column names in calibrated csv-file')
-                raise
+        Arguments
+        ---------
+        folder : str
+        columns : list, optional
+        mmap_mode : str, optional
+        """
+        return ColumnStore.read(folder, columns, mmap_mode=mmap_mode)
 
     @staticmethod
     def _diesel_fuel_cost_calculator(diesel_price: float,
@@ -727,9 +1617,15 @@ class SettlementProcessor:
 
         self.df = self.df.join(diesel_cost)
 
-    def condition_df(self):
+    def condition_df(self, sort=True):
         """
         Do any initial data conditioning that may be required.
+
+        Arguments
+        ---------
+        sort : bool, optional
+            Sort the settlements by Y and X. Chunks of a larger file are conditioned without sorting and sorted as a
+            whole afterwards.
         """
 
         logging.info('Ensure that columns that are supposed to be numeric are numeric')
@@ -746,10 +1642,15 @@ class SettlementProcessor:
             self.df[column] = pd.to_numeric(self.df[column], errors='coerce')
 
         logging.info('Replace null values with zero')
+        for column in self.df.select_dtypes('category'):
+            if self.df[column].isnull().any() and 0 not in self.df[column].cat.categories:
+                self.df[column] = self.df[column].cat.add_categories([0])
         self.df.fillna(0, inplace=True)
+        self.enforce_schema()
 
-        logging.info('Sort by country, Y and X')
-        self.df.sort_values(by=[SET_Y_DEG, SET_X_DEG], inplace=True)
+        if sort:
+            logging.info('Sort by country, Y and X')
+            self.df.sort_values(by=[SET_Y_DEG, SET_X_DEG], inplace=True)
 
     @staticmethod
     def classify_road_distance(road_distance):
@@ -935,7 +1836,7 @@ class SettlementProcessor:
         pop_ratio = pop_actual / self.df[SET_POP].sum()
 
         # Use above ratio to calibrate the population in a new column
-        self.df[SET_POP_CALIB] = self.df.apply(lambda row: row[SET_POP] * pop_ratio, axis=1)
+        self.df[SET_POP_CALIB] = self.df[SET_POP] * pop_ratio
         pop_modelled = self.df[SET_POP_CALIB].sum()
 
         self.df[SET_ELEC_POP_CALIB] = self.df[SET_ELEC_POP] * pop_ratio
@@ -945,10 +1846,19 @@ class SettlementProcessor:
         # The model uses 0, 1, 2 as follows; 0 = rural, 1 = peri-urban, 2 = urban.
         # The calibration build into the model only classifies into urban/rural
 
-        self.df.sort_values(by=[SET_POP_CALIB], inplace=True, ascending=False)
-        cumulative_urban_pop = self.df[SET_POP_CALIB].cumsum()
-        self.df[SET_URBAN] = np.where(cumulative_urban_pop < (urban_current * self.df[SET_POP_CALIB].sum()), 2, 0)
-        self.df.sort_index(inplace=True)
+        # The most populated settlements are classified as urban, until they hold the urban share of the population.
+        # Settlements with the same population are taken in the same order as a descending DataFrame.sort_values
+        pop_calib = self.df[SET_POP_CALIB].values
+        order = np.arange(len(pop_calib))[::-1][np.argsort(pop_calib[::-1])][::-1]
+        cumulative_urban_pop = np.nancumsum(pop_calib[order])
+        cumulative_urban_pop[np.isnan(pop_calib[order])] = np.nan
+        urban = np.zeros(len(pop_calib), dtype=int)
+        urban[order] = np.where(cumulative_urban_pop < (urban_current * self.df[SET_POP_CALIB].sum()), 2, 0)
+        self.df[SET_URBAN] = urban
+
+        # The settlements are kept in the order of the input file
+        if not self.df.index.is_monotonic_increasing:
+            self.df.sort_index(inplace=True)
 
         # Get the calculated urban ratio and compare to the actual ratio
         pop_urb = self.df.loc[self.df[SET_URBAN] > 1, SET_POP_CALIB].sum()
@@ -960,9 +1870,12 @@ class SettlementProcessor:
 
         return pop_modelled, urban_modelled
 
-    def project_pop_and_urban(self, pop_future, urban_future, start_year, years_of_analysis):
+    def project_pop_and_urban(self, pop_future, urban_future, start_year, years_of_analysis, projection_years=()):
         """
         This function projects population and urban/rural ratio for the different years of the analysis
+
+        The population of additional years, e.g. every year until the end year, can be projected at the same time
+        by listing them in projection_years
         """
         project_life = years_of_analysis[-1] - start_year
 
@@ -977,18 +1890,45 @@ class SettlementProcessor:
         yearly_urban_growth_rate = urban_growth ** (1 / project_life)
         yearly_rural_growth_rate = rural_growth ** (1 / project_life)
 
-        for year in years_of_analysis:
-            self.df[SET_POP + "{}".format(year)] = \
-                self.df.apply(lambda row: row[SET_POP_CALIB] * (yearly_urban_growth_rate ** (year - start_year))
-                if row[SET_URBAN] > 1
-                else row[SET_POP_CALIB] * (yearly_rural_growth_rate ** (year - start_year)), axis=1)
+        years = list(years_of_analysis) + [year for year in projection_years if year not in years_of_analysis]
+        years.append(start_year)
+        population = self.project_population(self.df[SET_POP_CALIB].values, self.df[SET_URBAN].values, years,
+                                              start_year, yearly_urban_growth_rate, yearly_rural_growth_rate)
+        self.df[[SET_POP + "{}".format(year) for year in years]] = population
+
+    @staticmethod
+    def project_population(pop_calib, urban, years, start_year, yearly_urban_growth_rate, yearly_rural_growth_rate):
+        """Projects the population of all settlements to all given years at once
+
+        Arguments
+        ---------
+        pop_calib : numpy.ndarray
+            Calibrated population of the start year
+        urban : numpy.ndarray
+            Urban classification of the settlements, where values above 1 are urban
+        years : list
+        start_year : int
+        yearly_urban_growth_rate : float
+        yearly_rural_growth_rate : float
 
-        self.df[SET_POP + "{}".format(start_year)] = self.df.apply(lambda row: row[SET_POP_CALIB], axis=1)
+        Returns
+        -------
+        numpy.ndarray
+            The population of each settlement (rows) in each year (columns)
+        """
+        growth = np.array([[yearly_rural_growth_rate ** (year - start_year) for year in years],
+                           [yearly_urban_growth_rate ** (year - start_year) for year in years]])
+        return pop_calib[:, np.newaxis] * growth[(urban > 1).astype(int)]
 
     def calibrate_elec_current(self, elec_actual, elec_actual_urban, elec_actual_rural, start_year, min_night_lights=0,
-                               min_pop=50, max_transformer_dist=2, max_mv_dist=2, max_hv_dist=5, buffer=True):
+                               min_pop=50, max_transformer_dist=2, max_mv_dist=2, max_hv_dist=5, buffer=True,
+                               max_buffer_dist=5):
         """
         Calibrate the current electrification status
+
+        The electrified population of the settlements meeting the conditions is scaled to the national statistics,
+        and if that is not enough the settlements within a buffer of the grid are electrified, starting with the
+        closest ones, up to max_buffer_dist km from it
         """
 
         self.df[SET_ELEC_POP_CALIB] = self.df[SET_ELEC_POP] * (self.df[SET_POP_CALIB].sum() / self.df[SET_POP].sum())
@@ -1018,20 +1958,14 @@ class SettlementProcessor:
         logging.info('Calibrate current electrification')
         self.df[SET_ELEC_CURRENT] = 0  # 0 = unelectrified, 1 = electrified. Initially all settlements set to 0
 
-        # This if function here skims through T&D columns in csv to identify which GIS grid distance information exists;
-        # Then it defines calibration method accordingly.
-        if max(self.df[SET_DIST_TO_TRANS]) < 9999:
-            self.df[SET_CALIB_GRID_DIST] = self.df[SET_DIST_TO_TRANS]
-            dist_limit = max_transformer_dist
-            grid_data = 'service transformers'
-        elif max(self.df[SET_MV_DIST_CURRENT]) < 9999:
-            self.df[SET_CALIB_GRID_DIST] = self.df[SET_MV_DIST_CURRENT]
-            dist_limit = max_mv_dist
-            grid_data = 'MV lines'
-        else:
-            self.df[SET_CALIB_GRID_DIST] = self.df[SET_HV_DIST_CURRENT]
-            dist_limit = max_hv_dist
-            grid_data = 'HV lines'
+        grid_data = self.calibration_grid_data()
+        self.df[SET_CALIB_GRID_DIST] = self.df[grid_data]
+        dist_limit = {SET_DIST_TO_TRANS: max_transformer_dist,
+                      SET_MV_DIST_CURRENT: max_mv_dist,
+                      SET_HV_DIST_CURRENT: max_hv_dist}[grid_data]
+        grid_data = {SET_DIST_TO_TRANS: 'service transformers',
+                     SET_MV_DIST_CURRENT: 'MV lines',
+                     SET_HV_DIST_CURRENT: 'HV lines'}[grid_data]
 
         print('We have identified the existence of {} as input data; therefore we proceed using '
               'those for the calibration'.format(grid_data))
@@ -1060,69 +1994,12 @@ class SettlementProcessor:
         elif (max_urban_ntl_elec < urban_electrified) or (max_rural_ntl_elec < rural_electrified):
             print('Not enough urban or rural population meet the criteria. '
                   'Calibrating to match total electrified population only')
-            total_elec_modelled = self.df.loc[self.df[SET_ELEC_CURRENT] == 1, SET_ELEC_POP_CALIB].sum()
-            total_elec_factor = total_elec_modelled / (urban_electrified + rural_electrified)
-
-            if total_elec_factor > 1:
-                self.df.loc[(self.df[SET_ELEC_CURRENT] == 1), SET_ELEC_POP_CALIB] *= (1 / total_elec_factor)
-            else:
-                i = 0
-                while total_elec_factor <= 1:
-                    if i < 10:
-                        self.df.loc[
-                            (self.df[SET_ELEC_CURRENT] == 1), SET_ELEC_POP_CALIB] *= 1.1
-                        self.df[SET_ELEC_POP_CALIB] = np.minimum(self.df[SET_ELEC_POP_CALIB], self.df[SET_POP_CALIB])
-                        total_elec_modelled = self.df.loc[self.df[SET_ELEC_CURRENT] == 1, SET_ELEC_POP_CALIB].sum()
-                        total_elec_factor = total_elec_modelled / (urban_electrified + rural_electrified)
-                        i += 1
-                    else:
-                        break
+            self.scale_elec_pop_calib(self.df[SET_ELEC_CURRENT] == 1, urban_electrified + rural_electrified)
 
         else:
             print('Calibrating to match both urban and rural electrified population')
-            urban_elec_modelled = self.df.loc[(self.df[SET_ELEC_CURRENT] == 1) & (self.df[SET_URBAN] == 2),
-                                              SET_ELEC_POP_CALIB].sum()
-
-            rural_elec_modelled = self.df.loc[(self.df[SET_ELEC_CURRENT] == 1) & (self.df[SET_URBAN] < 2),
-                                              SET_ELEC_POP_CALIB].sum()
-
-            urban_elec_factor = urban_elec_modelled / urban_electrified
-            rural_elec_factor = rural_elec_modelled / rural_electrified
-
-            if urban_elec_factor > 1:
-                self.df.loc[(self.df[SET_ELEC_CURRENT] == 1) & (self.df[SET_URBAN] == 2), SET_ELEC_POP_CALIB] *= (
-                        1 / urban_elec_factor)
-            else:
-                i = 0
-                while urban_elec_factor <= 1:
-                    if i < 10:
-                        self.df.loc[
-                            (self.df[SET_ELEC_CURRENT] == 1) & (self.df[SET_URBAN] == 2), SET_ELEC_POP_CALIB] *= 1.1
-                        self.df[SET_ELEC_POP_CALIB] = np.minimum(self.df[SET_ELEC_POP_CALIB], self.df[SET_POP_CALIB])
-                        urban_elec_modelled = self.df.loc[
-                            (self.df[SET_ELEC_CURRENT] == 1) & (self.df[SET_URBAN] == 2), SET_ELEC_POP_CALIB].sum()
-                        urban_elec_factor = urban_elec_modelled / urban_electrified
-                        i += 1
-                    else:
-                        break
-
-            if rural_elec_factor > 1:
-                self.df.loc[(self.df[SET_ELEC_CURRENT] == 1) & (self.df[SET_URBAN] < 2), SET_ELEC_POP_CALIB] *= (
-                        1 / rural_elec_factor)
-            else:
-                i = 0
-                while rural_elec_factor <= 1:
-                    if i < 10:
-                        self.df.loc[
-                            (self.df[SET_ELEC_CURRENT] == 1) & (self.df[SET_URBAN] < 2), SET_ELEC_POP_CALIB] *= 1.1
-                        self.df[SET_ELEC_POP_CALIB] = np.minimum(self.df[SET_ELEC_POP_CALIB],
-                                                                 self.df[SET_POP_CALIB])
-                        rural_elec_modelled = self.df.loc[
-                            (self.df[SET_ELEC_CURRENT] == 1) & (self.df[SET_URBAN] < 2), SET_ELEC_POP_CALIB].sum()
-                        rural_elec_factor = rural_elec_modelled / rural_electrified
-                        i += 1
-                    else:
-                        break
+            self.scale_elec_pop_calib((self.df[SET_ELEC_CURRENT] == 1) & (self.df[SET_URBAN] == 2), urban_electrified)
+            self.scale_elec_pop_calib((self.df[SET_ELEC_CURRENT] == 1) & (self.df[SET_URBAN] < 2), rural_electrified)
 
         pop_elec = self.df.loc[self.df[SET_ELEC_CURRENT] == 1, SET_ELEC_POP_CALIB].sum()
         elec_modelled = pop_elec / total_pop
@@ -1130,34 +2007,19 @@ class SettlementProcessor:
         buffer_used = 'No'
         td_dist_2 = 0
 
-        if buffer:
+        if buffer and (elec_actual - elec_modelled > 0.01):
             # If not enough people live where there is NTL, and buffer option set to True,
             # electrify people around buffer from existing grid
-            i = 0
-
-            while abs(elec_actual - elec_modelled) > 0.01:
-                buffer_used = 'Yes'
-                pop_elec_2 = self.df.loc[(self.df[SET_ELEC_CURRENT] == 0) & (self.df[SET_POP_CALIB] > min_pop) &
-                                         (self.df[SET_CALIB_GRID_DIST] < td_dist_2), SET_POP_CALIB].sum()
-                if i < 50:
-                    if (pop_elec + pop_elec_2) / total_pop > elec_actual:
-                        elec_modelled = (pop_elec + pop_elec_2) / total_pop
-                        self.df.loc[(self.df[SET_ELEC_CURRENT] == 0) & (self.df[SET_POP_CALIB] > min_pop) &
-                                    (self.df[SET_CALIB_GRID_DIST] < td_dist_2), SET_ELEC_POP_CALIB] = self.df[
-                            SET_POP_CALIB]
-                        self.df.loc[(self.df[SET_ELEC_CURRENT] == 0) & (self.df[SET_POP_CALIB] > min_pop) &
-                                    (self.df[SET_CALIB_GRID_DIST] < td_dist_2), SET_ELEC_CURRENT] = 1
-                    else:
-                        i += 1
-                        td_dist_2 += 0.1
-                else:
-                    self.df.loc[(self.df[SET_ELEC_CURRENT] == 0) & (self.df[SET_POP_CALIB] > min_pop) &
-                                (self.df[SET_CALIB_GRID_DIST] < td_dist_2), SET_ELEC_POP_CALIB] = self.df[
-                        SET_POP_CALIB]
-                    self.df.loc[(self.df[SET_ELEC_CURRENT] == 0) & (self.df[SET_POP_CALIB] > min_pop) &
-                                (self.df[SET_CALIB_GRID_DIST] < td_dist_2), SET_ELEC_CURRENT] = 1
-                    elec_modelled = (pop_elec + pop_elec_2) / total_pop
-                    break
+            buffer_used = 'Yes'
+            candidates = ((self.df[SET_ELEC_CURRENT] == 0) & (self.df[SET_POP_CALIB] > min_pop)).values
+            td_dist_2 = self.buffer_distance(self.df[SET_CALIB_GRID_DIST].values[candidates],
+                                             self.df[SET_POP_CALIB].values[candidates],
+                                             elec_actual * total_pop - pop_elec, max_buffer_dist)
+
+            buffered = candidates & (self.df[SET_CALIB_GRID_DIST] <= td_dist_2).values
+            self.df.loc[buffered, SET_ELEC_POP_CALIB] = self.df[SET_POP_CALIB]
+            self.df.loc[buffered, SET_ELEC_CURRENT] = 1
+            elec_modelled = (pop_elec + self.df.loc[buffered, SET_POP_CALIB].sum()) / total_pop
 
         if elec_modelled > elec_actual:
             self.df[SET_ELEC_POP_CALIB] *= elec_actual / elec_modelled
@@ -1180,10 +2042,175 @@ class SettlementProcessor:
 
         self.df[SET_ELEC_FINAL_CODE + "{}".format(start_year)] = 99
         self.df.loc[self.df[SET_ELEC_CURRENT] == 1, SET_ELEC_FINAL_CODE + "{}".format(start_year)] = 1
+        self.enforce_schema()
 
         return elec_modelled, rural_elec_modelled / rural_pop, urban_elec_modelled / urban_pop, grid_data, dist_limit, \
                min_night_lights, min_pop, buffer_used, td_dist_2
 
+    def calibration_grid_data(self):
+        """Returns the column of the most detailed grid distance data available for the calibration"""
+        # This if function here skims through T&D columns in csv to identify which GIS grid distance information exists;
+        # Then it defines calibration method accordingly.
+        if max(self.df[SET_DIST_TO_TRANS]) < 9999:
+            return SET_DIST_TO_TRANS
+        elif max(self.df[SET_MV_DIST_CURRENT]) < 9999:
+            return SET_MV_DIST_CURRENT
+        else:
+            return SET_HV_DIST_CURRENT
+
+    def calibration_sweep(self, elec_actual, elec_actual_urban, elec_actual_rural, min_night_lights=(0,),
+                          min_pop=(50,), dist_limit=(2,)):
+        """Evaluates all combinations of calibration thresholds at once
+
+        For each combination of minimum night lights, minimum population and maximum distance to the grid, the
+        settlements meeting the conditions of ``calibrate_elec_current`` are taken as electrified, and their share of
+        the national, urban and rural population is compared with the statistics. The settlements are sorted by
+        grid distance once, so each combination of night lights and population thresholds takes one cumulative sum,
+        from which the rates for all distances are read off.
+
+        Requires the calibrated population and urban split, see ``calibrate_current_pop_and_urban``.
+
+        Arguments
+        ---------
+        elec_actual : float
+        elec_actual_urban : float
+        elec_actual_rural : float
+        min_night_lights : list
+        min_pop : list
+        dist_limit : list
+            Maximum distances (km) to the grid data used by the calibration, see ``calibration_grid_data``
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per combination, ranked by the root-mean-square deviation of the modelled national, urban and
+            rural electrification rates from the statistics
+        """
+        pop = self.df[SET_POP_CALIB].values
+        order = np.argsort(self.df[self.calibration_grid_data()].values, kind='stable')
+        grid_dist = self.df[self.calibration_grid_data()].values[order]
+        pop = pop[order]
+        night_lights = self.df[SET_NIGHT_LIGHTS].values[order]
+        urban = self.df[SET_URBAN].values[order] == 2
+
+        urban_pop = pop[urban].sum()
+        rural_pop = pop[~urban].sum()
+        total_pop = urban_pop + rural_pop
+
+        # The urban and rural statistics are made consistent with the national one, as in calibrate_elec_current
+        factor = (total_pop * elec_actual) / (urban_pop * elec_actual_urban + rural_pop * elec_actual_rural)
+        elec_actual_urban *= factor
+        elec_actual_rural *= factor
+
+        # Number of settlements closer to the grid than each distance limit
+        within = np.searchsorted(grid_dist, np.asarray(dist_limit, dtype=float), side='left')
+        min_pop = np.asarray(min_pop, dtype=float)
+
+        results = []
+        for ntl in min_night_lights:
+            # Electrified population per population threshold (rows) and settlement (columns)
+            elec_pop = np.where((night_lights > ntl) & (pop > min_pop[:, np.newaxis]), pop, 0)
+            urban_elec = np.cumsum(np.where(urban, elec_pop, 0), axis=1)
+            rural_elec = np.cumsum(np.where(urban, 0, elec_pop), axis=1)
+            urban_elec = np.concatenate([np.zeros((len(min_pop), 1)), urban_elec], axis=1)[:, within]
+            rural_elec = np.concatenate([np.zeros((len(min_pop), 1)), rural_elec], axis=1)[:, within]
+
+            results.append(pd.DataFrame({'ntl_limit': ntl,
+                                         'pop_limit': np.repeat(min_pop, len(within)),
+                                         'grid_distance_used': np.tile(np.asarray(dist_limit), len(min_pop)),
+                                         'elec_modelled': ((urban_elec + rural_elec) / total_pop).ravel(),
+                                         'urban_elec_ratio_modelled': (urban_elec / urban_pop).ravel(),
+                                         'rural_elec_ratio_modelled': (rural_elec / rural_pop).ravel()}))
+
+        results = pd.concat(results, ignore_index=True)
+        results['deviation'] = np.sqrt(((results['elec_modelled'] - elec_actual) ** 2 +
+                                        (results['urban_elec_ratio_modelled'] - elec_actual_urban) ** 2 +
+                                        (results['rural_elec_ratio_modelled'] - elec_actual_rural) ** 2) / 3)
+        return results.sort_values('deviation', kind='stable').reset_index(drop=True)
+
+    def scale_elec_pop_calib(self, settlements, target):
+        """Scales the electrified population of the settlements so that it sums to target
+
+        The electrified population of each settlement is capped by its population. The capped sum is piecewise linear
+        in the scaling factor, with a breakpoint where each settlement reaches its cap, so the factor follows from a
+        single sort of the breakpoints. If even the full population falls short of target, all settlements are fully
+        electrified.
+
+        Arguments
+        ---------
+        settlements : pandas.Series
+            Boolean mask of the settlements to scale
+        target : float
+            Electrified population to match
+        """
+        elec_pop = self.df.loc[settlements, SET_ELEC_POP_CALIB].values
+        pop = self.df.loc[settlements, SET_POP_CALIB].values
+        factor = self.capped_scaling_factor(elec_pop, pop, target)
+        self.df.loc[settlements, SET_ELEC_POP_CALIB] = np.minimum(elec_pop * factor, pop)
+
+    @staticmethod
+    def capped_scaling_factor(values, caps, target):
+        """Finds the factor for which the sum of min(factor * values, caps) equals target
+
+        Arguments
+        ---------
+        values : numpy.ndarray
+        caps : numpy.ndarray
+        target : float
+
+        Returns
+        -------
+        float
+            The factor, or the smallest factor at which all values are capped if target exceeds the sum of the caps
+        """
+        positive = values > 0
+        values = values[positive]
+        caps = caps[positive]
+        if len(values) == 0 or target <= 0:
+            return 0
+
+        breakpoints = caps / values
+        order = np.argsort(breakpoints)
+        breakpoints, values, caps = breakpoints[order], values[order], caps[order]
+
+        # Between breakpoints k - 1 and k, the first k values are capped and the others are not
+        capped_sum = np.concatenate([[0], np.cumsum(caps)])[:-1]
+        uncapped_values = np.cumsum(values[::-1])[::-1]
+        sum_at_breakpoints = capped_sum + breakpoints * uncapped_values
+
+        k = np.searchsorted(sum_at_breakpoints, target)
+        if k == len(values):
+            return breakpoints[-1]
+        return (target - capped_sum[k]) / uncapped_values[k]
+
+    @staticmethod
+    def buffer_distance(grid_dist, pop, target, max_buffer_dist=5):
+        """Finds the buffer around the grid that holds more than target people
+
+        Arguments
+        ---------
+        grid_dist : numpy.ndarray
+            Distance of the candidate settlements to the grid
+        pop : numpy.ndarray
+            Population of the candidate settlements
+        target : float
+            Population to electrify
+        max_buffer_dist : float
+            Largest buffer distance
+
+        Returns
+        -------
+        float
+            The distance of the settlement that brings the population within the buffer above target, or
+            max_buffer_dist if the buffer holds too few people
+        """
+        order = np.argsort(grid_dist, kind='stable')
+        cumulative_pop = np.cumsum(pop[order])
+        k = np.searchsorted(cumulative_pop, target, side='right')
+        if k == len(order):
+            return max_buffer_dist
+        return min(grid_dist[order][k], max_buffer_dist)
+
     def current_mv_line_dist(self):
         logging.info('Determine current MV line length')
         self.df[SET_MV_CONNECT_DIST] = 0
@@ -1196,57 +2223,60 @@ class SettlementProcessor:
         """" ... """
 
         logging.info('Define the initial electrification status')
-        grid_investment = np.zeros(len(self.df[SET_X_DEG]))
-        grid_capacity = np.zeros(len(self.df[SET_X_DEG]))
-        prev_code = self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)].copy(deep=True)
+        state = SettlementState(self.df, year, time_step)
+        grid_electrified = state.prev_code == 1
 
         # Grid-electrified settlements
-        electrified_loce, electrified_investment, electrified_capacity = self.get_grid_lcoe(0, 0, 0, year, time_step,
-                                                                                            end_year, grid_calc)
-        electrified_investment = electrified_investment[0]
-        electrified_capacity = electrified_capacity[0]
-        grid_investment = np.where(self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)] == 1,
-                                   electrified_investment, grid_investment)
-        grid_capacity = np.where(self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)] == 1,
-                                 electrified_capacity, grid_capacity)
-
-        self.df[SET_LCOE_GRID + "{}".format(year)] = 99
-        self.df.loc[self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)] == 1,
-                    SET_LCOE_GRID + "{}".format(year)] = grid_price
+        _, electrified_investment, electrified_capacity = self.get_grid_lcoe(0, 0, 0, year, time_step, end_year,
+                                                                             grid_calc)
+        grid_investment = np.where(grid_electrified, electrified_investment, 0.)
+        grid_capacity = np.where(grid_electrified, electrified_capacity, 0.)
+
+        self.df[SET_LCOE_GRID + "{}".format(year)] = np.where(grid_electrified, grid_price, 99)
 
         # Two restrictions may be imposed on the grid. The new grid generation capacity that can be added and the
         # number of new households that can be connected. The next step calculates how much of that will be used up due
         # to demand (population) growth in already electrified settlements
 
         grid_capacity_limit -= grid_capacity.sum()
+        grid_connect_limit -= state.new_grid_connections()[grid_electrified].sum()
 
-        self.df['Densification_connections'] = self.df[SET_NEW_CONNECTIONS + "{}".format(year)] / self.df[
-            SET_NUM_PEOPLE_PER_HH]
-        grid_connect_limit -= sum(self.df.loc[prev_code == 1]['Densification_connections'])
-        del self.df['Densification_connections']
-
-        return pd.Series(grid_investment), pd.Series(grid_capacity), grid_capacity_limit, grid_connect_limit
+        return grid_investment, grid_capacity, grid_capacity_limit, grid_connect_limit
 
     def elec_extension(self, grid_calc, max_dist, year, start_year, end_year, time_step, grid_capacity_limit,
-                       grid_connect_limit, new_investment, new_capacity, auto_intensification=0, prioritization=0):
+                       grid_connect_limit, new_investment, new_capacity, auto_intensification=0, prioritization=0,
+                       algorithm='rounds', graph=None):
         """
         Iterate through all electrified settlements and find which settlements can be economically connected to the grid
         Repeat with newly electrified settlements until no more are added
+
+        Each round only evaluates the settlements that may still be connected in it (the active set), so the cost of
+        the later rounds depends on the size of the network frontier rather than on the number of settlements
+
+        If algorithm is 'priority', the settlements are instead connected one at a time in order of the advantage of
+        the grid over off-grid technologies, see priority_extension. graph is the SettlementGraph used by that
+        algorithm
         """
 
         prio = int(prioritization)
 
-        prev_code = self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)].copy(deep=True)
+        state = SettlementState(self.df, year, time_step)
+        prev_code = state.prev_code
         if year - time_step == start_year:
-            elecorder = self.df[SET_ELEC_ORDER].copy(deep=True)
+            elecorder = self.df[SET_ELEC_ORDER].values.copy()
         else:
-            elecorder = self.df[SET_ELEC_ORDER + "{}".format(year - time_step)].copy(deep=True)
-        grid_penalty_ratio = self.df[SET_GRID_PENALTY].copy(deep=True)
-        min_code_lcoes = self.df[SET_MIN_OFFGRID_LCOE + "{}".format(year)].copy(deep=True)
-        new_lcoes = self.df[SET_LCOE_GRID + "{}".format(year)].copy(deep=True)
-        cell_path_real = self.df[SET_MV_CONNECT_DIST].copy(deep=True)
-        cell_path_adjusted = list(np.zeros(len(prev_code)).tolist())
-        mv_planned = self.df[SET_MV_DIST_PLANNED].copy(deep=True)
+            elecorder = self.df[SET_ELEC_ORDER + "{}".format(year - time_step)].values.copy()
+        grid_penalty_ratio = state.grid_penalty_ratio
+        min_code_lcoes = state.min_offgrid_lcoe
+        new_lcoes = self.df[SET_LCOE_GRID + "{}".format(year)].values.astype(float)
+        cell_path_real = self.df[SET_MV_CONNECT_DIST].values.astype(float)
+        cell_path_adjusted = np.zeros(len(prev_code))
+        mv_planned = state.mv_dist_planned
+        new_investment = np.asarray(new_investment, dtype=float).reshape(-1).copy()
+        new_capacity = np.asarray(new_capacity, dtype=float).reshape(-1).copy()
+
+        # The distance-independent part of the grid LCOE is calculated once for all extension rounds
+        grid_lcoe_evaluator = self.grid_lcoe_evaluator(year, time_step, end_year, grid_calc)
 
         # Start by identifying which settlements are grid-connected already
         electrified = np.where(prev_code == 1, 1, 0)
@@ -1255,119 +2285,278 @@ class SettlementProcessor:
         # off-grid alternatives are less costly. The following section implements that
         if (prio == 2) or (prio == 4):
             mv_dist_adjusted = np.nan_to_num(grid_penalty_ratio * mv_planned)
+            candidates = np.flatnonzero((mv_planned < auto_intensification) & (electrified == 0) &
+                                        (mv_dist_adjusted <= max_dist))
 
-            intensification_lcoe, intensification_investment, intensification_capacity = \
-                self.get_grid_lcoe(dist_adjusted=mv_dist_adjusted, elecorder=0, additional_transformer=0, year=year,
-                                   time_step=time_step, end_year=end_year, grid_calc=grid_calc)
-            intensification_lcoe = new_lcoes.copy(deep=True)
-            intensification_lcoe.loc[(mv_planned < auto_intensification) & (prev_code != 1)] = 0.01
-            intensification_lcoe = pd.DataFrame(intensification_lcoe)
-            intensification_lcoe.columns = [0]
+            # These settlements are connected whatever their grid LCOE, so only their costs are evaluated
+            _, intensification_investment, intensification_capacity = \
+                grid_lcoe_evaluator.evaluate(mv_dist_adjusted[candidates], 0, 0, index=candidates)
+            intensification_lcoe = np.full(len(candidates), 0.01)
 
             grid_capacity_limit, grid_connect_limit, cell_path_real, cell_path_adjusted, elecorder, electrified, \
             new_lcoes, new_investment, new_capacity \
-                = self.update_grid_extension_info(grid_lcoe=intensification_lcoe, dist=mv_planned,
-                                                  dist_adjusted=mv_dist_adjusted, prev_dist=0, elecorder=elecorder,
-                                                  new_elec_order=1, max_dist=max_dist, new_lcoes=new_lcoes,
-                                                  grid_capacity_limit=grid_capacity_limit,
+                = self.update_grid_extension_info(grid_lcoe=intensification_lcoe, dist=mv_planned[candidates],
+                                                  dist_adjusted=mv_dist_adjusted[candidates], prev_dist=0,
+                                                  elecorder=elecorder, new_elec_order=1, max_dist=max_dist,
+                                                  new_lcoes=new_lcoes, grid_capacity_limit=grid_capacity_limit,
                                                   grid_connect_limit=grid_connect_limit, cell_path_real=cell_path_real,
                                                   cell_path_adjusted=cell_path_adjusted, electrified=electrified,
                                                   year=year, grid_calc=grid_calc,
                                                   grid_investment=intensification_investment,
                                                   new_investment=new_investment,
                                                   grid_capacity=intensification_capacity,
-                                                  new_capacity=new_capacity)
+                                                  new_capacity=new_capacity, candidates=candidates, state=state)
+
+        # Settlements further away than their break-even distance cannot be connected, so they are not evaluated.
+        # The margin keeps settlements right at the break-even distance despite rounding errors
+        break_even = grid_lcoe_evaluator.break_even_distance(min_code_lcoes)
+        self.df[SET_BREAK_EVEN_GRID_DIST + "{}".format(year)] = break_even
+        reach = break_even * (1 + 1e-9) + 1e-9
+
+        if algorithm == 'priority':
+            new_lcoes, cell_path_adjusted, elecorder, cell_path_real, new_investment, new_capacity = \
+                self.priority_extension(grid_lcoe_evaluator, grid_calc, max_dist, year, grid_capacity_limit,
+                                        grid_connect_limit, electrified, elecorder, new_lcoes, cell_path_real,
+                                        cell_path_adjusted, new_investment, new_capacity, graph, reach, state)
+            return new_lcoes, cell_path_adjusted, elecorder, cell_path_real, new_investment, new_capacity
+        elif algorithm != 'rounds':
+            raise ValueError("Unknown grid extension algorithm '{}'".format(algorithm))
 
         # Find the unelectrified settlements where grid can be less costly than off-grid
-        filter_lcoe, filter_investment, filter_capacity = self.get_grid_lcoe(0, 0, 0, year, time_step, end_year,
-                                                                             grid_calc)
-        filter_lcoe = filter_lcoe[0]
-        filter_lcoe.loc[electrified == 1] = 99
-        unelectrified = np.where(filter_lcoe < min_code_lcoes)
-        unelectrified = unelectrified[0].tolist()
+        candidates = np.flatnonzero(electrified == 0)
+        filter_lcoe = grid_lcoe_evaluator.evaluate(0, 0, 0, index=candidates)[0]
+        unelectrified = candidates[filter_lcoe < min_code_lcoes[candidates]]
 
-        logging.info('Initially {} electrified'.format(sum(electrified)))
+        logging.info('Initially {} electrified'.format(int(electrified.sum())))
 
         # First round of extension from MV network
-        mv_dist = pd.Series(self.df[SET_MV_DIST_PLANNED])
+        mv_dist = np.asarray(state.mv_dist_planned, dtype=float)
         mv_dist_adjusted = np.nan_to_num(grid_penalty_ratio * mv_dist)
+        candidates = candidates[mv_dist_adjusted[candidates] <= np.minimum(max_dist, reach[candidates])]
 
-        grid_lcoe, grid_investment, grid_capacity = self.get_grid_lcoe(dist_adjusted=mv_dist_adjusted, elecorder=0,
-                                                                       additional_transformer=0, year=year,
-                                                                       time_step=time_step,
-                                                                       end_year=end_year, grid_calc=grid_calc)
+        grid_lcoe, grid_investment, grid_capacity = grid_lcoe_evaluator.evaluate(mv_dist_adjusted[candidates], 0, 0,
+                                                                                 index=candidates)
 
         grid_capacity_limit, grid_connect_limit, cell_path_real, cell_path_adjusted, elecorder, electrified, \
         new_lcoes, new_investment, new_capacity \
-            = self.update_grid_extension_info(grid_lcoe=grid_lcoe, dist=mv_dist, dist_adjusted=mv_dist_adjusted,
-                                              prev_dist=0, elecorder=elecorder, new_elec_order=1, max_dist=max_dist,
+            = self.update_grid_extension_info(grid_lcoe=grid_lcoe, dist=mv_dist[candidates],
+                                              dist_adjusted=mv_dist_adjusted[candidates], prev_dist=0,
+                                              elecorder=elecorder, new_elec_order=1, max_dist=max_dist,
                                               new_lcoes=new_lcoes, grid_capacity_limit=grid_capacity_limit,
                                               grid_connect_limit=grid_connect_limit, cell_path_real=cell_path_real,
                                               cell_path_adjusted=cell_path_adjusted, electrified=electrified, year=year,
                                               grid_calc=grid_calc, grid_investment=grid_investment,
                                               new_investment=new_investment, grid_capacity=grid_capacity,
-                                              new_capacity=new_capacity)
+                                              new_capacity=new_capacity, candidates=candidates, state=state)
 
         #  Second round of extension from HV lines
-        hv_dist = np.nan_to_num(self.df[SET_HV_DIST_PLANNED])
+        hv_dist = np.nan_to_num(np.asarray(state.hv_dist_planned, dtype=float))
         hv_dist_adjusted = np.nan_to_num(hv_dist * grid_penalty_ratio)
+        candidates = np.flatnonzero(electrified == 0)
 
-        grid_lcoe, grid_investment, grid_capacity = self.get_grid_lcoe(dist_adjusted=hv_dist_adjusted, elecorder=0,
-                                                                       additional_transformer=1, year=year,
-                                                                       time_step=time_step,
-                                                                       end_year=end_year, grid_calc=grid_calc)
+        grid_lcoe, grid_investment, grid_capacity = grid_lcoe_evaluator.evaluate(hv_dist_adjusted[candidates], 0, 1,
+                                                                                 index=candidates)
 
         grid_capacity_limit, grid_connect_limit, cell_path_real, cell_path_adjusted, elecorder, electrified, \
         new_lcoes, new_investment, new_capacity \
-            = self.update_grid_extension_info(grid_lcoe=grid_lcoe, dist=hv_dist, dist_adjusted=hv_dist_adjusted,
-                                              prev_dist=0, elecorder=elecorder, new_elec_order=1, max_dist=999999,
+            = self.update_grid_extension_info(grid_lcoe=grid_lcoe, dist=hv_dist[candidates],
+                                              dist_adjusted=hv_dist_adjusted[candidates], prev_dist=0,
+                                              elecorder=elecorder, new_elec_order=1, max_dist=999999,
                                               new_lcoes=new_lcoes, grid_capacity_limit=grid_capacity_limit,
                                               grid_connect_limit=grid_connect_limit, cell_path_real=cell_path_real,
                                               cell_path_adjusted=cell_path_adjusted, electrified=electrified,
                                               year=year, grid_calc=grid_calc, grid_investment=grid_investment,
                                               new_investment=new_investment, grid_capacity=grid_capacity,
-                                              new_capacity=new_capacity)
+                                              new_capacity=new_capacity, candidates=candidates, state=state)
 
         # Third to last round of extension loops from electrified settlements. First considering all
-        # electrified settlements up until this point, then from the newly electrified settlements in each round
-        prev_electrified = np.zeros(len(prev_code))
+        # electrified settlements up until this point, then from the newly electrified settlements in each round.
+        # Only the unelectrified settlements that passed the filter above are candidates, and they are dropped
+        # from the active set once connected
+        extension_nodes = np.flatnonzero(electrified)
+        candidates = unelectrified
+        node_index = ExtensionNodeIndex(state.x, state.y)
         loops = 1
-        while sum(electrified) > sum(prev_electrified):
-            new_electrified = electrified - prev_electrified
-            prev_electrified = electrified
-            logging.info('Electrification loop {} with {} electrified'.format(loops, int(sum(new_electrified))))
+        while len(extension_nodes) > 1:
+            logging.info('Electrification loop {} with {} electrified'.format(loops, len(extension_nodes)))
             loops += 1
 
-            if sum(new_electrified) > 1:
-                # Calculating the distance and adjusted distance from each unelectrified settelement to the closest
-                # electrified settlement, as well as the electrification order an total MV distance to that electrified
-                # settlement
-                nearest_dist_adjusted, nearest_elec_order, prev_dist, nearest_dist = \
-                    self.closest_electrified_settlement(new_electrified, unelectrified, cell_path_real,
-                                                        grid_penalty_ratio, elecorder)
-
-                grid_lcoe, grid_investment, grid_capacity = self.get_grid_lcoe(dist_adjusted=nearest_dist_adjusted,
-                                                                               elecorder=nearest_elec_order,
-                                                                               additional_transformer=0, year=year,
-                                                                               time_step=time_step,
-                                                                               end_year=end_year, grid_calc=grid_calc)
-
-                grid_capacity_limit, grid_connect_limit, cell_path_real, cell_path_adjusted, elecorder, electrified, \
-                new_lcoes, new_investment, new_capacity = \
-                    self.update_grid_extension_info(grid_lcoe=grid_lcoe, dist=nearest_dist,
-                                                    dist_adjusted=nearest_dist_adjusted,
-                                                    prev_dist=prev_dist, elecorder=elecorder,
-                                                    new_elec_order=nearest_elec_order, max_dist=max_dist,
-                                                    new_lcoes=new_lcoes, grid_capacity_limit=grid_capacity_limit,
-                                                    grid_connect_limit=grid_connect_limit,
-                                                    cell_path_real=cell_path_real,
-                                                    cell_path_adjusted=cell_path_adjusted, electrified=electrified,
-                                                    year=year, grid_calc=grid_calc, grid_investment=grid_investment,
-                                                    new_investment=new_investment, grid_capacity=grid_capacity,
-                                                    new_capacity=new_capacity)
-
-        return new_lcoes, cell_path_adjusted, elecorder, cell_path_real, pd.DataFrame(new_investment), pd.DataFrame(
-            new_capacity)
+            candidates = candidates[electrified[candidates] == 0]
+            if len(candidates) == 0:
+                break
+
+            # Calculating the distance and adjusted distance from each unelectrified settelement to the closest
+            # electrified settlement, as well as the electrification order an total MV distance to that electrified
+            # settlement
+            node_index.activate(extension_nodes)
+            nearest_dist_adjusted, nearest_elec_order, prev_dist, nearest_dist = \
+                self.closest_extension_node(node_index, candidates, cell_path_real, grid_penalty_ratio, elecorder)
+
+            # Only the settlements within their break-even distance of the network are evaluated
+            within_reach = nearest_dist_adjusted <= reach[candidates]
+            connectable = candidates[within_reach]
+            nearest_dist_adjusted = nearest_dist_adjusted[within_reach]
+            nearest_elec_order = nearest_elec_order[within_reach]
+            prev_dist = prev_dist[within_reach]
+            nearest_dist = nearest_dist[within_reach]
+
+            grid_lcoe, grid_investment, grid_capacity = \
+                grid_lcoe_evaluator.evaluate(nearest_dist_adjusted, nearest_elec_order, 0, index=connectable)
+
+            grid_capacity_limit, grid_connect_limit, cell_path_real, cell_path_adjusted, elecorder, electrified, \
+            new_lcoes, new_investment, new_capacity = \
+                self.update_grid_extension_info(grid_lcoe=grid_lcoe, dist=nearest_dist,
+                                                dist_adjusted=nearest_dist_adjusted, prev_dist=prev_dist,
+                                                elecorder=elecorder, new_elec_order=nearest_elec_order,
+                                                max_dist=max_dist, new_lcoes=new_lcoes,
+                                                grid_capacity_limit=grid_capacity_limit,
+                                                grid_connect_limit=grid_connect_limit,
+                                                cell_path_real=cell_path_real,
+                                                cell_path_adjusted=cell_path_adjusted, electrified=electrified,
+                                                year=year, grid_calc=grid_calc, grid_investment=grid_investment,
+                                                new_investment=new_investment, grid_capacity=grid_capacity,
+                                                new_capacity=new_capacity, candidates=connectable, state=state)
+
+            extension_nodes = connectable[electrified[connectable] == 1]
+
+        return new_lcoes, cell_path_adjusted, elecorder, cell_path_real, new_investment, new_capacity
+
+    def priority_extension(self, grid_lcoe_evaluator, grid_calc, max_dist, year, grid_capacity_limit,
+                           grid_connect_limit, electrified, elecorder, new_lcoes, cell_path_real, cell_path_adjusted,
+                           new_investment, new_capacity, graph=None, reach=None, state=None):
+        """Extends the grid one settlement at a time, in order of the LCOE advantage of the grid
+
+        Possible connections from the MV and HV network, and from electrified settlements to their nearest
+        neighbours, are kept in a priority queue keyed by the difference between the least-cost off-grid LCOE and
+        the grid LCOE. The settlement with the largest advantage is connected first if it fits within the remaining
+        grid capacity and connection limits, and its own connections to its neighbours are then added to the queue.
+        The capacity and connection limits are therefore allocated by merit instead of in the order of the
+        settlements in the data frame.
+
+        The connections from newly connected settlements are evaluated in batches. No connection to a settlement is
+        less costly than its shortest connection to a neighbour in the first extension round, so connected
+        settlements are collected until one of their neighbours could have a larger advantage than the head of the
+        queue, and their connections are then evaluated together.
+
+        Arguments
+        ---------
+        grid_lcoe_evaluator : GridLcoeEvaluator
+        grid_calc : Technology
+        max_dist : float
+            Maximum length of MV lines from the existing MV network
+        year : int
+        grid_capacity_limit : float
+            Remaining grid generation capacity that can be added in the time step (kW)
+        grid_connect_limit : float
+            Remaining number of new grid connections in the time step
+        electrified, elecorder, new_lcoes, cell_path_real, cell_path_adjusted, new_investment, new_capacity : \
+        numpy.ndarray
+            The state of all settlements, updated in place
+        graph : SettlementGraph, optional
+            Neighbours each settlement can connect to. Built from the data frame if not given
+        reach : numpy.ndarray, optional
+            Longest adjusted connection distance of each settlement worth evaluating, e.g. its break-even distance
+        state : SettlementState, optional
+            The columns of the year, read from the data frame if not given
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            new_lcoes, cell_path_adjusted, elecorder, cell_path_real, new_investment and new_capacity
+        """
+        if state is None:
+            state = SettlementState(self.df, year)
+        grid_penalty_ratio = state.grid_penalty_ratio
+        min_code_lcoes = state.min_offgrid_lcoe
+        peak_load = state.peak_load(grid_calc)  # kW
+        new_grid_connections = state.new_grid_connections()
+        if graph is None:
+            graph = SettlementGraph.build(state.x, state.y, grid_penalty_ratio)
+
+        queue = []
+        counter = itertools.count()
+        rejected = np.zeros(len(electrified), dtype=bool)
+
+        # The largest advantage of any connection to each settlement, from its shortest connection to a neighbour
+        shortest = np.full(len(electrified), np.inf)
+        np.minimum.at(shortest, graph.indices, graph.distance_adjusted)
+        linked = np.flatnonzero((electrified == 0) & np.isfinite(shortest))
+        best_advantage = np.full(len(electrified), -np.inf)
+        best_advantage[linked] = min_code_lcoes[linked] - \
+            grid_lcoe_evaluator.evaluate(shortest[linked], 0, 0, index=linked)[0]
+        pending = []
+        pending_advantage = -np.inf
+
+        def add_connections(positions, dist, dist_adjusted, prev_dist, elec_order, additional_transformer,
+                            max_length):
+            """Evaluates the given connections and adds the ones where grid is less costly than off-grid"""
+            if reach is not None:
+                within_reach = dist_adjusted <= reach[positions]
+                positions, dist, dist_adjusted = positions[within_reach], dist[within_reach], \
+                    dist_adjusted[within_reach]
+                prev_dist, elec_order = prev_dist[within_reach], elec_order[within_reach]
+            if len(positions) == 0:
+                return
+            lcoe, investment, capacity = grid_lcoe_evaluator.evaluate(dist_adjusted, elec_order,
+                                                                      additional_transformer, index=positions)
+            advantage = min_code_lcoes[positions] - lcoe
+            valid = (advantage > 0) & (lcoe <= new_lcoes[positions]) & (prev_dist + dist_adjusted <= max_length)
+            for i in np.flatnonzero(valid):
+                heapq.heappush(queue, (-advantage[i], positions[i], next(counter), lcoe[i], investment[i],
+                                       capacity[i], dist[i], dist_adjusted[i], prev_dist[i], elec_order[i]))
+
+        def extend_from(sources):
+            """Adds the connections from the sources to their unelectrified neighbours"""
+            sources, targets, dist, dist_adjusted = graph.edges(sources)
+            unelectrified = electrified[targets] == 0
+            sources, targets = sources[unelectrified], targets[unelectrified]
+            add_connections(targets, dist[unelectrified], dist_adjusted[unelectrified], cell_path_real[sources],
+                            elecorder[sources] + 1, 0, max_dist)
+
+        # Connections from the MV and HV network and from the settlements that are already electrified
+        candidates = np.flatnonzero(electrified == 0)
+        mv_dist = np.asarray(state.mv_dist_planned, dtype=float)[candidates]
+        add_connections(candidates, mv_dist, np.nan_to_num(grid_penalty_ratio[candidates] * mv_dist),
+                        np.zeros(len(candidates)), np.ones(len(candidates), dtype=int), 0, max_dist)
+        hv_dist = np.nan_to_num(np.asarray(state.hv_dist_planned, dtype=float)[candidates])
+        add_connections(candidates, hv_dist, np.nan_to_num(hv_dist * grid_penalty_ratio[candidates]),
+                        np.zeros(len(candidates)), np.ones(len(candidates), dtype=int), 1, np.inf)
+        extend_from(np.flatnonzero(electrified))
+
+        while queue or pending:
+            if pending and (not queue or pending_advantage >= -queue[0][0]):
+                extend_from(np.array(pending))
+                pending = []
+                pending_advantage = -np.inf
+                continue
+
+            _, position, _, lcoe, investment, capacity, dist, dist_adjusted, prev_dist, elec_order = \
+                heapq.heappop(queue)
+            if electrified[position] or rejected[position]:
+                continue
+            if peak_load[position] > grid_capacity_limit or new_grid_connections[position] > grid_connect_limit:
+                rejected[position] = True
+                continue
+
+            grid_capacity_limit -= peak_load[position]
+            grid_connect_limit -= new_grid_connections[position]
+            electrified[position] = 1
+            new_lcoes[position] = lcoe
+            cell_path_real[position] = prev_dist + dist
+            cell_path_adjusted[position] = dist_adjusted
+            elecorder[position] = elec_order
+            new_investment[position] = investment
+            new_capacity[position] = capacity
+
+            neighbours = graph.edges([position])[1]
+            neighbours = neighbours[electrified[neighbours] == 0]
+            if len(neighbours) > 0:
+                pending.append(position)
+                pending_advantage = max(pending_advantage, best_advantage[neighbours].max())
+
+        logging.info('{} electrified after priority extension'.format(int(electrified.sum())))
+
+        return new_lcoes, cell_path_adjusted, elecorder, cell_path_real, new_investment, new_capacity
 
     def get_grid_lcoe(self, dist_adjusted, elecorder, additional_transformer, year, time_step, end_year, grid_calc):
         grid_lcoe, grid_investment, grid_capacity = \
@@ -1387,89 +2576,128 @@ class SettlementProcessor:
 
         return grid_lcoe, grid_investment, grid_capacity
 
-    def closest_electrified_settlement(self, new_electrified, unelectrified, cell_path_real, grid_penalty_ratio,
-                                       elecorder):
-
-        x = self.df[SET_X_DEG].copy(deep=True)
-        y = self.df[SET_Y_DEG].copy(deep=True)
-
-        # Identifies the electrified settlements from which to extend the network
-        extension_nodes = np.where(new_electrified == 1)
-        extension_nodes = extension_nodes[0].tolist()
-        # Creates an array of x, y coordinates of the electrified settlements
-        elec_nodes2 = np.transpose(np.array([x.loc[extension_nodes], y.loc[extension_nodes]]))
-
-        closest_elec_node = np.zeros(len(x), dtype=int)
-        nearest_dist = np.zeros(len(x))
-        nearest_elec_order = np.zeros(len(x), dtype=int)
-        prev_dist = np.zeros(len(x))
-
-        # Create an array of x-, y-coordinates of the (filtered) unelectrified settlements
-        unelectrified = np.setdiff1d(unelectrified, extension_nodes).tolist()
-        x_unelec = x.loc[unelectrified]
-        y_unelec = y.loc[unelectrified]
-        unelec_nodes = pd.DataFrame(np.transpose(np.array([x_unelec, y_unelec])))
-
-        # Calculate for each unelectrified settlement which is the closest electrified settlement
-        closest_node = self.do_kdtree(elec_nodes2, unelec_nodes)
-
-        # For each unelectrified settlement, find the electrifiecation order, distance to closest electrified
-        # settlement, distance including grid penalty, and total mv length up until the electrrfied settlement
-        j = 0
-        for unelec in unelectrified:
-            closest_elec_node[unelec] = closest_node[j]
-            j += 1
-        extension_nodes = np.array(extension_nodes)
-        x_closest_elec = x.loc[extension_nodes[closest_elec_node[unelectrified]]]
-        x_closest_elec.index = x_unelec.index
-        y_closest_elec = y.loc[extension_nodes[closest_elec_node[unelectrified]]]
-        y_closest_elec.index = y_unelec.index
-        dist = self.haversine_vector(x_closest_elec, y_closest_elec, x_unelec, y_unelec)
-        nearest_dist[unelectrified] = dist[unelectrified]
-        nearest_dist_adjusted = np.nan_to_num(nearest_dist * grid_penalty_ratio)
-        nearest_elec_order[unelectrified] = elecorder[extension_nodes[
-            closest_elec_node[unelectrified]]] + 1
-        prev_dist[unelectrified] = cell_path_real[
-            extension_nodes[closest_elec_node[unelectrified]]]
+    def grid_lcoe_evaluator(self, year, time_step, end_year, grid_calc):
+        """Prepares the grid LCOE calculation of a time step for repeated evaluation with different distances
+
+        Arguments
+        ---------
+        year : int
+        time_step : int
+        end_year : int
+        grid_calc : Technology
+
+        Returns
+        -------
+        GridLcoeEvaluator
+        """
+        return GridLcoeEvaluator(grid_calc,
+                                 energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
+                                 start_year=year - time_step,
+                                 end_year=end_year,
+                                 people=self.df[SET_POP + "{}".format(year)],
+                                 new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
+                                 total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
+                                 prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
+                                 num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
+                                 grid_cell_area=self.df[SET_GRID_CELL_AREA],
+                                 capacity_factor=grid_calc.capacity_factor)
+
+    def closest_extension_node(self, node_index, unelectrified, cell_path_real, grid_penalty_ratio, elecorder):
+        """Finds the closest active node of node_index for each unelectrified settlement
+
+        Arguments
+        ---------
+        node_index : ExtensionNodeIndex
+            Spatial index with the nodes from which to extend the network set as active
+        unelectrified : numpy.ndarray
+            Positions of the unelectrified settlements
+        cell_path_real : numpy.ndarray
+            Total MV distance up until each settlement
+        grid_penalty_ratio : numpy.ndarray
+        elecorder : numpy.ndarray
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            The distance including grid penalty, electrification order, total MV distance up until the closest node
+            and distance to the closest node, for each of the unelectrified settlements
+        """
+        closest_elec_node = node_index.nearest(unelectrified)
+
+        x = node_index.coordinates[:, 0]
+        y = node_index.coordinates[:, 1]
+        nearest_dist = self.haversine_vector(x[closest_elec_node], y[closest_elec_node],
+                                             x[unelectrified], y[unelectrified])
+        nearest_dist_adjusted = np.nan_to_num(nearest_dist * grid_penalty_ratio[unelectrified])
+        nearest_elec_order = elecorder[closest_elec_node] + 1
+        prev_dist = cell_path_real[closest_elec_node]
 
         return nearest_dist_adjusted, nearest_elec_order, prev_dist, nearest_dist
 
     def update_grid_extension_info(self, grid_lcoe, dist, dist_adjusted, prev_dist, elecorder, new_elec_order,
                                    max_dist, new_lcoes, grid_capacity_limit, grid_connect_limit, cell_path_real,
                                    cell_path_adjusted, electrified, year, grid_calc, grid_investment, new_investment,
-                                   grid_capacity, new_capacity):
-
-        min_code_lcoes = self.df[SET_MIN_OFFGRID_LCOE + "{}".format(year)].copy(deep=True)
+                                   grid_capacity, new_capacity, candidates=None, state=None):
+        """Connects the settlements of an extension round where the grid is the least-cost option
 
-        grid_lcoe = grid_lcoe[0]
-        grid_investment = grid_investment[0]
-        grid_capacity = grid_capacity[0]
-        grid_lcoe.loc[electrified == 1] = 99
-        grid_lcoe.loc[prev_dist + dist_adjusted > max_dist] = 99
-        grid_lcoe.loc[grid_lcoe > new_lcoes] = 99
-        consumption = self.df[SET_ENERGY_PER_CELL + "{}".format(year)]  # kWh/year
-        average_load = consumption / (1 - grid_calc.distribution_losses) / HOURS_PER_YEAR  # kW
-        peak_load = average_load / grid_calc.base_to_peak_load_ratio  # kW
-        peak_load.loc[grid_lcoe >= min_code_lcoes] = 0
+        Arguments
+        ---------
+        candidates : numpy.ndarray, optional
+            Sorted positions of the settlements evaluated in this round. If given, grid_lcoe, dist, dist_adjusted,
+            prev_dist, new_elec_order, grid_investment and grid_capacity only cover these settlements, and the
+            arrays covering all settlements (elecorder, new_lcoes, cell_path_real, cell_path_adjusted, electrified,
+            new_investment and new_capacity) are updated in place. Otherwise all settlements are evaluated.
+        state : SettlementState, optional
+            The columns of the year, read from the data frame if not given
+        """
+        if state is None:
+            state = SettlementState(self.df, year)
+
+        if candidates is None:
+            candidates = np.arange(len(self.df))
+            elecorder = np.array(elecorder)
+            new_lcoes = np.array(new_lcoes, dtype=float)
+            cell_path_real = np.array(cell_path_real, dtype=float)
+            cell_path_adjusted = np.array(cell_path_adjusted, dtype=float)
+            electrified = np.array(electrified)
+            new_investment = np.array(new_investment, dtype=float).reshape(-1)
+            new_capacity = np.array(new_capacity, dtype=float).reshape(-1)
+
+        grid_lcoe = np.array(grid_lcoe, dtype=float)
+        dist = np.asarray(dist)
+        dist_adjusted = np.asarray(dist_adjusted)
+        prev_dist = np.broadcast_to(prev_dist, grid_lcoe.shape)
+        new_elec_order = np.broadcast_to(new_elec_order, grid_lcoe.shape)
+
+        min_code_lcoes = state.min_offgrid_lcoe[candidates]
+
+        grid_lcoe[electrified[candidates] == 1] = 99
+        grid_lcoe[prev_dist + dist_adjusted > max_dist] = 99
+        grid_lcoe[grid_lcoe > new_lcoes[candidates]] = 99
+        peak_load = state.peak_load(grid_calc, candidates)  # kW
+        peak_load[grid_lcoe >= min_code_lcoes] = 0
         peak_load_cum_sum = np.cumsum(peak_load)
-        grid_lcoe.loc[peak_load_cum_sum > grid_capacity_limit] = 99
-        new_grid_connections = self.df[SET_NEW_CONNECTIONS + "{}".format(year)] / self.df[SET_NUM_PEOPLE_PER_HH]
-        new_grid_connections.loc[grid_lcoe >= min_code_lcoes] = 0
+        grid_lcoe[peak_load_cum_sum > grid_capacity_limit] = 99
+        new_grid_connections = state.new_grid_connections(candidates)
+        new_grid_connections[grid_lcoe >= min_code_lcoes] = 0
         new_grid_connections_cum_sum = np.cumsum(new_grid_connections)
-        grid_lcoe.loc[new_grid_connections_cum_sum > grid_connect_limit] = 99
+        grid_lcoe[new_grid_connections_cum_sum > grid_connect_limit] = 99
+
+        connected = grid_lcoe < min_code_lcoes
 
         # Update limiting values
-        grid_capacity_limit -= peak_load.loc[grid_lcoe < min_code_lcoes].sum()
-        grid_connect_limit -= new_grid_connections.loc[grid_lcoe < min_code_lcoes].sum()
+        grid_capacity_limit -= peak_load[connected].sum()
+        grid_connect_limit -= new_grid_connections[connected].sum()
 
         # Update values for settlements that meet conditions
-        cell_path_real = np.where(grid_lcoe < min_code_lcoes, prev_dist + dist, cell_path_real)
-        cell_path_adjusted = np.where(grid_lcoe < min_code_lcoes, dist_adjusted, cell_path_adjusted)
-        elecorder = np.where(grid_lcoe < min_code_lcoes, new_elec_order, elecorder)
-        electrified = np.where(grid_lcoe < min_code_lcoes, 1, electrified)
-        new_lcoes = np.where(grid_lcoe < min_code_lcoes, grid_lcoe, new_lcoes)
-        new_investment = np.where(grid_lcoe < min_code_lcoes, grid_investment, new_investment)
-        new_capacity = np.where(grid_lcoe < min_code_lcoes, grid_capacity, new_capacity)
+        positions = candidates[connected]
+        cell_path_real[positions] = (prev_dist + dist)[connected]
+        cell_path_adjusted[positions] = dist_adjusted[connected]
+        elecorder[positions] = new_elec_order[connected]
+        electrified[positions] = 1
+        new_lcoes[positions] = grid_lcoe[connected]
+        new_investment[positions] = np.asarray(grid_investment)[connected]
+        new_capacity[positions] = np.asarray(grid_capacity)[connected]
 
         return grid_capacity_limit, grid_connect_limit, cell_path_real, cell_path_adjusted, elecorder, \
                electrified, new_lcoes, new_investment, new_capacity
@@ -1488,12 +2716,6 @@ class SettlementProcessor:
         r = 6371  # Radius of earth in kilometers. Use 3956 for miles
         return c * r
 
-    @staticmethod
-    def do_kdtree(combined_x_y_arrays, points):
-        mytree = scipy.spatial.cKDTree(combined_x_y_arrays)
-        dist, indexes = mytree.query(points)
-        return indexes
-
     def calculate_new_connections(self, year, time_step, start_year):
         """this method defines new connections for grid related purposes
 
@@ -1671,53 +2893,74 @@ class SettlementProcessor:
         self.set_residential_demand(rural_tier, urban_tier, num_people_per_hh_rural, num_people_per_hh_urban,
                                     productive_demand)
         self.calculate_total_demand_per_settlement(year)
+        self.enforce_schema()
+
+    def chunked_lcoe(self, technology, **kwargs):
+        """Calls ``technology.get_lcoe`` on ``chunk_rows`` settlements at a time, if that is set
+
+        The LCOE of a settlement only depends on its own row, so the result is the same as that of a single call,
+        while the temporaries of the calculation only take up memory for one chunk.
+        """
+        if self.chunk_rows is None or len(self.df) <= self.chunk_rows:
+            return technology.get_lcoe(**kwargs)
+        results = []
+        for start in range(0, len(self.df), self.chunk_rows):
+            rows = slice(start, start + self.chunk_rows)
+            results.append(technology.get_lcoe(**{name: value.iloc[rows] if isinstance(value, pd.Series) else value
+                                                  for name, value in kwargs.items()}))
+        return tuple(np.concatenate(parts) for parts in zip(*results))
 
     def calculate_off_grid_lcoes(self, mg_hydro_calc, mg_wind_calc, mg_pv_calc, sa_pv_calc, mg_diesel_calc,
-                                 sa_diesel_calc, year, end_year, time_step, techs, tech_codes, diesel_techs=0):
+                                 sa_diesel_calc, year, end_year, time_step, techs, tech_codes, diesel_techs=0,
+                                 hydro_allocation='dataframe'):
         """
         Calculate the LCOEs for all off-grid technologies
 
+        hydro_allocation is the order in which the capacity of hydro-power sites is allocated, see limit_hydro_usage
         """
 
         logging.info('Calculate minigrid hydro LCOE')
         self.df[SET_LCOE_MG_HYDRO + "{}".format(year)], mg_hydro_investment, mg_hydro_capacity = \
-            mg_hydro_calc.get_lcoe(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
-                                   start_year=year - time_step,
-                                   end_year=end_year,
-                                   people=self.df[SET_POP + "{}".format(year)],
-                                   new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
-                                   total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
-                                   prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
-                                   num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
-                                   grid_cell_area=self.df[SET_GRID_CELL_AREA],
-                                   additional_mv_line_length=self.df[SET_HYDRO_DIST],
-                                   capacity_factor=mg_hydro_calc.capacity_factor)
+            self.chunked_lcoe(mg_hydro_calc,
+                              energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
+                              start_year=year - time_step,
+                              end_year=end_year,
+                              people=self.df[SET_POP + "{}".format(year)],
+                              new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
+                              total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
+                              prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
+                              num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
+                              grid_cell_area=self.df[SET_GRID_CELL_AREA],
+                              additional_mv_line_length=self.df[SET_HYDRO_DIST],
+                              capacity_factor=mg_hydro_calc.capacity_factor)
 
         logging.info('Calculate minigrid PV LCOE')
         self.df[SET_LCOE_MG_PV + "{}".format(year)], mg_pv_investment, mg_pv_capacity = \
-            mg_pv_calc.get_lcoe(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
-                                start_year=year - time_step,
-                                end_year=end_year,
-                                people=self.df[SET_POP + "{}".format(year)],
-                                new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
-                                total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
-                                prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
-                                num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
-                                grid_cell_area=self.df[SET_GRID_CELL_AREA],
-                                capacity_factor=self.df[SET_GHI] / HOURS_PER_YEAR)
+            self.chunked_lcoe(mg_pv_calc,
+                              energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
+                              start_year=year - time_step,
+                              end_year=end_year,
+                              people=self.df[SET_POP + "{}".format(year)],
+                              new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
+                              total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
+                              prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
+                              num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
+                              grid_cell_area=self.df[SET_GRID_CELL_AREA],
+                              capacity_factor=self.df[SET_GHI] / HOURS_PER_YEAR)
 
         logging.info('Calculate minigrid wind LCOE')
         self.df[SET_LCOE_MG_WIND + "{}".format(year)], mg_wind_investment, mg_wind_capacity = \
-            mg_wind_calc.get_lcoe(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
-                                  start_year=year - time_step,
-                                  end_year=end_year,
-                                  people=self.df[SET_POP + "{}".format(year)],
-                                  new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
-                                  total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
-                                  prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
-                                  num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
-                                  grid_cell_area=self.df[SET_GRID_CELL_AREA],
-                                  capacity_factor=self.df[SET_WINDCF])
+            self.chunked_lcoe(mg_wind_calc,
+                              energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
+                              start_year=year - time_step,
+                              end_year=end_year,
+                              people=self.df[SET_POP + "{}".format(year)],
+                              new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
+                              total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
+                              prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
+                              num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
+                              grid_cell_area=self.df[SET_GRID_CELL_AREA],
+                              capacity_factor=self.df[SET_WINDCF])
 
         if diesel_techs == 0:
             self.df[SET_LCOE_MG_DIESEL + "{}".format(year)] = 99
@@ -1729,52 +2972,55 @@ class SettlementProcessor:
         else:
             logging.info('Calculate minigrid diesel LCOE')
             self.df[SET_LCOE_MG_DIESEL + "{}".format(year)], mg_diesel_investment, mg_diesel_capacity = \
-                mg_diesel_calc.get_lcoe(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
-                                        start_year=year - time_step,
-                                        end_year=end_year,
-                                        people=self.df[SET_POP + "{}".format(year)],
-                                        new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
-                                        total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
-                                        prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
-                                        num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
-                                        grid_cell_area=self.df[SET_GRID_CELL_AREA],
-                                        fuel_cost=self.df[SET_MG_DIESEL_FUEL + "{}".format(year)],
-                                        capacity_factor=mg_diesel_calc.capacity_factor)
+                self.chunked_lcoe(mg_diesel_calc,
+                                  energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
+                                  start_year=year - time_step,
+                                  end_year=end_year,
+                                  people=self.df[SET_POP + "{}".format(year)],
+                                  new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
+                                  total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
+                                  prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
+                                  num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
+                                  grid_cell_area=self.df[SET_GRID_CELL_AREA],
+                                  fuel_cost=self.df[SET_MG_DIESEL_FUEL + "{}".format(year)],
+                                  capacity_factor=mg_diesel_calc.capacity_factor)
 
             logging.info('Calculate standalone diesel LCOE')
             self.df[SET_LCOE_SA_DIESEL + "{}".format(year)], sa_diesel_investment, sa_diesel_capacity = \
-                sa_diesel_calc.get_lcoe(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
-                                        start_year=year - time_step,
-                                        end_year=end_year,
-                                        people=self.df[SET_POP + "{}".format(year)],
-                                        new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
-                                        total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
-                                        prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
-                                        num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
-                                        grid_cell_area=self.df[SET_GRID_CELL_AREA],
-                                        fuel_cost=self.df[SET_SA_DIESEL_FUEL + "{}".format(year)],
-                                        capacity_factor=sa_diesel_calc.capacity_factor)
+                self.chunked_lcoe(sa_diesel_calc,
+                                  energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
+                                  start_year=year - time_step,
+                                  end_year=end_year,
+                                  people=self.df[SET_POP + "{}".format(year)],
+                                  new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
+                                  total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
+                                  prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
+                                  num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
+                                  grid_cell_area=self.df[SET_GRID_CELL_AREA],
+                                  fuel_cost=self.df[SET_SA_DIESEL_FUEL + "{}".format(year)],
+                                  capacity_factor=sa_diesel_calc.capacity_factor)
 
         logging.info('Calculate standalone PV LCOE')
         self.df[SET_LCOE_SA_PV + "{}".format(year)], sa_pv_investment, sa_pv_capacity = \
-            sa_pv_calc.get_lcoe(energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
-                                start_year=year - time_step,
-                                end_year=end_year,
-                                people=self.df[SET_POP + "{}".format(year)],
-                                new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
-                                total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
-                                prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
-                                num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
-                                grid_cell_area=self.df[SET_GRID_CELL_AREA],
-                                capacity_factor=self.df[SET_GHI] / HOURS_PER_YEAR)
-
-        self.choose_minimum_off_grid_tech(year, mg_hydro_calc, techs, tech_codes)
+            self.chunked_lcoe(sa_pv_calc,
+                              energy_per_cell=self.df[SET_ENERGY_PER_CELL + "{}".format(year)],
+                              start_year=year - time_step,
+                              end_year=end_year,
+                              people=self.df[SET_POP + "{}".format(year)],
+                              new_connections=self.df[SET_NEW_CONNECTIONS + "{}".format(year)],
+                              total_energy_per_cell=self.df[SET_TOTAL_ENERGY_PER_CELL],
+                              prev_code=self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)],
+                              num_people_per_hh=self.df[SET_NUM_PEOPLE_PER_HH],
+                              grid_cell_area=self.df[SET_GRID_CELL_AREA],
+                              capacity_factor=self.df[SET_GHI] / HOURS_PER_YEAR)
+
+        self.choose_minimum_off_grid_tech(year, mg_hydro_calc, techs, tech_codes, hydro_allocation)
 
         return sa_diesel_investment, sa_diesel_capacity, sa_pv_investment, sa_pv_capacity, mg_diesel_investment, \
                mg_diesel_capacity, mg_pv_investment, mg_pv_capacity, mg_wind_investment, mg_wind_capacity, \
                mg_hydro_investment, mg_hydro_capacity
 
-    def choose_minimum_off_grid_tech(self, year, mg_hydro_calc, techs, tech_codes):
+    def choose_minimum_off_grid_tech(self, year, mg_hydro_calc, techs, tech_codes, hydro_allocation='dataframe'):
         """Choose minimum LCOE off-grid technology
 
         First step determines the off-grid technology with minimum LCOE
@@ -1784,6 +3030,8 @@ class SettlementProcessor:
         ---------
         year : int
         mg_hydro_calc : dict
+        hydro_allocation : str
+            Order in which the capacity of hydro-power sites is allocated, see limit_hydro_usage
         """
         off_grid_techs = techs.copy()
         del off_grid_techs[0]
@@ -1792,43 +3040,95 @@ class SettlementProcessor:
         off_grid_tech_codes = tech_codes.copy()
         del off_grid_tech_codes[0]
 
-        logging.info('Determine minimum technology (off-grid)')
-        self.df[SET_MIN_OFFGRID + "{}".format(year)] = self.df[off_grid_techs].T.idxmin()
-
         logging.info('Ensure hydro-power is not over-utilized')
-        self.limit_hydro_usage(mg_hydro_calc, year)
+        alternatives = [tech for tech in techs[1:] if tech != SET_LCOE_MG_HYDRO]
+        self.limit_hydro_usage(mg_hydro_calc, year, hydro_allocation, alternatives)
 
-        self.df[SET_MIN_OFFGRID + "{}".format(year)] = self.df[off_grid_techs].T.idxmin()
+        logging.info('Determine minimum technology (off-grid)')
+        choice, min_lcoe = self.least_cost_technology(self.df[off_grid_techs])
+        self.df[SET_MIN_OFFGRID + "{}".format(year)] = pd.Categorical.from_codes(choice, off_grid_techs)
 
         logging.info('Determine minimum off-grid tech LCOE')
-        self.df[SET_MIN_OFFGRID_LCOE + "{}".format(year)] = self.df[off_grid_techs].T.min()
+        self.df[SET_MIN_OFFGRID_LCOE + "{}".format(year)] = min_lcoe
 
         # Add code numbers reflecting minimum off-grid technology code
-        for i in range(len(off_grid_techs)):
-            self.df.loc[self.df[SET_MIN_OFFGRID + "{}".format(year)] == off_grid_techs[i],
-                        SET_MIN_OFFGRID_CODE + "{}".format(year)] = off_grid_tech_codes[i]
-
-    def limit_hydro_usage(self, mg_hydro_calc, year):
-        # A df with all hydro-power sites, to ensure that they aren't assigned more capacity than is available
-        hydro_used = 'HydropowerUsed'  # the amount of the hydro potential that has been assigned
-        hydro_lcoe = self.df[SET_LCOE_MG_HYDRO + "{}".format(year)].copy()
-        hydro_df = self.df[[SET_HYDRO_FID, SET_HYDRO]].drop_duplicates(subset=SET_HYDRO_FID)
-        hydro_df[hydro_used] = 0
-        hydro_df = hydro_df.set_index(SET_HYDRO_FID)
+        self.df[SET_MIN_OFFGRID_CODE + "{}".format(year)] = self.technology_codes(choice, off_grid_tech_codes)
+        self.enforce_schema()
+
+    @staticmethod
+    def least_cost_technology(lcoes):
+        """Finds the technology with the lowest LCOE of each settlement
+
+        Arguments
+        ---------
+        lcoes : pandas.DataFrame or numpy.ndarray
+            LCOE of each settlement (rows) and technology (columns)
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            The column of the lowest LCOE of each settlement, or -1 where all LCOEs are missing, and the lowest LCOE
+        """
+        lcoes = np.ascontiguousarray(lcoes, dtype=float)
+        missing = np.isnan(lcoes)
+        choice = np.argmin(np.where(missing, np.inf, lcoes), axis=1)
+        min_lcoe = np.take_along_axis(lcoes, choice[:, np.newaxis], axis=1)[:, 0]
+        choice[missing.all(axis=1)] = -1
+        return choice, min_lcoe
+
+    @staticmethod
+    def technology_codes(choice, tech_codes):
+        """Maps the columns chosen by least_cost_technology to technology codes, NaN where there was no choice"""
+        codes = np.asarray(tech_codes, dtype=float)[choice]
+        codes[choice < 0] = np.nan
+        return codes
+
+    def limit_hydro_usage(self, mg_hydro_calc, year, allocation='dataframe', alternatives=None):
+        """Ensures that hydro-power sites aren't assigned more capacity than is available
+
+        The capacity of each site is allocated to the settlements within max_hydro_dist of it, in the order of the
+        data frame or, if allocation is 'advantage', starting with the settlements where mini-grid hydro has the
+        largest LCOE advantage over the alternatives. Settlements beyond the capacity of their site are not
+        assigned hydro-power. All sites are handled together in one grouped pass.
+
+        Arguments
+        ---------
+        mg_hydro_calc : Technology
+        year : int
+        allocation : str
+            'dataframe' or 'advantage'
+        alternatives : list, optional
+            LCOE columns (without the year) that hydro is compared with when allocation is 'advantage'. Defaults to
+            the other off-grid technologies
+        """
         max_hydro_dist = 5  # the max distance in km to consider hydropower viable
+        hydro_lcoe = self.df[SET_LCOE_MG_HYDRO + "{}".format(year)].values.astype(float)
         additional_capacity = (
-                (self.df[SET_ENERGY_PER_CELL + "{}".format(year)]) /
+                (self.df[SET_ENERGY_PER_CELL + "{}".format(year)].values) /
                 (HOURS_PER_YEAR * mg_hydro_calc.capacity_factor * mg_hydro_calc.base_to_peak_load_ratio *
                  (1 - mg_hydro_calc.distribution_losses)))
 
-        for index, row in hydro_df.iterrows():
-            hydro_usage = additional_capacity.loc[(self.df[SET_HYDRO_FID] == index) &
-                                                  (self.df[SET_HYDRO_DIST] < max_hydro_dist)].sum()
-            if hydro_usage > hydro_df[SET_HYDRO][index]:
-                hydro_usage_cumsum = additional_capacity.loc[(self.df[SET_HYDRO_FID] == index) &
-                                                             (self.df[SET_HYDRO_DIST] < max_hydro_dist)].cumsum()
-                hydro_usage = hydro_usage_cumsum.loc[hydro_usage_cumsum > hydro_df[SET_HYDRO][index]]
-                hydro_lcoe[hydro_usage.index] = 99
+        # A site's capacity is taken from the first settlement it appears in
+        site_capacity = self.df.groupby(SET_HYDRO_FID)[SET_HYDRO].transform('first').values
+        positions = np.flatnonzero((self.df[SET_HYDRO_DIST] < max_hydro_dist).values &
+                                   self.df[SET_HYDRO_FID].notna().values)
+
+        if allocation == 'advantage':
+            if alternatives is None:
+                alternatives = [SET_LCOE_SA_PV, SET_LCOE_SA_DIESEL, SET_LCOE_MG_PV, SET_LCOE_MG_WIND,
+                                SET_LCOE_MG_DIESEL]
+            alternative_lcoe = self.df[[column + "{}".format(year) for column in alternatives]].min(axis=1).values
+            advantage = alternative_lcoe[positions] - hydro_lcoe[positions]
+            positions = positions[np.argsort(-advantage, kind='stable')]
+        elif allocation != 'dataframe':
+            raise ValueError("Unknown hydro allocation '{}'".format(allocation))
+
+        usage = pd.Series(additional_capacity[positions])
+        sites = self.df[SET_HYDRO_FID].values[positions]
+        hydro_usage = usage.groupby(sites).transform('sum').values
+        hydro_usage_cumsum = usage.groupby(sites).cumsum().values
+        over_allocated = (hydro_usage > site_capacity[positions]) & (hydro_usage_cumsum > site_capacity[positions])
+        hydro_lcoe[positions[over_allocated]] = 99
 
         self.df[SET_LCOE_MG_HYDRO + "{}".format(year)] = hydro_lcoe
 
@@ -1849,140 +3149,233 @@ class SettlementProcessor:
         all_techs = [x + str(year) for x in techs]
 
         logging.info('Determine minimum overall tech')
-        self.df[SET_MIN_OVERALL + "{}".format(year)] = self.df[all_techs].T.idxmin()
+        choice, min_lcoe = self.least_cost_technology(self.df[all_techs])
+        grid = all_techs.index(SET_LCOE_GRID + "{}".format(year))
 
         # Ensure what is grid-connected in previous time-step remains grid-connected
-        self.df.loc[self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)] == 1,
-                    SET_MIN_OVERALL + "{}".format(year)] = 'Grid' + "{}".format(year)
+        choice[self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)].values == 1] = grid
 
         # Ensure settlements within intensification distance are grid-connected
         if (prio == 2) or (prio == 4):
-            self.df.loc[(self.df[SET_MV_DIST_PLANNED] < auto_intensification) &
-                        (self.df[SET_LCOE_GRID + "{}".format(year)] != 99),
-                        SET_MIN_OVERALL + "{}".format(year)] = 'Grid' + "{}".format(year)
+            choice[(self.df[SET_MV_DIST_PLANNED].values < auto_intensification) &
+                   (self.df[SET_LCOE_GRID + "{}".format(year)].values != 99)] = grid
+
+        self.df[SET_MIN_OVERALL + "{}".format(year)] = pd.Categorical.from_codes(choice, all_techs)
 
         logging.info('Determine minimum overall LCOE')
-        self.df[SET_MIN_OVERALL_LCOE + "{}".format(year)] = self.df[all_techs].T.min()
+        self.df[SET_MIN_OVERALL_LCOE + "{}".format(year)] = min_lcoe
 
-        for i in range(len(techs)):
-            self.df.loc[self.df[SET_MIN_OVERALL + "{}".format(year)] == all_techs[i],
-                        SET_MIN_OVERALL_CODE + "{}".format(year)] = tech_codes[i]
+        self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] = self.technology_codes(choice, tech_codes)
+        self.enforce_schema()
 
     def calculate_investments_and_capacity(self, sa_diesel_investment, sa_diesel_capacity, sa_pv_investment,
                                            sa_pv_capacity, mg_diesel_investment, mg_diesel_capacity, mg_pv_investment,
                                            mg_pv_capacity, mg_wind_investment, mg_wind_capacity, mg_hydro_investment,
                                            mg_hydro_capacity, grid_investment, grid_capacity, year):
 
-        grid = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 1, 1, 0))
-        sa_diesel = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 2, 1, 0))
-        sa_pv = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 3, 1, 0))
-        mg_diesel = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 4, 1, 0))
-        mg_pv = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 5, 1, 0))
-        mg_wind = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 6, 1, 0))
-        mg_hydro = pd.DataFrame(np.where(self.df[SET_MIN_OVERALL_CODE + "{}".format(year)] == 7, 1, 0))
+        min_overall_code = SettlementState(self.df, year).min_overall_code
 
-        logging.info('Calculate investment cost')
-
-        self.df[SET_INVESTMENT_COST + "{}".format(year)] = 0
+        def by_technology(grid, sa_diesel, sa_pv, mg_diesel, mg_pv, mg_wind, mg_hydro):
+            """Takes the value of the technology with the minimum overall code 1 to 7 of each settlement"""
+            values = [np.where(min_overall_code == code, 1, 0) * np.asarray(value, dtype=float).reshape(-1)
+                      for code, value in enumerate([grid, sa_diesel, sa_pv, mg_diesel, mg_pv, mg_wind, mg_hydro],
+                                                   start=1)]
+            total = values[0]
+            for value in values[1:]:
+                total = total + value
+            return total
 
-        self.df[SET_INVESTMENT_COST + "{}".format(year)] = grid * grid_investment + sa_diesel * sa_diesel_investment + \
-                                                           sa_pv * sa_pv_investment + mg_diesel * mg_diesel_investment + mg_pv * mg_pv_investment + \
-                                                           mg_wind * mg_wind_investment + mg_hydro * mg_hydro_investment
+        logging.info('Calculate investment cost')
+        self.df[SET_INVESTMENT_COST + "{}".format(year)] = \
+            by_technology(grid_investment, sa_diesel_investment, sa_pv_investment, mg_diesel_investment,
+                          mg_pv_investment, mg_wind_investment, mg_hydro_investment)
 
         logging.info('Calculate new capacity')
-        self.df[SET_NEW_CAPACITY + "{}".format(year)] = 0
-
-        self.df[SET_NEW_CAPACITY + "{}".format(year)] = grid * grid_capacity + sa_diesel * sa_diesel_capacity + \
-                                                        sa_pv * sa_pv_capacity + mg_diesel * mg_diesel_capacity + mg_pv * mg_pv_capacity + \
-                                                        mg_wind * mg_wind_capacity + mg_hydro * mg_hydro_capacity
+        self.df[SET_NEW_CAPACITY + "{}".format(year)] = \
+            by_technology(grid_capacity, sa_diesel_capacity, sa_pv_capacity, mg_diesel_capacity, mg_pv_capacity,
+                          mg_wind_capacity, mg_hydro_capacity)
 
     def apply_limitations(self, eleclimit, year, time_step, prioritization, auto_densification=0):
 
         logging.info('Determine electrification limits')
         choice = int(prioritization)
-        self.df[SET_LIMIT + "{}".format(year)] = 0
+        state = SettlementState(self.df, year, time_step)
+        limit = np.zeros(len(self.df), dtype=int)
 
         # Calculate the total population targeted to be electrified
-        elec_target_pop = eleclimit * self.df[SET_POP + "{}".format(year)].sum()
+        elec_target_pop = eleclimit * np.nansum(state.pop)
 
-        # Adding a column with investment/capita
-        self.df[SET_INVEST_PER_CAPITA + "{}".format(year)] = \
-            self.df[SET_INVESTMENT_COST + "{}".format(year)] / self.df[SET_NEW_CONNECTIONS + "{}".format(year)]
+        # Investment/capita
+        with np.errstate(divide='ignore', invalid='ignore'):
+            invest_per_capita = state.investment_cost / state.new_connections
 
         if choice == 4:
             # Choose only already electrified settlements and settlements within intensification target range,
             # regardless of target electrification rate
-            self.df.loc[(self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)] < 99),
-                        SET_LIMIT + "{}".format(year)] = 1
-            self.df.loc[self.df[SET_MV_DIST_PLANNED] < auto_densification, SET_LIMIT + "{}".format(year)] = 1
+            limit[state.prev_code < 99] = 1
+            limit[state.mv_dist_planned < auto_densification] = 1
 
         elif eleclimit == 1:
             # If electrification target rate is 100%, set all settlements to electrified
-            self.df[SET_LIMIT + "{}".format(year)] = 1
-
-        elif choice == 2:
-            # Prioritize already electrified settlements, then intensification, then lowest investment per capita
+            limit[:] = 1
+
+        elif choice in (2, 5):
+            # Prioritize already electrified settlements, then (for 2) intensification, then lowest investment per
+            # capita. The sort is stable, so ties keep the order of the settlements
+            if choice == 2:
+                intensification = np.where(state.mv_dist_planned < auto_densification, 1, 0)
+                order = np.lexsort((invest_per_capita, intensification, state.prev_code))
+            else:
+                order = np.lexsort((invest_per_capita, state.prev_code))
 
-            self.df['Intensification'] = np.where(self.df[SET_MV_DIST_PLANNED] < auto_densification, 1, 0)
+            cumulative_pop = np.cumsum(state.pop[order])
+            limit[order] = np.where(cumulative_pop < elec_target_pop, 1, 0)
 
-            self.df.sort_values(by=[SET_ELEC_FINAL_CODE + "{}".format(year - time_step),
-                                    'Intensification',
-                                    SET_INVEST_PER_CAPITA + "{}".format(year)], inplace=True)
+            # Ensure already electrified settlements remain electrified
+            limit[state.prev_code < 99] = 1
 
-            cumulative_pop = self.df[SET_POP + "{}".format(year)].cumsum()
+        elecrate = np.nansum(state.pop[limit == 1]) / np.nansum(state.pop)
 
-            self.df[SET_LIMIT + "{}".format(year)] = np.where(cumulative_pop < elec_target_pop, 1, 0)
+        logging.info('Determine final electrification decision')
+        final_code = state.min_overall_code.copy()
+        final_code[limit == 0] = 99
+        investment_cost = state.investment_cost.copy()
+        investment_cost[limit == 0] = 0
+        new_capacity = self.df[SET_NEW_CAPACITY + "{}".format(year)].to_numpy().copy()
+        new_capacity[limit == 0] = 0
+
+        self.df[SET_LIMIT + "{}".format(year)] = limit
+        self.df[SET_INVEST_PER_CAPITA + "{}".format(year)] = invest_per_capita
+        self.df[SET_ELEC_FINAL_CODE + "{}".format(year)] = final_code
+        self.df[SET_INVESTMENT_COST + "{}".format(year)] = investment_cost
+        self.df[SET_NEW_CAPACITY + "{}".format(year)] = new_capacity
+        self.enforce_schema()
 
-            del self.df['Intensification']
+        print("The electrification rate achieved in {} is {:.1f} %".format(year, elecrate * 100))
 
-            self.df.sort_index(inplace=True)
+    def calc_summaries(self, df_summary, sumtechs, tech_codes, year):
 
-            # Ensure already electrified settlements remain electrified
-            self.df.loc[(self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)] < 99),
-                        SET_LIMIT + "{}".format(year)] = 1
+        """The next section calculates the summaries for technology split,
+        capacity added and total investment cost"""
 
-        elif choice == 5:
-            # Prioritize already electrified settlements first, then lowest investment per capita
-            self.df.sort_values(by=[SET_ELEC_FINAL_CODE + "{}".format(year - time_step),
-                                    SET_INVEST_PER_CAPITA + "{}".format(year)], inplace=True)
+        logging.info('Calculate summaries')
 
-            cumulative_pop = self.df[SET_POP + "{}".format(year)].cumsum()
+        summaries = [SET_POP, SET_NEW_CONNECTIONS, SET_NEW_CAPACITY, SET_INVESTMENT_COST]
 
-            self.df[SET_LIMIT + "{}".format(year)] = np.where(cumulative_pop < elec_target_pop, 1, 0)
+        summary = self.summarise(year, tech_codes, summaries)
+        df_summary[year] = pd.Series(summary.values.T.ravel(), index=sumtechs)
 
-            self.df.sort_index(inplace=True)
+    def summarise(self, year, tech_codes, summaries=None, by=None):
+        """Sums the summary quantities of the settlements electrified by each technology in one pass
 
-            # Ensure already electrified settlements remain electrified
-            self.df.loc[(self.df[SET_ELEC_FINAL_CODE + "{}".format(year - time_step)] < 99),
-                        SET_LIMIT + "{}".format(year)] = 1
+        Arguments
+        ---------
+        year : int
+        tech_codes : list
+            Codes of the technologies, as in SET_ELEC_FINAL_CODE
+        summaries : list, optional
+            Columns (without the year) to sum. Defaults to population, new connections, capacity and investment
+        by : str, optional
+            Column to break the summaries down by, e.g. SET_URBAN, SET_TIER or an administrative region
 
-        elecrate = self.df.loc[self.df[SET_LIMIT + "{}".format(year)] == 1,
-                               SET_POP + "{}".format(year)].sum() / self.df[SET_POP + "{}".format(year)].sum()
+        Returns
+        -------
+        pandas.DataFrame
+            One column per summary quantity and one row per technology code, or per value of by and technology
+            code if by is given
+        """
+        if summaries is None:
+            summaries = [SET_POP, SET_NEW_CONNECTIONS, SET_NEW_CAPACITY, SET_INVESTMENT_COST]
+
+        tech_codes = np.asarray(tech_codes)
+        final_code = self.df[SET_ELEC_FINAL_CODE + "{}".format(year)].values
+        tech = np.searchsorted(np.sort(tech_codes), final_code)
+        tech = np.argsort(tech_codes)[np.minimum(tech, len(tech_codes) - 1)]
+        included = (tech_codes[tech] == final_code) & (self.df[SET_LIMIT + "{}".format(year)].values == 1)
+
+        if by is None:
+            groups = tech
+            index = pd.Index(tech_codes, name=SET_ELEC_FINAL_CODE)
+        else:
+            group_values, categories = pd.factorize(self.df[by], sort=True)
+            included &= group_values >= 0
+            groups = group_values * len(tech_codes) + tech
+            index = pd.MultiIndex.from_product([categories, tech_codes], names=[by, SET_ELEC_FINAL_CODE])
 
-        logging.info('Determine final electrification decision')
-        self.df[SET_ELEC_FINAL_CODE + "{}".format(year)] = self.df[SET_MIN_OVERALL_CODE + "{}".format(year)]
-        self.df.loc[(self.df[SET_LIMIT + "{}".format(year)] == 0), SET_ELEC_FINAL_CODE + "{}".format(year)] = 99
-        self.df.loc[(self.df[SET_LIMIT + "{}".format(year)] == 0), SET_INVESTMENT_COST + "{}".format(year)] = 0
-        self.df.loc[(self.df[SET_LIMIT + "{}".format(year)] == 0), SET_NEW_CAPACITY + "{}".format(year)] = 0
+        groups = groups[included]
+        summary = {s: np.bincount(groups, weights=self.df[s + "{}".format(year)].values[included],
+                                  minlength=len(index)) for s in summaries}
+        return pd.DataFrame(summary, index=index)
 
-        print("The electrification rate achieved in {} is {:.1f} %".format(year, elecrate * 100))
+    @staticmethod
+    def is_output(column, output_columns=None, years=()):
+        """Whether a column is to be written to the results
 
-    def calc_summaries(self, df_summary, sumtechs, tech_codes, year):
+        Arguments
+        ---------
+        column : str
+        output_columns : list, optional
+            Column names, or for yearly columns the names without the year. By default all columns are output.
+        years : list, optional
+            The years of the yearly columns. Only these are taken off the end of a name, so that e.g.
+            ResidentialDemandTier1 is not output along with ResidentialDemandTier.
+        """
+        if output_columns is None or column in output_columns:
+            return True
+        return any(column.endswith(str(year)) and column[:-len(str(year))] in output_columns for year in years)
 
-        """The next section calculates the summaries for technology split,
-        capacity added and total investment cost"""
+    def note_column_order(self):
+        """Appends the columns of df that are not yet in column_order"""
+        known = set(self.column_order)
+        self.column_order += [column for column in self.df.columns if column not in known]
 
-        logging.info('Calculate summaries')
+    def retire_year_columns(self, year, time_step, output_columns=None):
+        """Moves the yearly columns that later years no longer read out of df
 
-        i = 0
+        At the end of a year, these are the columns of the year, except for the ``SETTLEMENT_YEAR_CARRIED`` ones, and
+        the carried columns of the year before. This keeps df, and the cost of every column the stages add to it,
+        down to about one year of columns. Retired columns that are to be output are kept in year_columns until
+        ``output_frame`` puts them back; the others are freed.
 
-        summaries = [SET_POP, SET_NEW_CONNECTIONS, SET_NEW_CAPACITY, SET_INVESTMENT_COST]
+        Arguments
+        ---------
+        year : int
+        time_step : int
+        output_columns : list, optional
+            See ``is_output``
+        """
+        self.note_column_order()
+        retired = {}
+        for retired_year, carried in ((year, False), (year - time_step, True)):
+            suffix = str(retired_year)
+            for column in self.df.columns:
+                stem = column[:-len(suffix)]
+                if column.endswith(suffix) and stem and (stem in SETTLEMENT_YEAR_CARRIED) == carried:
+                    retired[column] = retired_year
+
+        for column, retired_year in retired.items():
+            if self.is_output(column, output_columns, [retired_year]):
+                # A copy, so that the dropped columns do not stay alive in the same block
+                self.year_columns.setdefault(retired_year, {})[column] = self.df[column].copy()
+        self.df = self.df.drop(columns=list(retired))
+
+    def output_frame(self, output_columns=None, years=()):
+        """Returns the settlements with the retired yearly columns put back, in the order the columns were added
 
-        # Population Summaries
-        for s in summaries:
-            for t in tech_codes:
-                df_summary[year][sumtechs[i]] = sum(
-                    self.df.loc[(self.df[SET_ELEC_FINAL_CODE + "{}".format(year)] == t) &
-                                (self.df[SET_LIMIT + "{}".format(year)] == 1)]
-                    [s + "{}".format(year)])
-                i += 1
+        Arguments
+        ---------
+        output_columns : list, optional
+        years : list, optional
+            See ``is_output``
+        """
+        self.note_column_order()
+        retired = {column: values for columns in self.year_columns.values() for column, values in columns.items()}
+        data = {}
+        for column in self.column_order:
+            if not self.is_output(column, output_columns, years):
+                continue
+            if column in self.df:
+                data[column] = self.df[column]
+            elif column in retired:
+                data[column] = retired[column]
+        return pd.DataFrame(data, index=self.df.index)
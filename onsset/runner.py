@@ -1,13 +1,29 @@
 # Defines the modules
 
+import hashlib
+import json
 import logging
 import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from shutil import copyfile, rmtree
+from tempfile import TemporaryDirectory
 
+import numpy as np
 import pandas as pd
-from onsset import (SET_ELEC_ORDER, SET_LCOE_GRID, SET_MIN_GRID_DIST, SET_GRID_PENALTY,
-                    SET_MV_CONNECT_DIST, SET_WINDVEL, SET_WINDCF, SettlementProcessor, Technology)
+from onsset import (SET_AGRI_DEMAND, SET_CAPITA_DEMAND, SET_COMMERCIAL_DEMAND, SET_DIST_TO_TRANS, SET_EDU_DEMAND,
+                    SET_ELEC_CURRENT, SET_ELEC_FINAL_CODE, SET_ELEC_ORDER, SET_ELEC_POP, SET_ELEC_POP_CALIB, SET_GHI,
+                    SET_GRID_CELL_AREA, SET_GRID_PENALTY, SET_HEALTH_DEMAND, SET_HV_DIST_CURRENT, SET_HV_DIST_PLANNED,
+                    SET_HYDRO, SET_HYDRO_DIST, SET_HYDRO_FID, SET_INVESTMENT_COST, SET_LCOE_GRID, SET_MIN_GRID_DIST,
+                    SET_MIN_OVERALL_LCOE, SET_MV_CONNECT_DIST, SET_MV_DIST_CURRENT, SET_MV_DIST_PLANNED,
+                    SET_NEW_CAPACITY, SET_NEW_CONNECTIONS, SET_NIGHT_LIGHTS, SET_POP, SET_POP_CALIB,
+                    SET_RESIDENTIAL_TIER, SET_TRAVEL_HOURS, SET_URBAN, SET_WINDCF, SET_WINDVEL, SET_X_DEG, SET_Y_DEG,
+                    SettlementGraph, SettlementProcessor, Technology)
 
 try:
+    from onsset.cache import StageCache, code_version
+    from onsset.config import Config
+    from onsset.storage import ColumnStore, ResultDataset, SettlementWriter
     from onsset.specs import (SPE_COUNTRY, SPE_ELEC, SPE_ELEC_MODELLED,
                               SPE_ELEC_RURAL, SPE_ELEC_URBAN, SPE_END_YEAR,
                               SPE_GRID_CAPACITY_INVESTMENT, SPE_GRID_LOSSES,
@@ -17,6 +33,9 @@ try:
                               SPE_START_YEAR, SPE_URBAN, SPE_URBAN_FUTURE,
                               SPE_URBAN_MODELLED)
 except ImportError:
+    from cache import StageCache, code_version
+    from config import Config
+    from storage import ColumnStore, ResultDataset, SettlementWriter
     from specs import (SPE_COUNTRY, SPE_ELEC, SPE_ELEC_MODELLED,
                        SPE_ELEC_RURAL, SPE_ELEC_URBAN, SPE_END_YEAR,
                        SPE_GRID_CAPACITY_INVESTMENT, SPE_GRID_LOSSES,
@@ -25,43 +44,227 @@ except ImportError:
                        SPE_NUM_PEOPLE_PER_HH_URBAN, SPE_POP, SPE_POP_FUTURE,
                        SPE_START_YEAR, SPE_URBAN, SPE_URBAN_FUTURE,
                        SPE_URBAN_MODELLED)
-from openpyxl import load_workbook
 
 logging.basicConfig(format='%(asctime)s\t\t%(message)s', level=logging.DEBUG)
 
+# The columns of the calibrated file that a scenario reads, used when ``scenario`` projects the columns on load.
+# The final electrification code of the start year is added to these.
+SCENARIO_COLUMNS = [SET_X_DEG, SET_Y_DEG, SET_GRID_CELL_AREA, SET_GHI, SET_TRAVEL_HOURS, SET_HV_DIST_CURRENT,
+                    SET_HV_DIST_PLANNED, SET_MV_DIST_PLANNED, SET_HYDRO_DIST, SET_HYDRO, SET_HYDRO_FID, SET_URBAN,
+                    SET_ELEC_ORDER, SET_CAPITA_DEMAND, SET_AGRI_DEMAND, SET_COMMERCIAL_DEMAND, SET_HEALTH_DEMAND,
+                    SET_EDU_DEMAND, SET_RESIDENTIAL_TIER + 'Custom', SET_RESIDENTIAL_TIER + '1',
+                    SET_RESIDENTIAL_TIER + '2', SET_RESIDENTIAL_TIER + '3', SET_RESIDENTIAL_TIER + '4',
+                    SET_RESIDENTIAL_TIER + '5', SET_GRID_PENALTY, SET_WINDCF, SET_POP_CALIB, SET_ELEC_POP_CALIB,
+                    SET_ELEC_CURRENT]
+
+# The columns that the calibration of the current population and electrification reads
+CALIBRATION_COLUMNS = [SET_X_DEG, SET_Y_DEG, SET_POP, SET_URBAN, SET_ELEC_POP, SET_NIGHT_LIGHTS, SET_DIST_TO_TRANS,
+                       SET_MV_DIST_CURRENT, SET_HV_DIST_CURRENT]
+
+# Named sets of output columns for ``scenario``: every column, the location, population and electrification plan of
+# each settlement, or no results file at all, only the summaries
+OUTPUT_COLUMN_SETS = {'full': None,
+                      'planning': [SET_X_DEG, SET_Y_DEG, SET_POP, SET_URBAN, SET_ELEC_CURRENT, SET_ELEC_FINAL_CODE,
+                                   SET_ELEC_ORDER, SET_NEW_CONNECTIONS, SET_NEW_CAPACITY, SET_INVESTMENT_COST,
+                                   SET_MIN_OVERALL_LCOE],
+                      'summary': []}
+
+# File formats that scenario results can be written in, by the extension of the results files, and 'dataset' for a
+# single ``ResultDataset`` of all scenarios
+RESULT_FORMATS = ('csv', 'csv.gz', 'csv.bz2', 'csv.xz', 'parquet', 'feather', 'dataset')
+
+# The ScenarioInfo columns that the scenarios of a ``ResultDataset`` are partitioned by
+SCENARIO_PARTITION_KEYS = ['Population_Growth', 'Target_electricity_consumption_level',
+                           'Electrification_target_5_years', 'Grid_electricity_generation_cost', 'PV_cost_adjust',
+                           'Diesel_price', 'Productive_uses_demand', 'Prioritization_algorithm']
+
+
+class CalibrationCache:
+    """Stores the outputs of ``calibration`` under a hash of the settlement file, the SpecsData sheet and the code
+
+    Each entry is a folder holding the calibrated settlements and the calibrated specs. Entries made by another version
+    of the code, or superseded by a newer calibration of the same files, are deleted whenever the cache is used.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def file_hash(path, chunk_size=2 ** 20):
+        """Returns the sha256 of the contents of a file, or of the files in a folder"""
+        digest = hashlib.sha256()
+        paths = [path]
+        if os.path.isdir(path):
+            paths = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+        for file_path in paths:
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def key(self, csv_path, specs_data):
+        """Returns the key of the calibration of csv_path with the given SpecsData sheet"""
+        digest = hashlib.sha256()
+        digest.update(self.file_hash(csv_path).encode())
+        digest.update(specs_data.to_csv(index=False).encode())
+        digest.update(code_version().encode())
+        return digest.hexdigest()
+
+    def restore(self, key, calibrated_csv_path):
+        """Writes the cached calibrated settlements to calibrated_csv_path and returns the calibrated specs, or returns
+        None if there is no entry for key"""
+        entry = os.path.join(self.folder, key)
+        try:
+            with open(os.path.join(entry, 'metadata.json')) as metadata_file:
+                metadata = json.load(metadata_file)
+            specs_data = pd.read_pickle(os.path.join(entry, 'specs.pkl'))
+        except (OSError, ValueError):
+            return None
+
+        settlements = os.path.join(entry, metadata['settlements'])
+        if os.path.splitext(settlements)[1] == os.path.splitext(calibrated_csv_path)[1]:
+            copyfile(settlements, calibrated_csv_path)
+        else:
+            SettlementProcessor.write_settlements(SettlementProcessor.read_settlements(settlements),
+                                                  calibrated_csv_path)
+        return specs_data
+
+    def store(self, key, calibrated_csv_path, specs_data, source):
+        """Copies a calibration into the cache
+
+        Arguments
+        ---------
+        key : str
+        calibrated_csv_path : str
+            The calibrated settlements written by the calibration
+        specs_data : pandas.DataFrame
+            The calibrated specs
+        source : tuple of str
+            The settlement and specs file that were calibrated, used to find the entries this one supersedes
+        """
+        entry = os.path.join(self.folder, key)
+        staging = entry + '.tmp{}'.format(os.getpid())
+        rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        settlements = 'settlements' + os.path.splitext(calibrated_csv_path)[1]
+        copyfile(calibrated_csv_path, os.path.join(staging, settlements))
+        specs_data.to_pickle(os.path.join(staging, 'specs.pkl'))
+        with open(os.path.join(staging, 'metadata.json'), 'w') as metadata_file:
+            json.dump({'settlements': settlements, 'source': [os.path.abspath(path) for path in source],
+                       'code': code_version()}, metadata_file)
+        rmtree(entry, ignore_errors=True)
+        os.replace(staging, entry)
+
+    def collect_garbage(self, keep, source):
+        """Deletes the entries of other code versions and those of the same source files other than keep"""
+        code = code_version()
+        source = [os.path.abspath(path) for path in source]
+        for name in os.listdir(self.folder):
+            entry = os.path.join(self.folder, name)
+            if name == keep or '.tmp' in name:
+                continue
+            try:
+                with open(os.path.join(entry, 'metadata.json')) as metadata_file:
+                    metadata = json.load(metadata_file)
+                stale = metadata['code'] != code or metadata['source'] == source
+            except (OSError, ValueError, KeyError):
+                stale = True
+            if stale:
+                logging.info('Removing stale calibration {}'.format(name))
+                rmtree(entry, ignore_errors=True)
+
+
+class ResultWriter:
+    """Writes the outputs of scenarios on a background thread
+
+    ``submit`` returns as soon as the writing of a scenario is queued, so that the next scenario is calculated while
+    the previous one is written. It first waits for the write before, so the results of at most one scenario are held
+    in memory while they wait to be written. An error in a write is raised by the next ``submit`` or by ``close``.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def submit(self, function, *args, **kwargs):
+        """Calls function(*args, **kwargs) on the background thread"""
+        self.wait()
+        self._pending = self._executor.submit(function, *args, **kwargs)
+
+    def wait(self):
+        """Waits for the pending write to finish"""
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            pending.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
 
-def calibration(specs_path, csv_path, specs_path_calib, calibrated_csv_path):
+def calibration(specs_path, csv_path, specs_path_calib, calibrated_csv_path, cache_folder=None, memory_budget=None):
     """
 
     Arguments
     ---------
-    specs_path
+    specs_path : str or Config
+        The specs file, or its ``Config``
     csv_path
     specs_path_calib
+        The config is written here with the calibrated specs as the SpecsDataCalib sheet, as a workbook of only the
+        config sheets, or as JSON or TOML if the path ends in .json or .toml
     calibrated_csv_path
+        The calibrated settlements are written as Parquet or Feather if the path ends in .parquet or .feather
+    cache_folder : str, optional
+        Folder of a ``CalibrationCache``. If the settlement file, the SpecsData sheet and the code are unchanged since
+        a previous calibration, its outputs are copied from there instead of calibrating again.
+    memory_budget : int, optional
+        Bytes that settlements may take up at a time. If given, the settlement file is streamed in chunks through the
+        row by row preparation and into a ``ColumnStore`` next to the calibrated file, only the
+        ``CALIBRATION_COLUMNS`` of all settlements are held in memory to calibrate, and the calibrated file is written
+        chunk by chunk. The result is the same as without a budget.
     """
-    specs_data = pd.read_excel(specs_path, sheet_name='SpecsData')
+    config = Config.load(specs_path)
+    specs_data = config.specs_frame()
+
+    cache = None
+    if cache_folder is not None:
+        cache = CalibrationCache(cache_folder)
+        key = cache.key(csv_path, specs_data)
+        source = tuple(path for path in (csv_path, config.source) if path is not None)
+        cache.collect_garbage(key, source)
+        calibrated_specs = cache.restore(key, calibrated_csv_path)
+        if calibrated_specs is not None:
+            logging.info('Calibration restored from {}'.format(cache_folder))
+            config.with_calibrated_specs(calibrated_specs).save(specs_path_calib)
+            return
+
     settlements_in_csv = csv_path
     settlements_out_csv = calibrated_csv_path
 
-    onsseter = SettlementProcessor(settlements_in_csv)
-
-    num_people_per_hh_rural = float(specs_data.iloc[0][SPE_NUM_PEOPLE_PER_HH_RURAL])
-    num_people_per_hh_urban = float(specs_data.iloc[0][SPE_NUM_PEOPLE_PER_HH_URBAN])
-
-    # RUN_PARAM: these are the annual household electricity targets
-    tier_1 = 38.7  # 38.7 refers to kWh/household/year. It is the mean value between Tier 1 and Tier 2
-    tier_2 = 219
-    tier_3 = 803
-    tier_4 = 2117
-    tier_5 = 2993
-
-    onsseter.prepare_wtf_tier_columns(num_people_per_hh_rural, num_people_per_hh_urban,
-                                      tier_1, tier_2, tier_3, tier_4, tier_5)
-    onsseter.condition_df()
-    onsseter.df[SET_GRID_PENALTY] = onsseter.grid_penalties(onsseter.df)
-
-    onsseter.df[SET_WINDCF] = onsseter.calc_wind_cfs(onsseter.df[SET_WINDVEL])
+    if memory_budget is None:
+        onsseter = SettlementProcessor(settlements_in_csv)
+        prepare_settlements(onsseter, specs_data)
+    else:
+        chunk_rows = SettlementProcessor.rows_per_chunk(settlements_in_csv, memory_budget)
+        temporary_folder = TemporaryDirectory(dir=os.path.dirname(os.path.abspath(settlements_out_csv)))
+        prepared = os.path.join(temporary_folder.name, 'prepared')
+        with ColumnStore(prepared) as store:
+            for chunk in SettlementProcessor.read_chunks(settlements_in_csv, chunk_rows):
+                onsseter = SettlementProcessor(chunk)
+                prepare_settlements(onsseter, specs_data, sort=False)
+                store.append(onsseter.df)
+        onsseter = SettlementProcessor(prepared, CALIBRATION_COLUMNS)
+        onsseter.df.sort_values(by=[SET_Y_DEG, SET_X_DEG], inplace=True)
 
     pop_actual = specs_data.loc[0, SPE_POP]
     urban_current = specs_data.loc[0, SPE_URBAN]
@@ -87,252 +290,577 @@ def calibration(specs_path, csv_path, specs_path_calib, calibrated_csv_path):
     specs_data['Buffer_used'] = elec_calibration_results[7]
     specs_data['buffer_distance'] = elec_calibration_results[8]
 
-    book = load_workbook(specs_path)
-    writer = pd.ExcelWriter(specs_path_calib, engine='openpyxl')
-    writer.book = book
-    # RUN_PARAM: Here the calibrated "specs" data are copied to a new tab called "SpecsDataCalib". 
-    # This is what will later on be used to feed the model
-    specs_data.to_excel(writer, sheet_name='SpecsDataCalib', index=False)
-    writer.save()
-    writer.close()
+    config.with_calibrated_specs(specs_data).save(specs_path_calib)
 
     logging.info('Calibration finished. Results are transferred to the csv file')
-    onsseter.df.to_csv(settlements_out_csv, index=False)
+    if memory_budget is None:
+        SettlementProcessor.write_settlements(onsseter.df, settlements_out_csv)
+    else:
+        write_calibrated_chunks(prepared, onsseter.df, settlements_out_csv, chunk_rows)
+        temporary_folder.cleanup()
+
+    if cache is not None:
+        cache.store(key, settlements_out_csv, specs_data, source)
+
 
+def prepare_settlements(onsseter, specs_data, sort=True):
+    """Adds the demand tier, grid penalty and wind capacity factor columns and conditions the settlements
 
-def scenario(specs_path, calibrated_csv_path, results_folder, summary_folder):
+    Everything here works row by row, so chunks of the settlements can be prepared one at a time.
     """
+    num_people_per_hh_rural = float(specs_data.iloc[0][SPE_NUM_PEOPLE_PER_HH_RURAL])
+    num_people_per_hh_urban = float(specs_data.iloc[0][SPE_NUM_PEOPLE_PER_HH_URBAN])
+
+    # RUN_PARAM: these are the annual household electricity targets
+    tier_1 = 38.7  # 38.7 refers to kWh/household/year. It is the mean value between Tier 1 and Tier 2
+    tier_2 = 219
+    tier_3 = 803
+    tier_4 = 2117
+    tier_5 = 2993
+
+    onsseter.prepare_wtf_tier_columns(num_people_per_hh_rural, num_people_per_hh_urban,
+                                      tier_1, tier_2, tier_3, tier_4, tier_5)
+    onsseter.condition_df(sort)
+    onsseter.df[SET_GRID_PENALTY] = onsseter.grid_penalties(onsseter.df)
+
+    onsseter.df[SET_WINDCF] = onsseter.calc_wind_cfs(onsseter.df[SET_WINDVEL])
+
+
+def write_calibrated_chunks(prepared, calibrated, path, chunk_rows):
+    """Writes the prepared settlements with the calibrated columns, chunk by chunk
 
     Arguments
     ---------
-    specs_path : str
+    prepared : str
+        ``ColumnStore`` folder of the prepared settlements, in file order
+    calibrated : pandas.DataFrame
+        The calibrated columns, in output order and indexed by the row of the settlement in prepared
+    path : str
+    chunk_rows : int
+    """
+    order = calibrated.index.to_numpy()
+    with SettlementWriter(path) as writer:
+        for start in range(0, len(order), chunk_rows):
+            rows = slice(start, start + chunk_rows)
+            chunk = ColumnStore.read(prepared, rows=order[rows])
+            for column in calibrated.columns:
+                chunk[column] = calibrated[column].to_numpy()[rows]
+            writer.write(chunk)
+
+
+def scenario(specs_path, calibrated_csv_path, results_folder, summary_folder, summary_breakdowns=(),
+             project_columns=False, processes=1, stage_cache=None, resume=False, chunk_memory=None,
+             output_columns=None, results_format='csv'):
+    """
+
+    Arguments
+    ---------
+    specs_path : str or Config
+        The calibrated specs file, or its ``Config``
     calibrated_csv_path : str
     results_folder : str
     summary_folder : str
-
+    summary_breakdowns : list, optional
+        Columns, e.g. IsUrban or an administrative region, to write additional summaries broken down by
+    project_columns : bool, optional
+        Only read the ``SCENARIO_COLUMNS`` (and any breakdown columns) of the calibrated file. The results file then
+        leaves out the input columns that the scenario does not use.
+    processes : int, optional
+        Number of worker processes to run the scenarios on. With more than one, the calibrated file is parsed once
+        and stored as columns that each worker copies into its own frame without parsing.
+    stage_cache : StageCache, optional
+        Memoises the stages that scenarios have in common. Worker processes only share the entries that are stored
+        in the cache folder.
+    resume : bool, optional
+        Checkpoint every scenario after each year, continue from the last checkpoint of an interrupted run and skip
+        the scenarios whose outputs are already written
+    chunk_memory : int, optional
+        Bytes that a chunk of settlements may take up. If given, the off-grid LCOEs are calculated and the results
+        written one chunk at a time. Unlike the memory_budget of the calibration, this does not bound the memory a
+        scenario takes up: the yearly grid extension and limits need all settlements at once, so the columns a
+        scenario keeps in memory are best kept down with project_columns.
+    output_columns : list or str, optional
+        The columns to write to the results files, with yearly columns named without the year, e.g. FinalElecCode,
+        or the name of one of the ``OUTPUT_COLUMN_SETS``. Yearly columns that are not output are freed as soon as the
+        scenario no longer reads them. By default all columns are written; with no columns, only the summaries are.
+    results_format : str, optional
+        One of the ``RESULT_FORMATS``, the extension of the results files. Compressed csv and Parquet files take a
+        fraction of the space and time to write of plain csv-files. With 'dataset', all scenarios are written to one
+        ``ResultDataset`` in results_folder, which stores the settlement columns that the scenarios do not change only
+        once.
+
+    Returns
+    -------
+    list of tuple
+        The results file (None if only the summaries are written) and summary csv-file of each scenario, in the order
+        of the ScenarioInfo sheet
+
+    Notes
+    -----
+    Without worker processes, the outputs of each scenario are written on a background thread while the next
+    scenario runs.
     """
+    if isinstance(output_columns, str):
+        output_columns = OUTPUT_COLUMN_SETS[output_columns]
+    if results_format not in RESULT_FORMATS:
+        raise ValueError('Unknown results format {}, expected one of {}'.format(results_format, RESULT_FORMATS))
+
+    config = Config.load(specs_path)
+    if config.calibrated_specs is None:
+        raise ValueError('{} has no SpecsDataCalib sheet, run the calibration first'.format(config.source))
+    scenarios = [scenario_config.number for scenario_config in config.scenarios]
+    specs_data = config.calibrated_specs
+    logging.info(specs_data[SPE_COUNTRY])
+
+    columns = None
+    if project_columns:
+        columns = SCENARIO_COLUMNS + [SET_ELEC_FINAL_CODE + str(int(specs_data[SPE_START_YEAR]))] + \
+            list(summary_breakdowns)
+
+    chunk_rows = None
+    if chunk_memory is not None:
+        chunk_rows = SettlementProcessor.rows_per_chunk(calibrated_csv_path, chunk_memory)
+
+    if results_format == 'dataset' and (output_columns is None or len(output_columns) > 0):
+        dataset = result_dataset(results_folder, specs_data)
+        if not (resume and os.path.exists(dataset.base_folder)):
+            base = SettlementProcessor(calibrated_csv_path, columns).df
+            start_year = [int(specs_data[SPE_START_YEAR])]
+            base = base[[column for column in base
+                         if SettlementProcessor.is_output(column, output_columns, start_year)]]
+            dataset.write_base(base.astype(SettlementProcessor.result_dtypes(base), copy=False))
+            del base
+
+    if processes <= 1:
+        with ResultWriter() as writer:
+            return [run_scenario(scenario, config, calibrated_csv_path, results_folder, summary_folder,
+                                 summary_breakdowns, columns, stage_cache=stage_cache, resume=resume,
+                                 chunk_rows=chunk_rows, output_columns=output_columns,
+                                 results_format=results_format, writer=writer)
+                    for scenario in scenarios]
+
+    with TemporaryDirectory() as shared_folder:
+        settlements = SettlementProcessor.read_settlements(calibrated_csv_path, columns)
+        SettlementProcessor.save_columns(settlements, shared_folder)
+
+        # The settlement graph only depends on the calibrated file, so it is built once before the workers load it
+        if any(scenario_config.algorithm == 'priority' for scenario_config in config.scenarios):
+            SettlementGraph.cached(calibrated_csv_path, settlements)
+        del settlements
+
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(run_scenario, scenario, config, shared_folder, results_folder, summary_folder,
+                                       summary_breakdowns, graph_source=calibrated_csv_path,
+                                       stage_cache=stage_cache, resume=resume, chunk_rows=chunk_rows,
+                                       output_columns=output_columns, results_format=results_format)
+                       for scenario in scenarios]
+            return [future.result() for future in futures]
+
+
+def run_scenario(scenario, config, settlements_path, results_folder, summary_folder, summary_breakdowns=(),
+                 columns=None, graph_source=None, stage_cache=None, resume=False, chunk_rows=None,
+                 output_columns=None, results_format='csv', writer=None):
+    """Runs one row of the ScenarioInfo sheet
 
-    scenario_info = pd.read_excel(specs_path, sheet_name='ScenarioInfo')
-    scenarios = scenario_info['Scenario']
-    scenario_parameters = pd.read_excel(specs_path, sheet_name='ScenarioParameters')
-    specs_data = pd.read_excel(specs_path, sheet_name='SpecsDataCalib')
-    print(specs_data.loc[0, SPE_COUNTRY])
-
-    for scenario in scenarios:
-        print('Scenario: ' + str(scenario + 1))
-        country_id = specs_data.iloc[0]['CountryCode']
-        pop_future = specs_data.loc[0, SPE_POP_FUTURE]
-        urban_future = specs_data.loc[0, SPE_URBAN_FUTURE]
-
-        pop_index = scenario_info.iloc[scenario]['Population_Growth']
-        tier_index = scenario_info.iloc[scenario]['Target_electricity_consumption_level']
-        five_year_index = scenario_info.iloc[scenario]['Electrification_target_5_years']
-        grid_index = scenario_info.iloc[scenario]['Grid_electricity_generation_cost']
-        pv_index = scenario_info.iloc[scenario]['PV_cost_adjust']
-        diesel_index = scenario_info.iloc[scenario]['Diesel_price']
-        productive_index = scenario_info.iloc[scenario]['Productive_uses_demand']
-        prio_index = scenario_info.iloc[scenario]['Prioritization_algorithm']
-
-        end_year_pop = scenario_parameters.iloc[pop_index]['PopEndYear']
-        rural_tier = scenario_parameters.iloc[tier_index]['RuralTargetTier']
-        urban_tier = scenario_parameters.iloc[tier_index]['UrbanTargetTier']
-        five_year_target = scenario_parameters.iloc[five_year_index]['5YearTarget']
-        annual_new_grid_connections_limit = scenario_parameters.iloc[five_year_index][
-                                                'GridConnectionsLimitThousands'] * 1000
-        grid_price = scenario_parameters.iloc[grid_index]['GridGenerationCost']
-        pv_capital_cost_adjust = scenario_parameters.iloc[pv_index]['PV_Cost_adjust']
-        diesel_price = scenario_parameters.iloc[diesel_index]['DieselPrice']
-        productive_demand = scenario_parameters.iloc[productive_index]['ProductiveDemand']
-        prioritization = scenario_parameters.iloc[prio_index]['PrioritizationAlgorithm']
-        auto_intensification = scenario_parameters.iloc[prio_index]['AutoIntensificationKM']
-
-        settlements_in_csv = calibrated_csv_path
-        settlements_out_csv = os.path.join(results_folder,
-                                           '{}-1-{}_{}_{}_{}_{}_{}.csv'.format(country_id, pop_index, tier_index,
-                                                                               five_year_index, grid_index, pv_index,
-                                                                               prio_index))
-        summary_csv = os.path.join(summary_folder,
-                                   '{}-1-{}_{}_{}_{}_{}_{}_summary.csv'.format(country_id, pop_index, tier_index,
-                                                                               five_year_index, grid_index, pv_index,
-                                                                               prio_index))
-
-        onsseter = SettlementProcessor(settlements_in_csv)
-
-        start_year = specs_data.iloc[0][SPE_START_YEAR]
-        end_year = specs_data.iloc[0][SPE_END_YEAR]
-
-        num_people_per_hh_rural = float(specs_data.iloc[0][SPE_NUM_PEOPLE_PER_HH_RURAL])
-        num_people_per_hh_urban = float(specs_data.iloc[0][SPE_NUM_PEOPLE_PER_HH_URBAN])
-        max_grid_extension_dist = float(specs_data.iloc[0][SPE_MAX_GRID_EXTENSION_DIST])
-        annual_grid_cap_gen_limit = specs_data.loc[0, 'NewGridGenerationCapacityAnnualLimitMW'] * 1000
-
-        # RUN_PARAM: Fill in general and technology specific parameters (e.g. discount rate, losses etc.)
-        Technology.set_default_values(base_year=start_year,
-                                      start_year=start_year,
-                                      end_year=end_year,
-                                      discount_rate=0.08)
-
-        grid_calc = Technology(om_of_td_lines=0.02,
-                               distribution_losses=float(specs_data.iloc[0][SPE_GRID_LOSSES]),
-                               connection_cost_per_hh=125,
-                               base_to_peak_load_ratio=0.8,
-                               capacity_factor=1,
+    Arguments
+    ---------
+    scenario : int
+        The position of the scenario in ``config.scenarios``
+    config : Config
+        A config with the SpecsDataCalib sheet
+    settlements_path : str
+        The calibrated settlements, as a file or a folder written by ``SettlementProcessor.save_columns``
+    results_folder : str
+    summary_folder : str
+    summary_breakdowns : list, optional
+    columns : list, optional
+        The columns to read from settlements_path
+    graph_source : str, optional
+        The calibrated file that the settlement graph is cached for, if it is not settlements_path
+    stage_cache : StageCache, optional
+    resume : bool, optional
+        Checkpoint after each year in results_folder/checkpoints, and continue from there or skip the scenario if it
+        is already finished
+    chunk_rows : int, optional
+        Calculate the off-grid LCOEs and write the results for this many settlements at a time
+    output_columns : list, optional
+        The columns to write to the results file (see ``SettlementProcessor.is_output``). With none, the results
+        file is not written.
+    results_format : str, optional
+        The extension of the results file, one of the ``RESULT_FORMATS``. The base of a 'dataset' must already be
+        written (see ``scenario``).
+    writer : ResultWriter, optional
+        Writes the outputs in the background. By default they are written before the function returns.
+
+    Returns
+    -------
+    tuple
+        The results file or dataset partition folder, or None if it is not written, and the summary csv-file of the
+        scenario
+    """
+    specs_data = config.calibrated_specs
+    scenario_config = config.scenarios[scenario]
+
+    logging.info('Scenario: ' + str(scenario + 1))
+    country_id = specs_data['CountryCode']
+    pop_future = specs_data[SPE_POP_FUTURE]
+    urban_future = specs_data[SPE_URBAN_FUTURE]
+
+    pop_index = scenario_config.info['Population_Growth']
+    tier_index = scenario_config.info['Target_electricity_consumption_level']
+    five_year_index = scenario_config.info['Electrification_target_5_years']
+    grid_index = scenario_config.info['Grid_electricity_generation_cost']
+    pv_index = scenario_config.info['PV_cost_adjust']
+    prio_index = scenario_config.info['Prioritization_algorithm']
+
+    end_year_pop = scenario_config.end_year_pop
+    rural_tier = scenario_config.rural_tier
+    urban_tier = scenario_config.urban_tier
+    five_year_target = scenario_config.five_year_target
+    annual_new_grid_connections_limit = scenario_config.annual_new_grid_connections_limit
+    grid_price = scenario_config.grid_price
+    pv_capital_cost_adjust = scenario_config.pv_capital_cost_adjust
+    diesel_price = scenario_config.diesel_price
+    productive_demand = scenario_config.productive_demand
+    prioritization = scenario_config.prioritization
+    auto_intensification = scenario_config.auto_intensification
+    algorithm = scenario_config.algorithm
+    hydro_allocation = scenario_config.hydro_allocation
+
+    scenario_name = '{}-1-{}_{}_{}_{}_{}_{}'.format(country_id, pop_index, tier_index, five_year_index, grid_index,
+                                                    pv_index, prio_index)
+    if results_format == 'dataset':
+        dataset = result_dataset(results_folder, specs_data)
+        partition = {key: int(scenario_config.info[key]) for key in SCENARIO_PARTITION_KEYS}
+        settlements_out_csv = dataset.partition_folder(partition)
+    else:
+        settlements_out_csv = os.path.join(results_folder, '{}.{}'.format(scenario_name, results_format))
+    summary_csv = os.path.join(summary_folder,
+                               '{}-1-{}_{}_{}_{}_{}_{}_summary.csv'.format(country_id, pop_index, tier_index,
+                                                                           five_year_index, grid_index, pv_index,
+                                                                           prio_index))
+    breakdown_csvs = {by: summary_csv.replace('_summary.csv', '_summary_{}.csv'.format(by))
+                      for by in summary_breakdowns}
+    checkpoint_folder = os.path.join(results_folder, 'checkpoints', scenario_name)
+    if output_columns is not None and len(output_columns) == 0:
+        settlements_out_csv = None
+
+    outputs = [summary_csv] + list(breakdown_csvs.values())
+    if settlements_out_csv is not None:
+        outputs.append(settlements_out_csv)
+    if resume and all(os.path.exists(output) for output in outputs):
+        logging.info('Scenario {} is already finished'.format(scenario + 1))
+        return settlements_out_csv, summary_csv
+
+    onsseter = SettlementProcessor(settlements_path, columns)
+    onsseter.chunk_rows = chunk_rows
+
+    graph = None
+    if algorithm == 'priority':
+        graph = SettlementGraph.cached(graph_source or settlements_path, onsseter.df)
+
+    start_year = specs_data[SPE_START_YEAR]
+    end_year = specs_data[SPE_END_YEAR]
+
+    num_people_per_hh_rural = float(specs_data[SPE_NUM_PEOPLE_PER_HH_RURAL])
+    num_people_per_hh_urban = float(specs_data[SPE_NUM_PEOPLE_PER_HH_URBAN])
+    max_grid_extension_dist = float(specs_data[SPE_MAX_GRID_EXTENSION_DIST])
+    annual_grid_cap_gen_limit = specs_data['NewGridGenerationCapacityAnnualLimitMW'] * 1000
+
+    # RUN_PARAM: Fill in general and technology specific parameters (e.g. discount rate, losses etc.)
+    Technology.set_default_values(base_year=start_year,
+                                  start_year=start_year,
+                                  end_year=end_year,
+                                  discount_rate=0.08)
+
+    grid_calc = Technology(om_of_td_lines=0.02,
+                           distribution_losses=float(specs_data[SPE_GRID_LOSSES]),
+                           connection_cost_per_hh=125,
+                           base_to_peak_load_ratio=0.8,
+                           capacity_factor=1,
+                           tech_life=30,
+                           grid_capacity_investment=float(specs_data[SPE_GRID_CAPACITY_INVESTMENT]),
+                           grid_penalty_ratio=1,
+                           grid_price=grid_price)
+
+    mg_hydro_calc = Technology(om_of_td_lines=0.02,
+                               distribution_losses=0.05,
+                               connection_cost_per_hh=100,
+                               base_to_peak_load_ratio=0.85,
+                               capacity_factor=0.5,
                                tech_life=30,
-                               grid_capacity_investment=float(specs_data.iloc[0][SPE_GRID_CAPACITY_INVESTMENT]),
-                               grid_penalty_ratio=1,
-                               grid_price=grid_price)
-
-        mg_hydro_calc = Technology(om_of_td_lines=0.02,
-                                   distribution_losses=0.05,
-                                   connection_cost_per_hh=100,
-                                   base_to_peak_load_ratio=0.85,
-                                   capacity_factor=0.5,
-                                   tech_life=30,
-                                   capital_cost={float("inf"): 3000},
-                                   om_costs=0.03,
-                                   mini_grid=True)
-
-        mg_wind_calc = Technology(om_of_td_lines=0.02,
-                                  distribution_losses=0.05,
-                                  connection_cost_per_hh=100,
-                                  base_to_peak_load_ratio=0.85,
-                                  capital_cost={float("inf"): 3750},
-                                  om_costs=0.02,
-                                  tech_life=20,
-                                  mini_grid=True)
-
-        mg_pv_calc = Technology(om_of_td_lines=0.02,
+                               capital_cost={float("inf"): 3000},
+                               om_costs=0.03,
+                               mini_grid=True)
+
+    mg_wind_calc = Technology(om_of_td_lines=0.02,
+                              distribution_losses=0.05,
+                              connection_cost_per_hh=100,
+                              base_to_peak_load_ratio=0.85,
+                              capital_cost={float("inf"): 3750},
+                              om_costs=0.02,
+                              tech_life=20,
+                              mini_grid=True)
+
+    mg_pv_calc = Technology(om_of_td_lines=0.02,
+                            distribution_losses=0.05,
+                            connection_cost_per_hh=100,
+                            base_to_peak_load_ratio=0.85,
+                            tech_life=20,
+                            om_costs=0.015,
+                            capital_cost={float("inf"): 2950 * pv_capital_cost_adjust},
+                            mini_grid=True)
+
+    sa_pv_calc = Technology(base_to_peak_load_ratio=0.9,
+                            tech_life=15,
+                            om_costs=0.02,
+                            capital_cost={float("inf"): 6950 * pv_capital_cost_adjust,
+                                          1: 4470 * pv_capital_cost_adjust,
+                                          0.100: 6380 * pv_capital_cost_adjust,
+                                          0.050: 8780 * pv_capital_cost_adjust,
+                                          0.020: 9620 * pv_capital_cost_adjust
+                                          },
+                            standalone=True)
+
+    mg_diesel_calc = Technology(om_of_td_lines=0.02,
                                 distribution_losses=0.05,
                                 connection_cost_per_hh=100,
                                 base_to_peak_load_ratio=0.85,
-                                tech_life=20,
-                                om_costs=0.015,
-                                capital_cost={float("inf"): 2950 * pv_capital_cost_adjust},
+                                capacity_factor=0.7,
+                                tech_life=15,
+                                om_costs=0.1,
+                                capital_cost={float("inf"): 721},
                                 mini_grid=True)
 
-        sa_pv_calc = Technology(base_to_peak_load_ratio=0.9,
-                                tech_life=15,
-                                om_costs=0.02,
-                                capital_cost={float("inf"): 6950 * pv_capital_cost_adjust,
-                                              1: 4470 * pv_capital_cost_adjust,
-                                              0.100: 6380 * pv_capital_cost_adjust,
-                                              0.050: 8780 * pv_capital_cost_adjust,
-                                              0.020: 9620 * pv_capital_cost_adjust
-                                              },
+    sa_diesel_calc = Technology(base_to_peak_load_ratio=0.9,
+                                capacity_factor=0.5,
+                                tech_life=10,
+                                om_costs=0.1,
+                                capital_cost={float("inf"): 938},
                                 standalone=True)
 
-        mg_diesel_calc = Technology(om_of_td_lines=0.02,
-                                    distribution_losses=0.05,
-                                    connection_cost_per_hh=100,
-                                    base_to_peak_load_ratio=0.85,
-                                    capacity_factor=0.7,
-                                    tech_life=15,
-                                    om_costs=0.1,
-                                    capital_cost={float("inf"): 721},
-                                    mini_grid=True)
-
-        sa_diesel_calc = Technology(base_to_peak_load_ratio=0.9,
-                                    capacity_factor=0.5,
-                                    tech_life=10,
-                                    om_costs=0.1,
-                                    capital_cost={float("inf"): 938},
-                                    standalone=True)
-
-        sa_diesel_cost = {'diesel_price': diesel_price,
-                          'efficiency': 0.28,
-                          'diesel_truck_consumption': 14,
-                          'diesel_truck_volume': 300}
-
-        mg_diesel_cost = {'diesel_price': diesel_price,
-                          'efficiency': 0.33,
-                          'diesel_truck_consumption': 33.7,
-                          'diesel_truck_volume': 15000}
-
-        # RUN_PARAM: One shall define here the years of analysis (excluding start year),
-        # together with access targets per interval and timestep duration
-        yearsofanalysis = [2025, 2030]
-        eleclimits = {2025: five_year_target, 2030: 1}
-        time_steps = {2025: 7, 2030: 5}
-
-        elements = ["1.Population", "2.New_Connections", "3.Capacity", "4.Investment"]
-        techs = ["Grid", "SA_Diesel", "SA_PV", "MG_Diesel", "MG_PV", "MG_Wind", "MG_Hydro"]
-        tech_codes = [1, 2, 3, 4, 5, 6, 7]
-
-        sumtechs = []
-        for element in elements:
-            for tech in techs:
-                sumtechs.append(element + "_" + tech)
-        total_rows = len(sumtechs)
-        df_summary = pd.DataFrame(columns=yearsofanalysis)
-        for row in range(0, total_rows):
-            df_summary.loc[sumtechs[row]] = "Nan"
-
-        onsseter.current_mv_line_dist()
-
-        onsseter.project_pop_and_urban(pop_future, urban_future, start_year, yearsofanalysis)
-
-        for year in yearsofanalysis:
-            eleclimit = eleclimits[year]
-            time_step = time_steps[year]
-
-            if year - time_step == start_year:
-                grid_cap_gen_limit = time_step * annual_grid_cap_gen_limit
-                grid_connect_limit = time_step * annual_new_grid_connections_limit
-            else:
-                grid_cap_gen_limit = 9999999999
-                grid_connect_limit = 9999999999
-
-            onsseter.set_scenario_variables(year, num_people_per_hh_rural, num_people_per_hh_urban, time_step,
-                                            start_year, urban_tier, rural_tier, end_year_pop, productive_demand)
-
-            onsseter.diesel_cost_columns(sa_diesel_cost, mg_diesel_cost, year)
-
-            sa_diesel_investment, sa_diesel_capacity, sa_pv_investment, sa_pv_capacity, mg_diesel_investment, \
-            mg_diesel_capacity, mg_pv_investment, mg_pv_capacity, mg_wind_investment, mg_wind_capacity, \
-            mg_hydro_investment, mg_hydro_capacity = onsseter.calculate_off_grid_lcoes(mg_hydro_calc, mg_wind_calc, mg_pv_calc,
-                                                                        sa_pv_calc, mg_diesel_calc,
-                                                                        sa_diesel_calc, year, end_year, time_step,
-                                                                        techs, tech_codes)
-
-            grid_investment, grid_capacity, grid_cap_gen_limit, grid_connect_limit = \
-                onsseter.pre_electrification(grid_price, year, time_step, end_year, grid_calc, grid_cap_gen_limit,
-                                             grid_connect_limit)
-
-            onsseter.df[SET_LCOE_GRID + "{}".format(year)], onsseter.df[SET_MIN_GRID_DIST + "{}".format(year)], \
-            onsseter.df[SET_ELEC_ORDER + "{}".format(year)], onsseter.df[SET_MV_CONNECT_DIST], grid_investment,\
-                grid_capacity = \
-                onsseter.elec_extension(grid_calc,
-                                        max_grid_extension_dist,
-                                        year,
-                                        start_year,
-                                        end_year,
-                                        time_step,
-                                        grid_cap_gen_limit,
-                                        grid_connect_limit,
-                                        auto_intensification=auto_intensification,
-                                        prioritization=prioritization,
-                                        new_investment=grid_investment,
-                                        new_capacity=grid_capacity)
-
-            onsseter.results_columns(techs, tech_codes, year, time_step, prioritization, auto_intensification)
-
-            onsseter.calculate_investments_and_capacity(sa_diesel_investment, sa_diesel_capacity, sa_pv_investment,
-                                                        sa_pv_capacity, mg_diesel_investment, mg_diesel_capacity,
-                                                        mg_pv_investment, mg_pv_capacity, mg_wind_investment,
-                                                        mg_wind_capacity, mg_hydro_investment, mg_hydro_capacity,
-                                                        grid_investment, grid_capacity, year)
-
-            onsseter.apply_limitations(eleclimit, year, time_step, prioritization, auto_intensification)
-
-            onsseter.calc_summaries(df_summary, sumtechs, tech_codes, year)
-
-        for i in range(len(onsseter.df.columns)):
-            if onsseter.df.iloc[:, i].dtype == 'float64':
-                onsseter.df.iloc[:, i] = pd.to_numeric(onsseter.df.iloc[:, i], downcast='float')
-            elif onsseter.df.iloc[:, i].dtype == 'int64':
-                onsseter.df.iloc[:, i] = pd.to_numeric(onsseter.df.iloc[:, i], downcast='signed')
-
-        df_summary.to_csv(summary_csv, index=sumtechs)
-        onsseter.df.to_csv(settlements_out_csv, index=False)
+    sa_diesel_cost = {'diesel_price': diesel_price,
+                      'efficiency': 0.28,
+                      'diesel_truck_consumption': 14,
+                      'diesel_truck_volume': 300}
+
+    mg_diesel_cost = {'diesel_price': diesel_price,
+                      'efficiency': 0.33,
+                      'diesel_truck_consumption': 33.7,
+                      'diesel_truck_volume': 15000}
+
+    # RUN_PARAM: One shall define here the years of analysis (excluding start year),
+    # together with access targets per interval and timestep duration
+    yearsofanalysis = [2025, 2030]
+    eleclimits = {2025: five_year_target, 2030: 1}
+    time_steps = {2025: 7, 2030: 5}
+
+    elements = ["1.Population", "2.New_Connections", "3.Capacity", "4.Investment"]
+    techs = ["Grid", "SA_Diesel", "SA_PV", "MG_Diesel", "MG_PV", "MG_Wind", "MG_Hydro"]
+    tech_codes = [1, 2, 3, 4, 5, 6, 7]
+
+    sumtechs = []
+    for element in elements:
+        for tech in techs:
+            sumtechs.append(element + "_" + tech)
+    df_summary = pd.DataFrame(index=sumtechs, columns=yearsofanalysis, dtype=float)
+    breakdown_summaries = {by: [] for by in summary_breakdowns}
+
+    onsseter.current_mv_line_dist()
+
+    # The scenario parameters that each stage reads, directly or through the technologies it is given. The settlements
+    # after a stage depend on these and on the parameters of every stage before it.
+    off_grid_calcs = (mg_hydro_calc, mg_wind_calc, mg_pv_calc, sa_pv_calc, mg_diesel_calc, sa_diesel_calc)
+    stage_parameters = {'project_pop_and_urban': {},
+                        'set_scenario_variables': {'end_year_pop': end_year_pop, 'rural_tier': rural_tier,
+                                                   'urban_tier': urban_tier, 'productive_demand': productive_demand},
+                        'diesel_cost_columns': {'sa_diesel_cost': sa_diesel_cost, 'mg_diesel_cost': mg_diesel_cost},
+                        'calculate_off_grid_lcoes': {'off_grid': StageCache.technology_fingerprint(*off_grid_calcs),
+                                                     'hydro_allocation': hydro_allocation},
+                        'pre_electrification': {'grid': StageCache.technology_fingerprint(grid_calc),
+                                                'annual_grid_cap_gen_limit': annual_grid_cap_gen_limit,
+                                                'annual_grid_connections_limit': annual_new_grid_connections_limit},
+                        'elec_extension': {'max_grid_extension_dist': max_grid_extension_dist,
+                                           'auto_intensification': auto_intensification,
+                                           'prioritization': prioritization, 'algorithm': algorithm},
+                        'results_columns': {},
+                        'calculate_investments_and_capacity': {},
+                        'apply_limitations': {'five_year_target': five_year_target}}
+    lineage = {}
+    if stage_cache is not None:
+        lineage = {'settlements': StageCache.data_hash(onsseter.df),
+                   'specs': StageCache.fingerprint(specs_data)}
+
+    def run_stage(stage, year, *args, **kwargs):
+        if stage_cache is None:
+            return stage(*args, **kwargs)
+        lineage.update(stage_parameters[stage.__name__])
+        return stage_cache.run(onsseter, stage, dict(lineage, year=year), *args, **kwargs)
+
+    checkpoint = load_checkpoint(checkpoint_folder) if resume else None
+    if checkpoint is None:
+        run_stage(onsseter.project_pop_and_urban, start_year, pop_future, urban_future, start_year, yearsofanalysis)
+    else:
+        onsseter.df, df_summary, breakdown_summaries, completed_year = checkpoint
+        logging.info('Resuming scenario {} after {}'.format(scenario + 1, completed_year))
+        for completed in yearsofanalysis:
+            if completed <= completed_year:
+                onsseter.retire_year_columns(completed, time_steps[completed], output_columns)
+        # Every stage has run in the years before the checkpoint
+        for parameters in stage_parameters.values():
+            lineage.update(parameters)
+
+    for year in yearsofanalysis:
+        if checkpoint is not None and year <= checkpoint[3]:
+            continue
+        eleclimit = eleclimits[year]
+        time_step = time_steps[year]
+
+        if year - time_step == start_year:
+            grid_cap_gen_limit = time_step * annual_grid_cap_gen_limit
+            grid_connect_limit = time_step * annual_new_grid_connections_limit
+        else:
+            grid_cap_gen_limit = 9999999999
+            grid_connect_limit = 9999999999
+
+        run_stage(onsseter.set_scenario_variables, year, year, num_people_per_hh_rural, num_people_per_hh_urban,
+                  time_step, start_year, urban_tier, rural_tier, end_year_pop, productive_demand)
+
+        run_stage(onsseter.diesel_cost_columns, year, sa_diesel_cost, mg_diesel_cost, year)
+
+        sa_diesel_investment, sa_diesel_capacity, sa_pv_investment, sa_pv_capacity, mg_diesel_investment, \
+        mg_diesel_capacity, mg_pv_investment, mg_pv_capacity, mg_wind_investment, mg_wind_capacity, \
+        mg_hydro_investment, mg_hydro_capacity = run_stage(onsseter.calculate_off_grid_lcoes, year, mg_hydro_calc,
+                                                           mg_wind_calc, mg_pv_calc, sa_pv_calc, mg_diesel_calc,
+                                                           sa_diesel_calc, year, end_year, time_step, techs,
+                                                           tech_codes, hydro_allocation=hydro_allocation)
+
+        grid_investment, grid_capacity, grid_cap_gen_limit, grid_connect_limit = \
+            run_stage(onsseter.pre_electrification, year, grid_price, year, time_step, end_year, grid_calc,
+                      grid_cap_gen_limit, grid_connect_limit)
+
+        onsseter.df[SET_LCOE_GRID + "{}".format(year)], onsseter.df[SET_MIN_GRID_DIST + "{}".format(year)], \
+        onsseter.df[SET_ELEC_ORDER + "{}".format(year)], onsseter.df[SET_MV_CONNECT_DIST], grid_investment,\
+            grid_capacity = \
+            run_stage(onsseter.elec_extension, year,
+                      grid_calc,
+                      max_grid_extension_dist,
+                      year,
+                      start_year,
+                      end_year,
+                      time_step,
+                      grid_cap_gen_limit,
+                      grid_connect_limit,
+                      auto_intensification=auto_intensification,
+                      prioritization=prioritization,
+                      algorithm=algorithm,
+                      graph=graph,
+                      new_investment=grid_investment,
+                      new_capacity=grid_capacity)
+
+        run_stage(onsseter.results_columns, year, techs, tech_codes, year, time_step, prioritization,
+                  auto_intensification)
+
+        run_stage(onsseter.calculate_investments_and_capacity, year, sa_diesel_investment, sa_diesel_capacity,
+                  sa_pv_investment, sa_pv_capacity, mg_diesel_investment, mg_diesel_capacity, mg_pv_investment,
+                  mg_pv_capacity, mg_wind_investment, mg_wind_capacity, mg_hydro_investment, mg_hydro_capacity,
+                  grid_investment, grid_capacity, year)
+
+        run_stage(onsseter.apply_limitations, year, eleclimit, year, time_step, prioritization, auto_intensification)
+
+        onsseter.calc_summaries(df_summary, sumtechs, tech_codes, year)
+        for by in summary_breakdowns:
+            breakdown_summaries[by].append(onsseter.summarise(year, tech_codes, by=by))
+
+        onsseter.retire_year_columns(year, time_step, output_columns)
+
+        if resume:
+            save_checkpoint(checkpoint_folder, onsseter.output_frame(), df_summary, breakdown_summaries, year)
+
+    results = None
+    if settlements_out_csv is not None:
+        results = onsseter.output_frame(output_columns, [start_year] + yearsofanalysis)
+        results = results.astype(SettlementProcessor.result_dtypes(results), copy=False)
+    del onsseter
+
+    def write_outputs():
+        # Each output is written under a temporary name first, so that a file that exists is complete
+        if results is None:
+            pass
+        elif results_format == 'dataset':
+            dataset.write_scenario(partition, results, chunk_rows)
+        else:
+            write_results(results, settlements_out_csv, chunk_rows)
+        for by, summaries in breakdown_summaries.items():
+            breakdown = pd.concat(summaries, axis=1, keys=yearsofanalysis)
+            breakdown.to_csv(breakdown_csvs[by] + '.tmp')
+            os.replace(breakdown_csvs[by] + '.tmp', breakdown_csvs[by])
+        df_summary.to_csv(summary_csv + '.tmp', index=sumtechs)
+        os.replace(summary_csv + '.tmp', summary_csv)
+        if resume:
+            rmtree(checkpoint_folder, ignore_errors=True)
 
         logging.info('Finished')
+
+    if writer is None:
+        write_outputs()
+    else:
+        writer.submit(write_outputs)
+
+    return settlements_out_csv, summary_csv
+
+
+def result_dataset(results_folder, specs_data):
+    """Returns the ``ResultDataset`` that the scenarios of the country are written to with the 'dataset' format"""
+    return ResultDataset(os.path.join(results_folder, '{}-1-dataset'.format(specs_data['CountryCode'])))
+
+
+def write_results(results, path, chunk_rows=None):
+    """Writes the results of a scenario, in the format given by the extension of path
+
+    Arguments
+    ---------
+    results : pandas.DataFrame
+    path : str
+    chunk_rows : int, optional
+        Write this many settlements at a time. By default all are written at once.
+    """
+    chunk_rows = chunk_rows or max(len(results), 1)
+    with SettlementWriter(path, temporary=True) as writer:
+        for start in range(0, max(len(results), 1), chunk_rows):
+            writer.write(results.iloc[start:start + chunk_rows])
+
+
+def save_checkpoint(folder, df, df_summary, breakdown_summaries, year):
+    """Stores the settlements and summaries of a scenario after a year
+
+    The settlements are stored as memory-mappable columns (see ``SettlementProcessor.save_columns``). The checkpoint
+    is staged next to the previous one and then swapped in.
+    """
+    staging = folder + '.tmp'
+    rmtree(staging, ignore_errors=True)
+    SettlementProcessor.save_columns(df, os.path.join(staging, 'settlements'))
+    np.save(os.path.join(staging, 'index.npy'), df.index.to_numpy())
+    with open(os.path.join(staging, 'summaries.pkl'), 'wb') as summaries_file:
+        pickle.dump((df_summary, breakdown_summaries), summaries_file, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(os.path.join(staging, 'metadata.json'), 'w') as metadata_file:
+        json.dump({'year': int(year)}, metadata_file)
+    rmtree(folder, ignore_errors=True)
+    os.replace(staging, folder)
+
+
+def load_checkpoint(folder):
+    """Returns the settlements, summaries and year of the checkpoint in folder, or None if there is none"""
+    # The metadata is written last, so a staged checkpoint that has it is complete
+    for path in (folder, folder + '.tmp'):
+        try:
+            with open(os.path.join(path, 'metadata.json')) as metadata_file:
+                year = json.load(metadata_file)['year']
+            with open(os.path.join(path, 'summaries.pkl'), 'rb') as summaries_file:
+                df_summary, breakdown_summaries = pickle.load(summaries_file)
+        except (OSError, ValueError, KeyError):
+            continue
+        df = SettlementProcessor.load_columns(os.path.join(path, 'settlements'))
+        df.index = np.load(os.path.join(path, 'index.npy'))
+        return df, df_summary, breakdown_summaries, year
+    return None
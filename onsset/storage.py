@@ -0,0 +1,348 @@
+"""Reads and writes settlement data in columns and in chunks
+
+A ``ColumnStore`` keeps the settlements as one raw binary file per column, which can be appended to one chunk at a
+time and read back, in any selection of rows and columns, through memory maps. A ``SettlementWriter`` writes the
+settlements chunk by chunk as csv (optionally compressed), Parquet or Feather, and a ``ResultDataset`` the results of
+a sweep of scenarios as column stores that only hold what each scenario changes.
+"""
+
+import bz2
+import gzip
+import json
+import lzma
+import os
+from shutil import rmtree
+
+import numpy as np
+import pandas as pd
+
+# Openers of compressed csv-files, by extension
+CSV_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+
+def settlement_format(path):
+    """Returns the file format of a settlement file from its extension
+
+    Arguments
+    ---------
+    path : str
+
+    Returns
+    -------
+    str
+        One of 'columns' (a ``ColumnStore`` folder), 'parquet', 'feather' or 'csv', which includes
+        compressed csv-files (see ``open_csv``)
+    """
+    if os.path.isdir(path):
+        return 'columns'
+    extension = os.path.splitext(str(path))[1].lower()
+    if extension in ('.parquet', '.pq'):
+        return 'parquet'
+    elif extension in ('.feather', '.arrow'):
+        return 'feather'
+    return 'csv'
+
+
+def open_csv(path, mode='r', name=None):
+    """Opens a csv-file as text, compressed or decompressed with the ``CSV_OPENERS`` entry of its extension
+
+    Arguments
+    ---------
+    path : str
+    mode : str
+        'r' or 'w'
+    name : str, optional
+        The name to take the extension from, if path is a temporary name
+    """
+    opener = CSV_OPENERS.get(os.path.splitext(str(name or path))[1].lower(), open)
+    return opener(path, mode + 't', newline='')
+
+
+class ColumnStore:
+    """Settlement columns stored as one raw binary file per column in a folder
+
+    Chunks of settlements are appended as they come, so a file larger than memory can be converted one chunk at a
+    time, and any rows of any columns can be read back through memory maps. Text and categorical columns are stored
+    as category codes; their categories are collected over all chunks and kept in metadata.json with the row count.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.entries = []
+        self.rows = 0
+        self._lookups = {}
+        os.makedirs(folder, exist_ok=True)
+        if os.path.exists(os.path.join(folder, 'metadata.json')):
+            os.remove(os.path.join(folder, 'metadata.json'))
+
+    def append(self, df):
+        """Appends the rows of a DataFrame, which must have the columns of the first chunk in the same order"""
+        if not self.entries:
+            for number, column in enumerate(df.columns):
+                entry = {'name': column, 'file': '{}.bin'.format(number)}
+                if df[column].dtype.kind in 'biuf':
+                    entry['dtype'] = df[column].dtype.str
+                else:
+                    entry['dtype'] = np.dtype('int32').str
+                    entry['pandas_dtype'] = str(df[column].dtype)
+                    entry['categories'] = []
+                    self._lookups[column] = {}
+                    if isinstance(df[column].dtype, pd.CategoricalDtype):
+                        # Keep the order of the categories of the first chunk
+                        self._encode(df[column].cat.categories, entry, self._lookups[column])
+                self.entries.append(entry)
+        elif list(df.columns) != [entry['name'] for entry in self.entries]:
+            raise ValueError('Chunk columns differ from the columns of the store')
+
+        for entry in self.entries:
+            values = df[entry['name']]
+            if 'categories' in entry:
+                values = self._encode(values, entry, self._lookups[entry['name']])
+            else:
+                values = values.to_numpy(dtype=entry['dtype'])
+            with open(os.path.join(self.folder, entry['file']), 'ab' if self.rows else 'wb') as column_file:
+                values.tofile(column_file)
+        self.rows += len(df)
+
+    @staticmethod
+    def _encode(values, entry, lookup):
+        """Returns the category codes of values, adding the values not seen before to the categories"""
+        values = pd.Series(np.asarray(values, dtype=object))
+        for value in pd.unique(values.dropna()):
+            if value not in lookup:
+                lookup[value] = len(lookup)
+                entry['categories'].append(value.item() if isinstance(value, np.generic) else value)
+        return values.map(lookup).fillna(-1).to_numpy(dtype='int32')
+
+    def close(self):
+        """Writes the metadata, after which the store can be read"""
+        with open(os.path.join(self.folder, 'metadata.json'), 'w') as metadata_file:
+            json.dump({'rows': self.rows, 'columns': self.entries}, metadata_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+
+    @staticmethod
+    def metadata(folder):
+        """Returns the row count and column entries of a store"""
+        with open(os.path.join(folder, 'metadata.json')) as metadata_file:
+            return json.load(metadata_file)
+
+    @staticmethod
+    def read(folder, columns=None, rows=None, mmap_mode='r'):
+        """Reads columns of a store into a DataFrame
+
+        Arguments
+        ---------
+        folder : str
+        columns : list, optional
+            By default all columns are read
+        rows : slice or numpy.ndarray, optional
+            The positions of the rows to read, by default all of them
+        mmap_mode : str, optional
+        """
+        metadata = ColumnStore.metadata(folder)
+        data = {}
+        for entry in metadata['columns']:
+            if columns is not None and entry['name'] not in columns:
+                continue
+            if metadata['rows'] == 0:
+                values = np.empty(0, dtype=entry['dtype'])
+            else:
+                values = np.memmap(os.path.join(folder, entry['file']), dtype=entry['dtype'], mode=mmap_mode,
+                                   shape=(metadata['rows'],))
+            if rows is not None:
+                values = values[rows]
+            if 'categories' in entry:
+                values = pd.Categorical.from_codes(values, entry['categories'])
+                if entry['pandas_dtype'] != 'category':
+                    values = np.asarray(values, dtype=object)
+            data[entry['name']] = values
+        return pd.DataFrame(data)
+
+
+class SettlementWriter:
+    """Writes settlements chunk by chunk, as csv or, if the path ends in .parquet or .feather, with ``pyarrow``
+
+    Csv-files whose path ends in .gz, .bz2 or .xz are compressed accordingly, Parquet and Feather files with zstd.
+    """
+
+    def __init__(self, path, temporary=False):
+        """
+        Arguments
+        ---------
+        path : str
+        temporary : bool, optional
+            Write under path + '.tmp' and only move the file to path once it is closed, so that a file that exists
+            at path is complete
+        """
+        self.path = path
+        self.format = settlement_format(path)
+        self.rows = 0
+        self._target = path + '.tmp' if temporary else path
+        self._writer = None
+
+    def write(self, df):
+        """Appends the rows of a DataFrame"""
+        if self.format == 'csv':
+            if self._writer is None:
+                self._writer = open_csv(self._target, 'w', name=self.path)
+            df.to_csv(self._writer, header=not self.rows, index=False)
+        else:
+            import pyarrow
+            table = pyarrow.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                if self.format == 'parquet':
+                    import pyarrow.parquet
+                    self._writer = pyarrow.parquet.ParquetWriter(self._target, table.schema, compression='zstd')
+                else:
+                    import pyarrow.ipc
+                    self._writer = pyarrow.ipc.new_file(self._target, table.schema,
+                                                        options=pyarrow.ipc.IpcWriteOptions(compression='zstd'))
+            self._writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._target != self.path and os.path.exists(self._target):
+            os.replace(self._target, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        elif self._writer is not None:
+            self._writer.close()
+
+
+class ResultDataset:
+    """The results of a sweep of scenarios, as one dataset partitioned by the scenario parameters
+
+    The columns that scenarios take over unchanged from the settlements are stored once, as a ``ColumnStore`` in
+    base/. Each scenario only stores the columns that it adds or changes, as a ``ColumnStore`` in a folder named
+    after its parameters, e.g. Population_Growth=1/.../Prioritization_algorithm=0, with the order of all its
+    columns in scenario.json. Scenarios are put back together column by column, so reading a few columns of many
+    scenarios only touches the files of those columns.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.base_folder = os.path.join(folder, 'base')
+
+    def partition_folder(self, partition):
+        """Returns the folder of a scenario
+
+        Arguments
+        ---------
+        partition : dict
+            The parameters of the scenario, in the order of the partition levels
+        """
+        return os.path.join(self.folder, *['{}={}'.format(key, value) for key, value in partition.items()])
+
+    @staticmethod
+    def _replace(temporary, folder):
+        if os.path.exists(folder):
+            rmtree(folder)
+        os.replace(temporary, folder)
+
+    def write_base(self, df):
+        """Stores the columns that the scenarios share, before any scenario is written"""
+        temporary = self.base_folder + '.tmp'
+        rmtree(temporary, ignore_errors=True)
+        with ColumnStore(temporary) as store:
+            store.append(df)
+        self._replace(temporary, self.base_folder)
+
+    def write_scenario(self, partition, results, chunk_rows=None):
+        """Stores the columns of a scenario that are not in the base, or differ from it
+
+        Arguments
+        ---------
+        partition : dict
+        results : pandas.DataFrame
+            The results of the scenario, with the settlements in the order of the base
+        chunk_rows : int, optional
+            Store this many settlements at a time
+        """
+        base = ColumnStore.metadata(self.base_folder)
+        if base['rows'] != len(results):
+            raise ValueError('The results have {} settlements, the base {}'.format(len(results), base['rows']))
+        base_columns = {entry['name'] for entry in base['columns']}
+        shared = ColumnStore.read(self.base_folder, [column for column in results if column in base_columns])
+        changed = [column for column in results
+                   if column not in shared or not results[column].reset_index(drop=True).equals(shared[column])]
+        del shared
+
+        folder = self.partition_folder(partition)
+        temporary = folder + '.tmp'
+        rmtree(temporary, ignore_errors=True)
+        chunk_rows = chunk_rows or max(len(results), 1)
+        positions = [results.columns.get_loc(column) for column in changed]
+        with ColumnStore(temporary) as store:
+            for start in range(0, max(len(results), 1), chunk_rows):
+                store.append(results.iloc[start:start + chunk_rows, positions])
+        with open(os.path.join(temporary, 'scenario.json'), 'w') as scenario_file:
+            json.dump({'partition': partition, 'columns': list(results.columns)}, scenario_file)
+        self._replace(temporary, folder)
+
+    def partitions(self):
+        """Returns the partition of every scenario in the dataset, sorted by the parameters"""
+        partitions = []
+        for root, folders, files in os.walk(self.folder):
+            folders[:] = sorted(folder for folder in folders if not folder.endswith('.tmp'))
+            if 'scenario.json' in files:
+                with open(os.path.join(root, 'scenario.json')) as scenario_file:
+                    partitions.append(json.load(scenario_file)['partition'])
+        return partitions
+
+    def columns(self, partition):
+        """Returns the columns of a scenario, in the order of its results"""
+        with open(os.path.join(self.partition_folder(partition), 'scenario.json')) as scenario_file:
+            return json.load(scenario_file)['columns']
+
+    def read(self, partition, columns=None, rows=None):
+        """Puts the results of a scenario back together
+
+        Arguments
+        ---------
+        partition : dict
+        columns : list, optional
+            By default all columns are read
+        rows : slice or numpy.ndarray, optional
+            The positions of the settlements to read, by default all of them
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        folder = self.partition_folder(partition)
+        order = [column for column in self.columns(partition) if columns is None or column in columns]
+        changed = {entry['name'] for entry in ColumnStore.metadata(folder)['columns']}
+        parts = [ColumnStore.read(folder, [column for column in order if column in changed], rows),
+                 ColumnStore.read(self.base_folder, [column for column in order if column not in changed], rows)]
+        return pd.concat(parts, axis=1)[order]
+
+    def scan(self, columns, partitions=None):
+        """Reads columns of several scenarios into one DataFrame, with the partition keys as the first columns
+
+        Arguments
+        ---------
+        columns : list
+        partitions : list of dict, optional
+            By default all scenarios are read
+        """
+        frames = []
+        for partition in self.partitions() if partitions is None else partitions:
+            df = self.read(partition, columns)
+            for position, (key, value) in enumerate(partition.items()):
+                df.insert(position, key, value)
+            frames.append(df)
+        return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,101 @@
+import json
+import os
+
+import pandas as pd
+from onsset.config import Config
+from pytest import fixture, mark, raises
+
+SPECS_PATH = os.path.join('test', 'test_data', 'dj-specs-test.xlsx')
+
+
+@fixture
+def config():
+    return Config.load(SPECS_PATH)
+
+
+class TestConfig:
+
+    def test_parses_sheets(self, config):
+        assert config.specs['CountryCode'] == 'dj'
+        assert config.specs['StartYear'] == 2018 and isinstance(config.specs['StartYear'], int)
+        assert config.calibrated_specs is None
+        assert len(config.scenario_parameters) == 3
+
+    def test_expands_scenarios(self, config):
+        [scenario] = config.scenarios
+
+        assert scenario.number == 0
+        assert scenario.end_year_pop == 1.0
+        assert (scenario.rural_tier, scenario.urban_tier) == (3, 5)
+        assert scenario.annual_new_grid_connections_limit == 3.587579806 * 1000
+        assert scenario.grid_price == 0.03
+        assert scenario.pv_capital_cost_adjust == 1.0
+        assert (scenario.prioritization, scenario.auto_intensification) == (5, 0)
+        assert scenario.algorithm == 'rounds'
+        assert scenario.hydro_allocation == 'dataframe'
+
+    def test_optional_parameters(self, config):
+        sheets = config.to_dict()
+        for row in sheets['scenario_parameters']:
+            row.update(GridExtensionAlgorithm='priority', HydroAllocation='advantage')
+
+        [scenario] = Config.from_dict(sheets).scenarios
+
+        assert (scenario.algorithm, scenario.hydro_allocation) == ('priority', 'advantage')
+
+    def test_missing_optional_parameters(self, config):
+        sheets = config.to_dict()
+        for row in sheets['scenario_parameters']:
+            row.update(GridExtensionAlgorithm=float('nan'), HydroAllocation=float('nan'))
+
+        [scenario] = Config.from_dict(sheets).scenarios
+
+        assert (scenario.algorithm, scenario.hydro_allocation) == ('rounds', 'dataframe')
+
+    def test_load_is_cached(self, config):
+        assert Config.load(SPECS_PATH) is config
+        assert Config.load(config) is config
+
+    @mark.parametrize('extension', ['json', 'toml'])
+    def test_round_trip(self, config, tmpdir, extension):
+        config = config.with_calibrated_specs(dict(config.specs, ElecModelled=0.61, Buffer_used=True))
+        path = os.path.join(str(tmpdir), 'config.' + extension)
+
+        config.save(path)
+        actual = Config.load(path)
+
+        # NaN is not equal to itself, so the configs are compared in their serialised form
+        assert json.dumps(actual.to_dict()) == json.dumps(config.to_dict())
+        assert vars(actual.scenarios[0]) == vars(config.scenarios[0])
+
+    def test_saves_only_config_sheets(self, config, tmpdir):
+        path = os.path.join(str(tmpdir), 'specs.xlsx')
+
+        config.with_calibrated_specs(config.specs_frame()).save(path)
+
+        assert pd.ExcelFile(path).sheet_names == ['SpecsData', 'SpecsDataCalib', 'ScenarioInfo', 'ScenarioParameters']
+        assert json.dumps(Config.load(path).calibrated_specs) == json.dumps(config.specs)
+
+    @mark.parametrize('sheet, column, value, message', [
+        ('specs', 'StartYear', 2018.5, 'SpecsData StartYear'),
+        ('specs', 'CountryCode', float('nan'), 'SpecsData has no CountryCode'),
+        ('scenario_info', 'PV_cost_adjust', 3, 'ScenarioInfo row 0 PV_cost_adjust'),
+        ('scenario_info', 'Population_Growth', 2, 'ScenarioParameters row 2 PopEndYear'),
+        ('scenario_info', 'Scenario', float('nan'), 'ScenarioInfo row 0 Scenario'),
+        ('scenario_parameters', 'GridExtensionAlgorithm', 'round', 'ScenarioParameters row 0 GridExtensionAlgorithm'),
+        ('scenario_parameters', 'HydroAllocation', 'greedy', 'ScenarioParameters row 0 HydroAllocation')])
+    def test_validates(self, config, sheet, column, value, message):
+        sheets = config.to_dict()
+        rows = sheets[sheet] if isinstance(sheets[sheet], list) else [sheets[sheet]]
+        rows[0] = dict(rows[0], **{column: value})
+        sheets[sheet] = rows if isinstance(sheets[sheet], list) else rows[0]
+
+        with raises(ValueError, match=message):
+            Config.from_dict(sheets)
+
+    def test_validates_scenario_column(self, config):
+        sheets = config.to_dict()
+        del sheets['scenario_info'][0]['Scenario']
+
+        with raises(ValueError, match='ScenarioInfo row 0 Scenario'):
+            Config.from_dict(sheets)
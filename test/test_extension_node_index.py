@@ -0,0 +1,57 @@
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+from onsset import SET_GRID_PENALTY, SET_X_DEG, SET_Y_DEG, ExtensionNodeIndex, SettlementGraph
+from pandas import DataFrame
+from pytest import mark
+
+
+@mark.parametrize('active_share, max_neighbours', [(0.5, 256), (0.01, 256), (0.01, 8)])
+def test_nearest_active_node(active_share, max_neighbours):
+    rng = np.random.RandomState(3)
+    x = rng.uniform(40, 44, 2000)
+    y = rng.uniform(10, 13, 2000)
+    nodes = np.flatnonzero(rng.uniform(size=2000) < active_share)
+    positions = np.setdiff1d(np.arange(2000), nodes)
+
+    node_index = ExtensionNodeIndex(x, y, max_neighbours=max_neighbours)
+    node_index.activate(np.arange(10))
+    node_index.activate(nodes)
+    actual = node_index.nearest(positions)
+
+    distances = np.hypot(x[positions, None] - x[nodes], y[positions, None] - y[nodes])
+    assert_array_equal(actual, nodes[distances.argmin(axis=1)])
+
+
+def test_neighbour_graph():
+    rng = np.random.RandomState(4)
+    x = rng.uniform(40, 44, 300)
+    y = rng.uniform(10, 13, 300)
+
+    indptr, indices = ExtensionNodeIndex(x, y).neighbour_graph(5)
+
+    edges = {(i, j) for i in range(300) for j in indices[indptr[i]:indptr[i + 1]]}
+    assert all((j, i) in edges for i, j in edges)
+    assert all(i != j for i, j in edges)
+    distances = np.hypot(x[:, None] - x, y[:, None] - y)
+    np.fill_diagonal(distances, np.inf)
+    nearest = np.argsort(distances, axis=1)[:, :5]
+    assert all((i, j) in edges for i in range(300) for j in nearest[i])
+
+
+def test_settlement_graph_cache(tmpdir):
+    rng = np.random.RandomState(5)
+    df = DataFrame({SET_X_DEG: rng.uniform(40, 44, 200),
+                    SET_Y_DEG: rng.uniform(10, 13, 200),
+                    SET_GRID_PENALTY: rng.uniform(1, 1.5, 200)})
+    csv_path = str(tmpdir.join('settlements.csv'))
+    df.to_csv(csv_path, index=False)
+
+    built = SettlementGraph.cached(csv_path, df, neighbours=4)
+    loaded = SettlementGraph.cached(csv_path, df, neighbours=4)
+
+    assert isinstance(loaded.indices, np.memmap)
+    for name in SettlementGraph.arrays:
+        assert_array_equal(getattr(loaded, name), getattr(built, name))
+    sources, targets, distance, distance_adjusted = loaded.edges(np.array([3, 7]))
+    assert_array_equal(np.unique(sources), [3, 7])
+    assert_allclose(distance_adjusted, distance * df[SET_GRID_PENALTY].values[targets])
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_array_equal
+from onsset import (SET_ENERGY_PER_CELL, SET_HYDRO, SET_HYDRO_DIST, SET_HYDRO_FID, SET_LCOE_MG_HYDRO,
+                    SET_LCOE_MG_PV, SET_LCOE_SA_PV, SettlementProcessor, Technology)
+from pytest import fixture
+
+
+def loop_limit_hydro_usage(df, mg_hydro_calc, year):
+    """The site-by-site implementation that ``SettlementProcessor.limit_hydro_usage`` replaces"""
+    hydro_lcoe = df[SET_LCOE_MG_HYDRO + "{}".format(year)].copy()
+    hydro_df = df[[SET_HYDRO_FID, SET_HYDRO]].drop_duplicates(subset=SET_HYDRO_FID).set_index(SET_HYDRO_FID)
+    additional_capacity = (df[SET_ENERGY_PER_CELL + "{}".format(year)] /
+                           (8760 * mg_hydro_calc.capacity_factor * mg_hydro_calc.base_to_peak_load_ratio *
+                            (1 - mg_hydro_calc.distribution_losses)))
+    for index, row in hydro_df.iterrows():
+        usage = additional_capacity.loc[(df[SET_HYDRO_FID] == index) & (df[SET_HYDRO_DIST] < 5)]
+        if usage.sum() > hydro_df[SET_HYDRO][index]:
+            usage_cumsum = usage.cumsum()
+            hydro_lcoe[usage_cumsum.loc[usage_cumsum > hydro_df[SET_HYDRO][index]].index] = 99
+    hydro_lcoe[df[SET_HYDRO_DIST] > 5] = 99
+    return hydro_lcoe.values
+
+
+class TestLimitHydroUsage:
+
+    @fixture
+    def setup_settlementprocessor(self) -> SettlementProcessor:
+        settlementprocessor = SettlementProcessor(os.path.join('test', 'test_data', 'dj-test.csv'))
+        rng = np.random.RandomState(6)
+        n = 2000
+        sites = rng.randint(0, 300, n)
+        settlementprocessor.df = pd.DataFrame({SET_HYDRO_FID: sites,
+                                               SET_HYDRO: rng.uniform(0, 200, 300)[sites],
+                                               SET_HYDRO_DIST: rng.uniform(0, 8, n),
+                                               SET_ENERGY_PER_CELL + '2030': rng.uniform(0, 2e5, n),
+                                               SET_LCOE_MG_HYDRO + '2030': rng.uniform(0.1, 0.5, n),
+                                               SET_LCOE_MG_PV + '2030': rng.uniform(0.1, 0.5, n),
+                                               SET_LCOE_SA_PV + '2030': rng.uniform(0.1, 0.5, n)})
+        return settlementprocessor
+
+    @fixture
+    def setup_hydro(self):
+        Technology.set_default_values(base_year=2018, start_year=2018, end_year=2030, discount_rate=0.08)
+        return Technology(om_costs=0.02, capital_cost={float("inf"): 3000}, tech_life=30, capacity_factor=0.5,
+                          base_to_peak_load_ratio=0.85, distribution_losses=0.05, mini_grid=True)
+
+    def test_matches_site_loop(self, setup_settlementprocessor, setup_hydro):
+        sp = setup_settlementprocessor
+        expected = loop_limit_hydro_usage(sp.df, setup_hydro, 2030)
+
+        sp.limit_hydro_usage(setup_hydro, 2030)
+
+        assert (expected == 99).sum() > 0
+        assert_array_equal(sp.df[SET_LCOE_MG_HYDRO + '2030'].values, expected)
+
+    def test_advantage_allocation(self, setup_settlementprocessor, setup_hydro):
+        sp = setup_settlementprocessor
+        hydro_lcoe = sp.df[SET_LCOE_MG_HYDRO + '2030'].values.copy()
+        advantage = sp.df[[SET_LCOE_MG_PV + '2030', SET_LCOE_SA_PV + '2030']].min(axis=1).values - hydro_lcoe
+
+        sp.limit_hydro_usage(setup_hydro, 2030, 'advantage', [SET_LCOE_MG_PV, SET_LCOE_SA_PV])
+
+        near = sp.df[SET_HYDRO_DIST].values < 5
+        capacity = sp.df[SET_ENERGY_PER_CELL + '2030'].values / (8760 * 0.5 * 0.85 * 0.95)
+        expected = np.where(sp.df[SET_HYDRO_DIST].values > 5, 99, hydro_lcoe)
+        for site in np.unique(sp.df[SET_HYDRO_FID]):
+            in_site = np.flatnonzero(near & (sp.df[SET_HYDRO_FID].values == site))
+            in_site = in_site[np.argsort(-advantage[in_site], kind='stable')]
+            site_capacity = sp.df[SET_HYDRO].values[in_site[0]] if len(in_site) else 0
+            expected[in_site[np.cumsum(capacity[in_site]) > site_capacity]] = 99
+
+        assert_array_equal(sp.df[SET_LCOE_MG_HYDRO + '2030'].values, expected)
@@ -0,0 +1,170 @@
+import numpy as np
+from numpy.testing import assert_allclose
+from onsset import GridLcoeEvaluator, Technology
+from pytest import fixture, mark
+
+
+def matrix_lcoe(tech, generation_per_year, total_investment_cost, total_om_cost, peak_load, fuel_cost,
+                start_year, end_year):
+    """The settlements x project years implementation that ``Technology.discounted_lcoe`` replaces"""
+    project_life = end_year - tech.base_year + 1
+    reinvest_year = 0
+    step = start_year - tech.base_year
+    if tech.tech_life + step < project_life:
+        reinvest_year = tech.tech_life + step
+
+    year = np.arange(project_life)
+    el_gen = np.outer(generation_per_year, np.ones(project_life))
+    for s in range(step):
+        el_gen[:, s] = 0
+    discount_factor = (1 + tech.discount_rate) ** year
+    investments = np.zeros(project_life)
+    investments[step] = 1
+    if reinvest_year:
+        investments[reinvest_year] = 1
+    grid_capacity_investments = np.outer(peak_load * tech.grid_capacity_investment, investments)
+    investments = np.outer(total_investment_cost, investments)
+
+    salvage = np.zeros(project_life)
+    if reinvest_year > 0:
+        used_life = (project_life - step) - tech.tech_life
+    else:
+        used_life = project_life - step - 1
+    salvage[-1] = 1
+    salvage = np.outer(total_investment_cost * (1 - used_life / tech.tech_life), salvage)
+
+    operation_and_maintenance = np.ones(project_life)
+    for s in range(step):
+        operation_and_maintenance[s] = 0
+    operation_and_maintenance = np.outer(total_om_cost, operation_and_maintenance)
+    fuel = np.zeros((len(generation_per_year), project_life))
+    for p in range(project_life):
+        fuel[:, p] = el_gen[:, p] * fuel_cost
+
+    investment_cost = np.sum(investments / discount_factor, axis=1) + \
+        np.sum(grid_capacity_investments / discount_factor, axis=1)
+    discounted_costs = (investments + operation_and_maintenance + fuel - salvage) / discount_factor
+    discounted_generation = el_gen / discount_factor
+    lcoe = np.sum(discounted_costs, axis=1) / np.sum(discounted_generation, axis=1)
+    return lcoe, investment_cost
+
+
+class TestDiscountedLcoe:
+
+    @fixture
+    def setup_inputs(self):
+        rng = np.random.RandomState(42)
+        n = 1000
+        return {'generation_per_year': rng.uniform(1, 1e6, n),
+                'peak_load': rng.uniform(0.01, 500, n),
+                'td_investment_cost': rng.uniform(0, 1e6, n),
+                'people': rng.uniform(1, 5000, n),
+                'num_people_per_hh': rng.uniform(3, 8, n),
+                'capacity_factor': rng.uniform(0.1, 0.9, n),
+                'grid_penalty_ratio': rng.uniform(0.9, 1.5, n),
+                'fuel_cost': rng.uniform(0, 0.5, n)}
+
+    @mark.parametrize('tech_life, start_year, grid_price', [(30, 2018, 0.08),
+                                                            (20, 2025, 0),
+                                                            (10, 2018, 0),
+                                                            (15, 2025, 0)])
+    def test_matches_matrix_implementation(self, setup_inputs, tech_life, start_year, grid_price):
+        Technology.set_default_values(base_year=2018, start_year=2018, end_year=2030, discount_rate=0.08)
+        tech = Technology(tech_life=tech_life,
+                          om_costs=0.02,
+                          om_of_td_lines=0.02,
+                          capital_cost={float("inf"): 3000, 1: 4470, 0.1: 6380},
+                          grid_capacity_investment=2000,
+                          grid_price=grid_price)
+        inputs = setup_inputs
+
+        lcoe, investment_cost, installed_capacity = tech.discounted_lcoe(start_year=start_year, end_year=2030,
+                                                                         **inputs)
+
+        td_investment_cost = inputs['td_investment_cost'] * np.maximum(1, inputs['grid_penalty_ratio'])
+        cap_cost = np.where(installed_capacity < 0.1, 6380, np.where(installed_capacity < 1, 4470, 3000))
+        total_investment_cost = td_investment_cost + installed_capacity * cap_cost
+        total_om_cost = td_investment_cost * 0.02 + cap_cost * 0.02 * installed_capacity
+        fuel_cost = grid_price if grid_price > 0 else inputs['fuel_cost']
+
+        expected_lcoe, expected_investment = matrix_lcoe(tech, inputs['generation_per_year'], total_investment_cost,
+                                                         total_om_cost, inputs['peak_load'], fuel_cost,
+                                                         start_year, 2030)
+
+        assert_allclose(installed_capacity, inputs['peak_load'] / inputs['capacity_factor'])
+        assert_allclose(lcoe, expected_lcoe, rtol=1e-12)
+        assert_allclose(investment_cost, expected_investment, rtol=1e-12)
+
+
+class TestGridLcoeEvaluator:
+
+    @fixture
+    def setup_grid(self):
+        Technology.set_default_values(base_year=2018, start_year=2018, end_year=2030, discount_rate=0.08)
+        return Technology(om_of_td_lines=0.02,
+                          distribution_losses=0.1,
+                          connection_cost_per_hh=125,
+                          base_to_peak_load_ratio=0.8,
+                          capacity_factor=1,
+                          tech_life=30,
+                          grid_capacity_investment=2000,
+                          grid_price=0.08)
+
+    @fixture
+    def setup_settlements(self):
+        rng = np.random.RandomState(1)
+        n = 500
+        people = rng.uniform(1, 5000, n)
+        new_connections = np.where(rng.uniform(size=n) > 0.5, people, people * rng.uniform(size=n))
+        energy_per_cell = new_connections * rng.uniform(10, 500, n)
+        return {'people': people,
+                'new_connections': new_connections,
+                'energy_per_cell': energy_per_cell,
+                'total_energy_per_cell': energy_per_cell * rng.uniform(1, 2, n),
+                'prev_code': rng.choice([1, 3, 5, 99], n),
+                'num_people_per_hh': rng.uniform(3, 8, n),
+                'grid_cell_area': rng.uniform(0.01, 5, n)}
+
+    @mark.parametrize('elec_loop, additional_transformer', [(0, 0), (3, 0), (0, 1)])
+    def test_matches_get_lcoe(self, setup_grid, setup_settlements, elec_loop, additional_transformer):
+        grid = setup_grid
+        settlements = setup_settlements
+        distances = np.random.RandomState(2).uniform(0, 120, len(settlements['people']))
+
+        evaluator = GridLcoeEvaluator(grid, start_year=2018, end_year=2030, capacity_factor=1, **settlements)
+        actual = evaluator.evaluate(distances, elec_loop, additional_transformer)
+        expected = grid.get_lcoe(start_year=2018, end_year=2030, capacity_factor=1,
+                                 additional_mv_line_length=distances, elec_loop=elec_loop,
+                                 additional_transformer=additional_transformer, **settlements)
+
+        for a, e in zip(actual, expected):
+            assert_allclose(a, e, rtol=1e-12)
+
+    def test_evaluates_subset(self, setup_grid, setup_settlements):
+        grid = setup_grid
+        settlements = setup_settlements
+        distances = np.random.RandomState(2).uniform(0, 120, len(settlements['people']))
+        index = np.flatnonzero(settlements['prev_code'] != 1)
+
+        evaluator = GridLcoeEvaluator(grid, start_year=2018, end_year=2030, capacity_factor=1, **settlements)
+        actual = evaluator.evaluate(distances[index], 2, 0, index=index)
+        expected = evaluator.evaluate(distances, 2, 0)
+
+        for a, e in zip(actual, expected):
+            assert_allclose(a, e[index], rtol=1e-12)
+
+    def test_break_even_distance(self, setup_grid, setup_settlements):
+        grid = setup_grid
+        settlements = setup_settlements
+        max_lcoe = np.random.RandomState(3).uniform(0.1, 0.6, len(settlements['people']))
+        distances = np.linspace(0, 300, 1201)
+
+        evaluator = GridLcoeEvaluator(grid, start_year=2018, end_year=2030, capacity_factor=1, **settlements)
+        break_even = evaluator.break_even_distance(max_lcoe)
+
+        for i in range(len(max_lcoe)):
+            lcoe = evaluator.evaluate(distances, index=np.full(len(distances), i))[0]
+            below = distances[lcoe < max_lcoe[i]]
+            assert np.all(below <= break_even[i] * (1 + 1e-9))
+            if np.isfinite(break_even[i]) and break_even[i] > 0:
+                assert evaluator.evaluate(break_even[i] * (1 - 1e-9), index=np.array([i]))[0] < max_lcoe[i]
@@ -0,0 +1,98 @@
+import os
+
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_allclose, assert_array_equal
+from onsset import (SET_DIST_TO_TRANS, SET_ELEC_POP, SET_HV_DIST_CURRENT, SET_MV_DIST_CURRENT, SET_NIGHT_LIGHTS,
+                    SET_POP, SET_POP_CALIB, SET_URBAN, SettlementProcessor)
+from pytest import fixture
+
+
+class TestPopulation:
+
+    @fixture
+    def setup_settlementprocessor(self) -> SettlementProcessor:
+        settlementprocessor = SettlementProcessor(os.path.join('test', 'test_data', 'dj-test.csv'))
+        rng = np.random.RandomState(8)
+        n = 1000
+        pop = rng.choice(rng.uniform(0, 5000, 300), n)
+        settlementprocessor.df = pd.DataFrame({SET_POP: pop, SET_ELEC_POP: pop / 2},
+                                              index=rng.permutation(n)).sort_values(SET_POP)
+        return settlementprocessor
+
+    def test_calibrate_and_project(self, setup_settlementprocessor):
+        sp = setup_settlementprocessor
+        df = sp.df.copy()
+
+        sp.calibrate_current_pop_and_urban(1e6, 0.4)
+        sp.project_pop_and_urban(1.5e6, 0.5, 2018, [2025, 2030], projection_years=range(2019, 2031))
+
+        # Row-wise implementation that the vectorised one replaces
+        pop_ratio = 1e6 / df[SET_POP].sum()
+        df[SET_POP_CALIB] = df.apply(lambda row: row[SET_POP] * pop_ratio, axis=1)
+        df.sort_values(by=[SET_POP_CALIB], inplace=True, ascending=False)
+        cumulative_urban_pop = df[SET_POP_CALIB].cumsum()
+        df[SET_URBAN] = np.where(cumulative_urban_pop < (0.4 * df[SET_POP_CALIB].sum()), 2, 0)
+        df.sort_index(inplace=True)
+
+        assert_array_equal(sp.df.index, df.index)
+        assert_array_equal(sp.df[SET_POP_CALIB], df[SET_POP_CALIB])
+        assert_array_equal(sp.df[SET_URBAN], df[SET_URBAN])
+
+        urban_ratio = df.loc[df[SET_URBAN] > 1, SET_POP_CALIB].sum() / 1e6
+        urban_rate = (0.5 * 1.5e6 / (urban_ratio * 1e6)) ** (1 / 12)
+        rural_rate = (0.5 * 1.5e6 / ((1 - urban_ratio) * 1e6)) ** (1 / 12)
+        for year in [2018, 2019, 2025, 2030]:
+            expected = df.apply(lambda row: row[SET_POP_CALIB] * (urban_rate ** (year - 2018))
+                                if row[SET_URBAN] > 1 else row[SET_POP_CALIB] * (rural_rate ** (year - 2018)), axis=1)
+            assert_array_equal(sp.df[SET_POP + str(year)], expected)
+
+
+def test_capped_scaling_factor():
+    rng = np.random.RandomState(9)
+    values = rng.uniform(0, 100, 500)
+    caps = values * rng.uniform(0.5, 3, 500)
+
+    for target in [0.3 * values.sum(), values.sum(), 1.5 * values.sum(), caps.sum() * 0.999]:
+        factor = SettlementProcessor.capped_scaling_factor(values, caps, target)
+        assert_allclose(np.minimum(values * factor, caps).sum(), target, rtol=1e-12)
+
+    factor = SettlementProcessor.capped_scaling_factor(values, caps, 2 * caps.sum())
+    assert_array_equal(np.minimum(values * factor, caps), caps)
+
+
+def test_buffer_distance():
+    grid_dist = np.array([3.0, 0.5, 1.2, 0.5, 8.0])
+    pop = np.array([100, 200, 300, 400, 500])
+
+    assert SettlementProcessor.buffer_distance(grid_dist, pop, 550) == 0.5
+    assert SettlementProcessor.buffer_distance(grid_dist, pop, 600) == 1.2
+    assert SettlementProcessor.buffer_distance(grid_dist, pop, 950) == 3
+    assert SettlementProcessor.buffer_distance(grid_dist, pop, 1100) == 5
+    assert SettlementProcessor.buffer_distance(grid_dist, pop, 2000) == 5
+
+
+def test_calibration_sweep():
+    sp = SettlementProcessor(os.path.join('test', 'test_data', 'dj-test.csv'))
+    rng = np.random.RandomState(10)
+    n = 1000
+    sp.df = pd.DataFrame({SET_POP_CALIB: rng.uniform(0, 500, n),
+                          SET_URBAN: rng.choice([0, 2], n),
+                          SET_NIGHT_LIGHTS: rng.choice([0, 0.5, 3, 10], n),
+                          SET_DIST_TO_TRANS: 99999,
+                          SET_MV_DIST_CURRENT: rng.uniform(0, 10, n),
+                          SET_HV_DIST_CURRENT: rng.uniform(0, 50, n)})
+    df = sp.df
+
+    sweep = sp.calibration_sweep(0.5, 0.8, 0.3, min_night_lights=[0, 1, 5], min_pop=[0, 50, 200],
+                                 dist_limit=[1, 2, 5])
+
+    assert len(sweep) == 27
+    assert sweep['deviation'].is_monotonic_increasing
+    for _, row in sweep.iterrows():
+        electrified = ((df[SET_MV_DIST_CURRENT] < row['grid_distance_used']) &
+                       (df[SET_NIGHT_LIGHTS] > row['ntl_limit']) & (df[SET_POP_CALIB] > row['pop_limit']))
+        assert_allclose(row['elec_modelled'], df.loc[electrified, SET_POP_CALIB].sum() / df[SET_POP_CALIB].sum())
+        urban = df[SET_URBAN] == 2
+        assert_allclose(row['urban_elec_ratio_modelled'],
+                        df.loc[electrified & urban, SET_POP_CALIB].sum() / df.loc[urban, SET_POP_CALIB].sum())
@@ -11,19 +11,32 @@ changes the contents of the output files.
 
 import filecmp
 import os
-from shutil import copyfile
+from shutil import copyfile, copytree, ignore_patterns
 from tempfile import TemporaryDirectory
 
+import pandas as pd
+from onsset import (SET_ELEC_FINAL_CODE, SET_INVESTMENT_COST, SET_X_DEG, SET_Y_DEG, ColumnStore, ResultDataset,
+                    SettlementProcessor, StageCache)
+from onsset import runner
+from onsset.cache import code_version
+from onsset.config import Config
 from onsset.runner import calibration, scenario
+from pandas.testing import assert_frame_equal
+from pytest import fixture, mark, raises
 
 
-def run_analysis(tmpdir):
+def run_analysis(tmpdir, processes=1, stage_cache=None, memory_budget=None):
     """
 
     Arguments
     ---------
     tmpdir : str
         Temporary directory to use for the calculated files
+    processes : int, optional
+        Number of worker processes to run the scenarios on
+    stage_cache : onsset.StageCache, optional
+    memory_budget : int, optional
+        Bytes of settlements to calibrate at a time, and that a chunk of the scenarios' LCOE calculation may take up
 
     Returns
     -------
@@ -37,9 +50,10 @@ def run_analysis(tmpdir):
     calibrated_csv_path = os.path.join(tmpdir, 'dj-calibrated.csv')
     specs_path_calib = os.path.join(tmpdir, 'dj-specs-test-calib.xlsx')
 
-    calibration(specs_path, csv_path, specs_path_calib, calibrated_csv_path)
+    calibration(specs_path, csv_path, specs_path_calib, calibrated_csv_path, memory_budget=memory_budget)
 
-    scenario(specs_path_calib, calibrated_csv_path, tmpdir, tmpdir)
+    scenario(specs_path_calib, calibrated_csv_path, tmpdir, tmpdir, processes=processes, stage_cache=stage_cache,
+             chunk_memory=memory_budget)
 
     actual = os.path.join(tmpdir, 'dj-1-1_1_1_1_0_0_summary.csv')
     expected = os.path.join('test', 'test_results', 'expected_summary.csv')
@@ -53,6 +67,26 @@ def run_analysis(tmpdir):
     return summary, full
 
 
+@fixture(scope='module')
+def calibrated(tmp_path_factory):
+    """Calibrates the test settlements once for the tests that only run scenarios on them
+
+    Returns
+    -------
+    tuple of str
+        The calibrated specs file, the calibrated settlements and a calibration cache folder holding the calibration,
+        from which it can be restored to other output files
+    """
+    folder = str(tmp_path_factory.mktemp('calibrated'))
+    specs_path = os.path.join('test', 'test_data', 'dj-specs-test.xlsx')
+    csv_path = os.path.join('test', 'test_data', 'dj-test.csv')
+    calibrated_csv_path = os.path.join(folder, 'dj-calibrated.csv')
+    specs_path_calib = os.path.join(folder, 'dj-specs-test-calib.xlsx')
+    cache_folder = os.path.join(folder, 'cache')
+    calibration(specs_path, csv_path, specs_path_calib, calibrated_csv_path, cache_folder=cache_folder)
+    return specs_path_calib, calibrated_csv_path, cache_folder
+
+
 def test_regression_summary():
     """A regression test to track changes to the summary results of OnSSET
 
@@ -65,12 +99,270 @@ def test_regression_summary():
     assert full
 
 
+def test_regression_parallel():
+    """Running the scenarios on a process pool gives the same files as running them one by one
+
+    """
+
+    with TemporaryDirectory() as tmpdir:
+        summary, full = run_analysis(tmpdir, processes=2)
+
+    assert summary
+    assert full
+
+
+def test_parallel_scenarios(calibrated):
+    """Several scenarios on a process pool give the same files, in the same order, as running them one by one
+
+    """
+    specs_path_calib, calibrated_csv_path, _ = calibrated
+    with TemporaryDirectory() as tmpdir:
+
+        sheets = Config.load(specs_path_calib).to_dict()
+        sheets['scenario_info'].append(dict(sheets['scenario_info'][0], Scenario=1, Population_Growth=0,
+                                            Prioritization_algorithm=1))
+        config = Config.from_dict(sheets)
+
+        outputs = {}
+        for processes in (1, 2):
+            folder = os.path.join(tmpdir, str(processes))
+            os.makedirs(folder)
+            outputs[processes] = scenario(config, calibrated_csv_path, folder, folder, processes=processes)
+
+        names = [[os.path.basename(path) for path in files] for files in outputs[2]]
+        assert names == [['dj-1-1_1_1_1_0_0.csv', 'dj-1-1_1_1_1_0_0_summary.csv'],
+                         ['dj-1-0_1_1_1_0_1.csv', 'dj-1-0_1_1_1_0_1_summary.csv']]
+        for sequential, parallel in zip(outputs[1], outputs[2]):
+            for sequential_path, parallel_path in zip(sequential, parallel):
+                assert filecmp.cmp(sequential_path, parallel_path, shallow=False)
+        assert not filecmp.cmp(outputs[2][0][1], outputs[2][1][1], shallow=False)
+
+
+def test_regression_memory_budget():
+    """Streaming the settlements in chunks gives the same files as processing them at once
+
+    """
+
+    with TemporaryDirectory() as tmpdir:
+        summary, full = run_analysis(tmpdir, memory_budget=200000)
+
+    assert summary
+    assert full
+
+
+def test_regression_stage_cache():
+    """A scenario restored from the stage cache gives the same files as computing it
+
+    """
+    stage_cache = StageCache()
+
+    with TemporaryDirectory() as tmpdir:
+        run_analysis(tmpdir, stage_cache=stage_cache)
+    misses = stage_cache.misses
+    with TemporaryDirectory() as tmpdir:
+        summary, full = run_analysis(tmpdir, stage_cache=stage_cache)
+
+    assert stage_cache.misses == misses
+    assert stage_cache.hits == misses
+    assert summary
+    assert full
+
+
+def test_calibration_cache(monkeypatch):
+    """A calibration restored from the cache gives the same files as calibrating
+
+    """
+    specs_path = os.path.join('test', 'test_data', 'dj-specs-test.xlsx')
+    csv_path = os.path.join('test', 'test_data', 'dj-test.csv')
+
+    with TemporaryDirectory() as tmpdir:
+        cache_folder = os.path.join(tmpdir, 'cache')
+        stale = os.path.join(cache_folder, 'stale')
+        os.makedirs(stale)
+        calibrated_csv_path = os.path.join(tmpdir, 'dj-calibrated.csv')
+        specs_path_calib = os.path.join(tmpdir, 'dj-specs-test-calib.xlsx')
+        calibration(specs_path, csv_path, specs_path_calib, calibrated_csv_path, cache_folder=cache_folder)
+        assert not os.path.exists(stale)
+        assert len(os.listdir(cache_folder)) == 1
+
+        def recalibrated(self):
+            raise AssertionError('The calibration was not restored from the cache')
+        monkeypatch.setattr(SettlementProcessor, 'condition_df', recalibrated)
+        restored_csv_path = os.path.join(tmpdir, 'dj-restored.csv')
+        restored_specs_path = os.path.join(tmpdir, 'dj-specs-test-restored.xlsx')
+        calibration(specs_path, csv_path, restored_specs_path, restored_csv_path, cache_folder=cache_folder)
+
+        assert filecmp.cmp(calibrated_csv_path, restored_csv_path, shallow=False)
+        assert_frame_equal(pd.read_excel(restored_specs_path, sheet_name='SpecsDataCalib'),
+                           pd.read_excel(specs_path_calib, sheet_name='SpecsDataCalib'))
+
+
+def test_calibration_cache_code_version(monkeypatch):
+    """Changing any module of the package invalidates the cached calibrations
+
+    """
+    specs_path = os.path.join('test', 'test_data', 'dj-specs-test.xlsx')
+    csv_path = os.path.join('test', 'test_data', 'dj-test.csv')
+
+    with TemporaryDirectory() as tmpdir:
+        package = os.path.join(tmpdir, 'onsset')
+        copytree(os.path.dirname(runner.__file__), package, ignore=ignore_patterns('__pycache__'))
+        version = code_version(package)
+        with open(os.path.join(package, 'storage.py'), 'a') as module:
+            module.write('\n')
+        assert code_version(package) != version
+
+        cache_folder = os.path.join(tmpdir, 'cache')
+        calibrated_csv_path = os.path.join(tmpdir, 'dj-calibrated.csv')
+        specs_path_calib = os.path.join(tmpdir, 'dj-specs-test-calib.xlsx')
+        calibration(specs_path, csv_path, specs_path_calib, calibrated_csv_path, cache_folder=cache_folder)
+        entries = os.listdir(cache_folder)
+
+        monkeypatch.setattr(runner, 'code_version', lambda: code_version(package))
+        calibration(specs_path, csv_path, specs_path_calib, calibrated_csv_path, cache_folder=cache_folder)
+        assert len(os.listdir(cache_folder)) == 1
+        assert os.listdir(cache_folder) != entries
+
+
+def test_resume(monkeypatch, calibrated):
+    """A scenario interrupted in its last year resumes from the checkpoint of the year before
+
+    """
+    specs_path_calib, calibrated_csv_path, _ = calibrated
+    apply_limitations = SettlementProcessor.apply_limitations
+
+    def interrupted(self, eleclimit, year, *args, **kwargs):
+        if year == 2030:
+            raise MemoryError
+        return apply_limitations(self, eleclimit, year, *args, **kwargs)
+
+    def repeated(*args, **kwargs):
+        raise AssertionError('A finished year was run again')
+
+    with TemporaryDirectory() as tmpdir:
+
+        monkeypatch.setattr(SettlementProcessor, 'apply_limitations', interrupted)
+        with raises(MemoryError):
+            scenario(specs_path_calib, calibrated_csv_path, tmpdir, tmpdir, resume=True)
+        assert os.path.exists(os.path.join(tmpdir, 'checkpoints', 'dj-1-1_1_1_1_0_0'))
+
+        monkeypatch.setattr(SettlementProcessor, 'apply_limitations', apply_limitations)
+        monkeypatch.setattr(SettlementProcessor, 'project_pop_and_urban', repeated)
+        scenario(specs_path_calib, calibrated_csv_path, tmpdir, tmpdir, resume=True)
+
+        assert not os.path.exists(os.path.join(tmpdir, 'checkpoints', 'dj-1-1_1_1_1_0_0'))
+        assert filecmp.cmp(os.path.join(tmpdir, 'dj-1-1_1_1_1_0_0_summary.csv'),
+                           os.path.join('test', 'test_results', 'expected_summary.csv'))
+        assert filecmp.cmp(os.path.join(tmpdir, 'dj-1-1_1_1_1_0_0.csv'),
+                           os.path.join('test', 'test_results', 'expected_full.csv'))
+
+        # Finished scenarios are skipped
+        monkeypatch.setattr(SettlementProcessor, '__init__', repeated)
+        scenario(specs_path_calib, calibrated_csv_path, tmpdir, tmpdir, resume=True)
+
+
+def test_output_columns(calibrated):
+    """Only the requested columns are written, with the same values as in the full results
+
+    """
+    specs_path_calib, calibrated_csv_path, _ = calibrated
+    output_columns = [SET_X_DEG, SET_Y_DEG, SET_ELEC_FINAL_CODE, SET_INVESTMENT_COST]
+
+    with TemporaryDirectory() as tmpdir:
+
+        scenario(specs_path_calib, calibrated_csv_path, tmpdir, tmpdir, output_columns=output_columns)
+
+        actual = pd.read_csv(os.path.join(tmpdir, 'dj-1-1_1_1_1_0_0.csv'))
+        assert filecmp.cmp(os.path.join(tmpdir, 'dj-1-1_1_1_1_0_0_summary.csv'),
+                           os.path.join('test', 'test_results', 'expected_summary.csv'))
+
+    expected = pd.read_csv(os.path.join('test', 'test_results', 'expected_full.csv'))
+    assert list(actual.columns) == [SET_X_DEG, SET_Y_DEG, 'FinalElecCode2018', 'InvestmentCost2025',
+                                    'FinalElecCode2025', 'InvestmentCost2030', 'FinalElecCode2030']
+    assert_frame_equal(actual, expected[actual.columns])
+
+
+@mark.parametrize('output_columns, results_format', [('planning', 'csv.gz'), ('summary', 'csv')])
+def test_output_column_sets(calibrated, output_columns, results_format):
+    """Named column sets and compressed results files hold the same values as the full results
+
+    """
+    specs_path_calib, calibrated_csv_path, _ = calibrated
+    with TemporaryDirectory() as tmpdir:
+
+        [(results_path, summary_path)] = scenario(specs_path_calib, calibrated_csv_path, tmpdir, tmpdir,
+                                                  output_columns=output_columns, results_format=results_format)
+
+        assert filecmp.cmp(summary_path, os.path.join('test', 'test_results', 'expected_summary.csv'))
+        if output_columns == 'summary':
+            assert results_path is None
+            assert os.listdir(tmpdir) == ['dj-1-1_1_1_1_0_0_summary.csv']
+            return
+        assert results_path == os.path.join(tmpdir, 'dj-1-1_1_1_1_0_0.csv.gz')
+        actual = pd.read_csv(results_path)
+
+    expected = pd.read_csv(os.path.join('test', 'test_results', 'expected_full.csv'))
+    assert SET_INVESTMENT_COST + '2030' in actual.columns
+    assert len(actual.columns) < len(expected.columns)
+    assert_frame_equal(actual, expected[actual.columns])
+
+
+def test_result_dataset(calibrated):
+    """A scenario read back from the dataset matches the full results, without storing the unchanged columns again
+
+    """
+    specs_path_calib, calibrated_csv_path, _ = calibrated
+    with TemporaryDirectory() as tmpdir:
+
+        [(partition_folder, _)] = scenario(specs_path_calib, calibrated_csv_path, tmpdir, tmpdir,
+                                           results_format='dataset')
+
+        dataset = ResultDataset(os.path.join(tmpdir, 'dj-1-dataset'))
+        [partition] = dataset.partitions()
+        assert dataset.partition_folder(partition) == partition_folder
+        assert partition['Population_Growth'] == 1 and partition['Prioritization_algorithm'] == 0
+        changed = [entry['name'] for entry in ColumnStore.metadata(partition_folder)['columns']]
+        assert SET_X_DEG not in changed and SET_ELEC_FINAL_CODE + '2030' in changed
+
+        actual = dataset.read(partition).to_csv(index=False)
+        scanned = dataset.scan([SET_X_DEG, SET_ELEC_FINAL_CODE + '2030'])
+
+    with open(os.path.join('test', 'test_results', 'expected_full.csv'), newline='') as expected:
+        assert actual == expected.read()
+    assert list(scanned.columns[-3:]) == ['Prioritization_algorithm', SET_X_DEG, SET_ELEC_FINAL_CODE + '2030']
+
+
+def test_compiled_config(calibrated):
+    """The calibrated specs can be written as a JSON config, which the scenarios then run from without Excel
+
+    """
+    _, _, cache_folder = calibrated
+    with TemporaryDirectory() as tmpdir:
+        specs_path = os.path.join('test', 'test_data', 'dj-specs-test.xlsx')
+        csv_path = os.path.join('test', 'test_data', 'dj-test.csv')
+        calibrated_csv_path = os.path.join(tmpdir, 'dj-calibrated.csv')
+        config_path = os.path.join(tmpdir, 'dj-config.json')
+        calibration(specs_path, csv_path, config_path, calibrated_csv_path, cache_folder=cache_folder)
+
+        scenario(config_path, calibrated_csv_path, tmpdir, tmpdir)
+
+        assert filecmp.cmp(os.path.join(tmpdir, 'dj-1-1_1_1_1_0_0_summary.csv'),
+                           os.path.join('test', 'test_results', 'expected_summary.csv'))
+        assert filecmp.cmp(os.path.join(tmpdir, 'dj-1-1_1_1_1_0_0.csv'),
+                           os.path.join('test', 'test_results', 'expected_full.csv'))
+
+
+def test_unknown_results_format():
+    with raises(ValueError):
+        scenario('specs.xlsx', 'settlements.csv', '.', '.', results_format='xlsx')
+
+
 def update_test_file():
     """A utility function to produce a new test file if intended changes are made
     """
     tmpdir = '.'
 
-    summary, actual = run_analysis(tmpdir)
+    summary, full = run_analysis(tmpdir)
 
     actual = os.path.join(tmpdir, 'dj-1-1_1_1_1_0_0_summary.csv')
     expected = os.path.join('test', 'test_results', 'expected_summary.csv')
@@ -79,7 +371,7 @@ def update_test_file():
 
     actual = os.path.join(tmpdir, 'dj-1-1_1_1_1_0_0.csv')
     expected = os.path.join('test', 'test_results', 'expected_full.csv')
-    if not actual:
+    if not full:
         copyfile(actual, expected)
 
 
@@ -0,0 +1,239 @@
+import os
+
+import numpy as np
+import pandas as pd
+from onsset import (SET_COUNTRY, SET_ELEC_FINAL_CODE, SET_GHI, SET_HYDRO_FID, SET_MIN_OVERALL, SET_NIGHT_LIGHTS,
+                    SET_POP, SET_RESIDENTIAL_TIER, SET_ROAD_DIST, SET_URBAN, SET_X_DEG, ColumnStore, ResultDataset,
+                    SettlementProcessor, SettlementWriter, settlement_format)
+from pandas.testing import assert_frame_equal
+from pytest import fixture, mark, raises
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+
+@fixture
+def settlements():
+    return pd.read_csv(os.path.join('test', 'test_data', 'dj-test.csv'))
+
+
+class TestReadSettlements:
+
+    @mark.parametrize('sep', [',', ';', '\t'])
+    def test_sniffs_separator(self, settlements, tmpdir, sep):
+        path = os.path.join(str(tmpdir), 'settlements.csv')
+        settlements.to_csv(path, sep=sep, index=False)
+
+        actual = SettlementProcessor(path).df
+
+        assert list(actual.columns) == list(settlements.columns)
+        assert_frame_equal(actual.astype({SET_COUNTRY: object}), settlements, check_dtype=False)
+
+    def test_applies_schema(self, settlements, tmpdir):
+        path = os.path.join(str(tmpdir), 'settlements.csv')
+        settlements.astype({SET_POP: int}).to_csv(path, index=False)
+
+        actual = SettlementProcessor.read_settlements(path)
+
+        assert actual[SET_POP].dtype == np.float64
+        assert actual[SET_NIGHT_LIGHTS].dtype == np.float64
+        assert actual[SET_HYDRO_FID].dtype == np.int32
+        assert actual[SET_URBAN].dtype == np.int8
+        assert actual[SET_COUNTRY].dtype == 'category'
+
+    def test_keeps_thresholds_exact(self, settlements, tmpdir):
+        path = os.path.join(str(tmpdir), 'settlements.csv')
+        settlements = settlements.head(2).copy()
+        settlements[SET_ROAD_DIST] = [5.0, 5.0000001]
+        settlements[SET_NIGHT_LIGHTS] = [0.1, 0.1000001]
+        settlements.to_csv(path, index=False)
+
+        actual = SettlementProcessor.read_settlements(path)
+
+        assert list(SettlementProcessor.classify_road_distance(actual[SET_ROAD_DIST])) == [5.0, 4.0]
+        assert list(actual[SET_NIGHT_LIGHTS] > 0.1) == [False, True]
+
+    def test_falls_back_to_inferred_types(self, settlements, tmpdir):
+        path = os.path.join(str(tmpdir), 'settlements.csv')
+        settlements.loc[0, SET_HYDRO_FID] = np.nan
+        settlements.to_csv(path, index=False)
+
+        actual = SettlementProcessor.read_settlements(path)
+
+        assert np.isnan(actual.loc[0, SET_HYDRO_FID])
+        assert actual[SET_HYDRO_FID].dtype == np.float64
+        assert actual[SET_URBAN].dtype == np.int8
+
+    def test_projects_columns(self, settlements, tmpdir):
+        path = os.path.join(str(tmpdir), 'settlements.csv')
+        settlements.to_csv(path, sep=';', index=False)
+
+        actual = SettlementProcessor(path, columns=[SET_GHI, SET_X_DEG, 'NotInFile']).df
+
+        assert list(actual.columns) == [SET_X_DEG, SET_GHI]
+
+    def test_missing_ghi(self, settlements, tmpdir):
+        path = os.path.join(str(tmpdir), 'settlements.csv')
+        settlements.drop(columns=SET_GHI).to_csv(path, index=False)
+
+        with raises(KeyError):
+            SettlementProcessor(path)
+
+    @mark.skipif(not HAS_PYARROW, reason='pyarrow is needed for Parquet and Feather files')
+    @mark.parametrize('extension', ['.parquet', '.feather'])
+    def test_columnar_round_trip(self, settlements, tmpdir, extension):
+        path = os.path.join(str(tmpdir), 'settlements' + extension)
+
+        SettlementProcessor.write_settlements(settlements, path)
+
+        assert_frame_equal(SettlementProcessor(path).df, SettlementProcessor.read_settlements(path))
+        actual = SettlementProcessor(path, columns=[SET_GHI, SET_X_DEG, 'NotInFile']).df
+        assert list(actual.columns) == [SET_X_DEG, SET_GHI]
+
+
+class TestSharedColumns:
+
+    def test_round_trip(self, settlements, tmpdir):
+        folder = os.path.join(str(tmpdir), 'settlements')
+        settlements = settlements.astype({SET_URBAN: 'int8'})
+        settlements['Names'] = pd.Categorical(['a', None, 'b'] * (len(settlements) // 3) +
+                                              ['a'] * (len(settlements) % 3))
+
+        SettlementProcessor.save_columns(settlements, folder)
+
+        assert settlement_format(folder) == 'columns'
+        assert_frame_equal(SettlementProcessor.read_settlements(folder), settlements)
+        actual = SettlementProcessor.read_settlements(folder, columns=[SET_GHI, SET_X_DEG])
+        assert list(actual.columns) == [SET_X_DEG, SET_GHI]
+        actual.loc[0, SET_GHI] = 0  # the memory-mapped columns are copied
+
+
+class TestChunks:
+
+    def test_column_store_appends_chunks(self, settlements, tmpdir):
+        folder = os.path.join(str(tmpdir), 'settlements')
+        settlements['Names'] = ['a', 'b', None] * (len(settlements) // 3) + ['c'] * (len(settlements) % 3)
+
+        with ColumnStore(folder) as store:
+            for start in range(0, len(settlements), 500):
+                store.append(settlements.iloc[start:start + 500])
+
+        assert ColumnStore.metadata(folder)['rows'] == len(settlements)
+        assert_frame_equal(ColumnStore.read(folder), settlements)
+        rows = np.array([1472, 3, 700])
+        assert_frame_equal(ColumnStore.read(folder, columns=[SET_POP, 'Names'], rows=rows),
+                           settlements.iloc[rows][[SET_POP, 'Names']].reset_index(drop=True))
+
+    @mark.parametrize('file_format', ['csv', 'columns'])
+    def test_read_chunks(self, settlements, tmpdir, file_format):
+        path = os.path.join(str(tmpdir), 'settlements')
+        if file_format == 'csv':
+            path += '.csv'
+            settlements.to_csv(path, index=False)
+        else:
+            SettlementProcessor.save_columns(settlements, path)
+
+        chunks = list(SettlementProcessor.read_chunks(path, 400, columns=[SET_GHI, SET_POP]))
+
+        assert [len(chunk) for chunk in chunks] == [400, 400, 400, 273]
+        actual = pd.concat(chunks, ignore_index=True)
+        assert_frame_equal(actual, settlements[[SET_POP, SET_GHI]])
+
+    def test_writer(self, settlements, tmpdir):
+        path = os.path.join(str(tmpdir), 'settlements.csv')
+
+        with SettlementWriter(path) as writer:
+            for start in range(0, len(settlements), 400):
+                writer.write(settlements.iloc[start:start + 400])
+
+        assert_frame_equal(pd.read_csv(path), settlements)
+
+    @mark.parametrize('extension', ['csv.gz', 'csv.xz'])
+    def test_writer_compresses(self, settlements, tmpdir, extension):
+        path = os.path.join(str(tmpdir), 'settlements.' + extension)
+
+        with SettlementWriter(path, temporary=True) as writer:
+            for start in range(0, len(settlements), 400):
+                writer.write(settlements.iloc[start:start + 400])
+            assert not os.path.exists(path)
+
+        assert os.listdir(str(tmpdir)) == ['settlements.' + extension]
+        assert os.path.getsize(path) < settlements.memory_usage().sum() / 4
+        actual = SettlementProcessor(path).df
+        assert_frame_equal(actual.astype({SET_COUNTRY: object}), settlements, check_dtype=False)
+
+    def test_result_dtypes(self, settlements):
+        settlements[SET_POP + '2030'] = settlements[SET_POP]
+        settlements['Unknown'] = settlements[SET_GHI]
+
+        dtypes = SettlementProcessor.result_dtypes(settlements)
+
+        assert dtypes[SET_X_DEG] == 'float32'
+        assert dtypes[SET_GHI] == 'float32'
+        assert SET_POP not in dtypes
+        assert SET_POP + '2030' not in dtypes
+        assert 'Unknown' not in dtypes
+        assert SET_URBAN not in dtypes
+
+    def test_is_output(self):
+        output_columns = [SET_POP, SET_RESIDENTIAL_TIER]
+
+        assert SettlementProcessor.is_output(SET_RESIDENTIAL_TIER, output_columns)
+        assert SettlementProcessor.is_output(SET_POP + '2025', output_columns, [2018, 2025])
+        assert not SettlementProcessor.is_output(SET_POP + '2030', output_columns, [2018, 2025])
+        assert not SettlementProcessor.is_output(SET_RESIDENTIAL_TIER + '1', output_columns, [2018, 2025])
+
+    def test_result_dataset(self, settlements, tmpdir):
+        dataset = ResultDataset(str(tmpdir))
+        dataset.write_base(settlements[[SET_X_DEG, SET_POP, SET_GHI]])
+        partitions = [{'Population_Growth': 0, 'Prioritization_algorithm': 2},
+                      {'Population_Growth': 1, 'Prioritization_algorithm': 2}]
+        results = []
+        for number, partition in enumerate(partitions):
+            result = settlements[[SET_X_DEG, SET_POP, SET_GHI]].copy()
+            result[SET_POP] *= 1 + number
+            result.insert(1, SET_ELEC_FINAL_CODE + '2030', np.full(len(result), number, dtype='int8'))
+            dataset.write_scenario(partition, result, chunk_rows=400)
+            results.append(result)
+
+        assert dataset.partitions() == partitions
+        assert [entry['name'] for entry in ColumnStore.metadata(dataset.partition_folder(partitions[0]))['columns']] \
+            == [SET_ELEC_FINAL_CODE + '2030']
+        for partition, result in zip(partitions, results):
+            assert_frame_equal(dataset.read(partition), result)
+        assert_frame_equal(dataset.read(partitions[1], [SET_GHI, SET_POP], rows=slice(10, 20)),
+                           results[1][[SET_POP, SET_GHI]].iloc[10:20].reset_index(drop=True))
+        scanned = dataset.scan([SET_POP], partitions[1:])
+        assert list(scanned.columns) == ['Population_Growth', 'Prioritization_algorithm', SET_POP]
+        assert (scanned['Population_Growth'] == 1).all()
+
+    def test_rows_per_chunk(self, settlements, tmpdir):
+        path = os.path.join(str(tmpdir), 'settlements.csv')
+        settlements.to_csv(path, index=False)
+        row_bytes = settlements.memory_usage(index=False, deep=True).sum() / len(settlements)
+
+        assert SettlementProcessor.rows_per_chunk(path, 100 * row_bytes, copies=4) == 25
+        assert SettlementProcessor.rows_per_chunk(path, 1) == 1
+
+
+class TestEnforceSchema:
+
+    def test_casts_yearly_columns(self):
+        onsseter = SettlementProcessor(os.path.join('test', 'test_data', 'dj-test.csv'))
+        onsseter.df = pd.DataFrame({SET_ELEC_FINAL_CODE + '2030': [1.0, 99.0, 3.0],
+                                    SET_ELEC_FINAL_CODE + '2025': [1.0, np.nan, 3.0],
+                                    SET_MIN_OVERALL + '2030': ['Grid2030', 'SA_PV2030', 'Grid2030'],
+                                    SET_URBAN: [0, 1, 300],
+                                    'Other2030': [1.0, 2.0, 3.0]})
+
+        onsseter.enforce_schema()
+
+        dtypes = onsseter.df.dtypes
+        assert dtypes[SET_ELEC_FINAL_CODE + '2030'] == np.int8
+        assert dtypes[SET_ELEC_FINAL_CODE + '2025'] == np.float64
+        assert dtypes[SET_MIN_OVERALL + '2030'] == 'category'
+        assert dtypes[SET_URBAN] == np.int64
+        assert dtypes['Other2030'] == np.float64
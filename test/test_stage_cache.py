@@ -0,0 +1,106 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+from onsset import StageCache, Technology
+from pandas.testing import assert_frame_equal
+
+
+class Stages:
+
+    def __init__(self):
+        self.df = pd.DataFrame({'a': np.arange(1000, dtype=float)})
+        self.calls = 0
+
+    def double(self, factor=2):
+        self.calls += 1
+        self.df['b'] = self.df['a'] * factor
+        return self.df['b'].values
+
+
+class TestStageCache:
+
+    def test_restores_stage(self):
+        cache = StageCache()
+        first = Stages()
+        expected = cache.run(first, first.double, {'factor': 3}, factor=3)
+
+        second = Stages()
+        actual = cache.run(second, second.double, {'factor': 3}, factor=3)
+
+        assert second.calls == 0
+        assert cache.hits == 1 and cache.misses == 1
+        assert_frame_equal(second.df, first.df)
+        np.testing.assert_array_equal(actual, expected)
+
+        # Restored entries are copies
+        second.df['a'] = 0
+        third = Stages()
+        cache.run(third, third.double, {'factor': 3}, factor=3)
+        assert_frame_equal(third.df, first.df)
+
+    def test_parameters_are_part_of_key(self):
+        cache = StageCache()
+        for factor in (2, 3):
+            stages = Stages()
+            cache.run(stages, stages.double, {'factor': factor}, factor=factor)
+            assert stages.calls == 1
+
+    def test_evicts_least_recently_used(self):
+        stages = Stages()
+        entry_size = StageCache.nbytes_of((stages.double(), stages.df))
+        cache = StageCache(max_bytes=2 * entry_size)
+
+        for factor in (1, 2, 1, 3):
+            stages = Stages()
+            cache.run(stages, stages.double, {'factor': factor}, factor=factor)
+
+        assert cache.nbytes <= 2 * entry_size
+        assert len(cache.entries) == 2
+        stages = Stages()
+        cache.run(stages, stages.double, {'factor': 1}, factor=1)
+        assert stages.calls == 0
+        cache.run(stages, stages.double, {'factor': 2}, factor=2)
+        assert stages.calls == 1
+
+    def test_folder(self, tmpdir):
+        stages = Stages()
+        StageCache(folder=str(tmpdir)).run(stages, stages.double, {'factor': 2}, factor=2)
+
+        cache = StageCache(folder=str(tmpdir))
+        restored = Stages()
+        cache.run(restored, restored.double, {'factor': 2}, factor=2)
+
+        assert restored.calls == 0
+        assert_frame_equal(restored.df, stages.df)
+
+    def test_pickle_leaves_entries_behind(self):
+        cache = StageCache()
+        stages = Stages()
+        cache.run(stages, stages.double, {'factor': 2}, factor=2)
+
+        copied = pickle.loads(pickle.dumps(cache))
+
+        assert len(copied.entries) == 0 and copied.sizes == {} and copied.nbytes == 0
+        assert copied.max_bytes == cache.max_bytes and copied.code == cache.code
+        assert len(cache.entries) == 1
+
+    def test_code_version_is_part_of_key(self, tmpdir):
+        stages = Stages()
+        StageCache(folder=str(tmpdir)).run(stages, stages.double, {'factor': 2}, factor=2)
+
+        cache = StageCache(folder=str(tmpdir))
+        cache.code = 'changed'
+        restored = Stages()
+        cache.run(restored, restored.double, {'factor': 2}, factor=2)
+
+        assert restored.calls == 1
+
+    def test_technology_fingerprint(self):
+        Technology.set_default_values(base_year=2018, start_year=2018, end_year=2030, discount_rate=0.08)
+        pv = Technology(capital_cost={float("inf"): 2950})
+        same = Technology(capital_cost={float("inf"): 2950})
+        cheaper = Technology(capital_cost={float("inf"): 2000})
+
+        assert StageCache.technology_fingerprint(pv) == StageCache.technology_fingerprint(same)
+        assert StageCache.technology_fingerprint(pv) != StageCache.technology_fingerprint(cheaper)
@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_allclose
+from onsset import (SET_ELEC_FINAL_CODE, SET_INVESTMENT_COST, SET_LIMIT, SET_NEW_CAPACITY, SET_NEW_CONNECTIONS,
+                    SET_POP, SET_URBAN, SettlementProcessor)
+from pytest import fixture
+
+
+class TestSummarise:
+
+    @fixture
+    def setup_settlementprocessor(self) -> SettlementProcessor:
+        settlementprocessor = SettlementProcessor(os.path.join('test', 'test_data', 'dj-test.csv'))
+        rng = np.random.RandomState(7)
+        n = 1000
+        settlementprocessor.df = pd.DataFrame({SET_ELEC_FINAL_CODE + '2030': rng.choice([1, 3, 5, 99], n),
+                                               SET_LIMIT + '2030': rng.choice([0, 1], n),
+                                               SET_URBAN: rng.choice([0, 1, 2], n),
+                                               SET_POP + '2030': rng.uniform(0, 1000, n),
+                                               SET_NEW_CONNECTIONS + '2030': rng.uniform(0, 1000, n),
+                                               SET_NEW_CAPACITY + '2030': rng.uniform(0, 100, n),
+                                               SET_INVESTMENT_COST + '2030': rng.uniform(0, 1e5, n)})
+        return settlementprocessor
+
+    def test_matches_masked_sums(self, setup_settlementprocessor):
+        sp = setup_settlementprocessor
+        df = sp.df
+        tech_codes = [1, 2, 3, 4, 5, 6, 7]
+
+        summary = sp.summarise(2030, tech_codes)
+        by_urban = sp.summarise(2030, tech_codes, by=SET_URBAN)
+
+        for s in [SET_POP, SET_NEW_CONNECTIONS, SET_NEW_CAPACITY, SET_INVESTMENT_COST]:
+            for t in tech_codes:
+                electrified = (df[SET_ELEC_FINAL_CODE + '2030'] == t) & (df[SET_LIMIT + '2030'] == 1)
+                assert_allclose(summary.loc[t, s], df.loc[electrified, s + '2030'].sum())
+                for urban in [0, 1, 2]:
+                    assert_allclose(by_urban.loc[(urban, t), s],
+                                    df.loc[electrified & (df[SET_URBAN] == urban), s + '2030'].sum())
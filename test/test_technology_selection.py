@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_array_equal
+from onsset import SettlementProcessor
+from pytest import mark
+
+
+def test_least_cost_technology():
+    df = pd.DataFrame({'Grid2030': [0.2, 99, np.nan, 0.1, np.nan],
+                       'SA_PV2030': [0.3, 0.4, 0.5, 0.1, np.nan],
+                       'MG_PV2030': [0.1, 0.4, np.nan, 0.3, np.nan]})
+
+    choice, min_lcoe = SettlementProcessor.least_cost_technology(df)
+    names = pd.Categorical.from_codes(choice, df.columns)
+
+    expected = df.T.idxmin()
+    assert_array_equal(np.asarray(names, dtype=object)[:4], expected.values[:4])
+    assert pd.isna(names[4])
+    assert_array_equal(min_lcoe, df.T.min().values)
+    assert_array_equal(SettlementProcessor.technology_codes(choice, [1, 3, 5]), [5, 3, 3, 1, np.nan])
+
+
+def sorted_limits(df, eleclimit, by):
+    """The data frame sorting implementation that ``SettlementProcessor.apply_limitations`` replaces"""
+    elec_target_pop = eleclimit * df['Pop2030'].sum()
+    df = df.assign(InvestmentCapita2030=df['InvestmentCost2030'] / df['NewConnections2030'],
+                   Intensification=np.where(df['PlannedMVLineDist'] < 5, 1, 0))
+    df = df.sort_values(by=by)
+    limit = pd.Series(np.where(df['Pop2030'].cumsum() < elec_target_pop, 1, 0), index=df.index).sort_index()
+    limit[df.sort_index()['FinalElecCode2025'] < 99] = 1
+    return limit.values
+
+
+@mark.parametrize('prioritization, by', [(2, ['FinalElecCode2025', 'Intensification', 'InvestmentCapita2030']),
+                                         (5, ['FinalElecCode2025', 'InvestmentCapita2030'])])
+def test_apply_limitations(prioritization, by):
+    rng = np.random.RandomState(0)
+    n = 200
+    df = pd.DataFrame({'Pop2030': rng.uniform(0, 1000, n),
+                       'NewConnections2030': rng.choice([0, 10, 100], n).astype(float),
+                       'InvestmentCost2030': rng.choice([0, 1000, 5000, 20000], n).astype(float),
+                       'NewCapacity2030': rng.uniform(0, 10, n),
+                       'PlannedMVLineDist': rng.uniform(0, 20, n),
+                       'FinalElecCode2025': rng.choice([1, 3, 99], n),
+                       'MinimumOverallCode2030': rng.choice([1, 3, 5], n)})
+    onsseter = SettlementProcessor(df.copy())
+
+    onsseter.apply_limitations(0.6, 2030, 5, prioritization, auto_densification=5)
+
+    limit = sorted_limits(df, 0.6, by)
+    assert_array_equal(onsseter.df['ElecStatusIn2030'], limit)
+    assert_array_equal(onsseter.df['FinalElecCode2030'], np.where(limit == 1, df['MinimumOverallCode2030'], 99))
+    assert_array_equal(onsseter.df['InvestmentCost2030'], np.where(limit == 1, df['InvestmentCost2030'], 0))